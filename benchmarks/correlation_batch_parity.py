@@ -0,0 +1,132 @@
+# Проверяет, что батчевый поиск пиков корреляции (services.fft_correlator.find_correlation_peaks_batch)
+# совпадает с поиском по одной паре: эпизоды разной длины собираются в батчи s3_correlator.generate_pair_batches
+# с маленьким бюджетом памяти, так что пары сериала делятся на несколько батчей.
+# Отдельно проверяются множители корреляции по смещениям (scales). При расхождении код возврата 1.
+# Запуск на CPU: AOR_BACKEND=numpy python -m benchmarks.correlation_batch_parity
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from config import RATE, WINDOW_BEAT
+from services.audio_loader import load_folder_lazy, save_npy_audio
+from services.backend import xp, asnumpy
+from services.correlator import (correlation_with_async_moving_window, correlation_with_async_moving_window_batch,
+                                 estimate_pair_memory_bytes)
+from services.fft_correlator import (compute_blocks_spectra, compute_fragments_spectra, find_correlation_peaks,
+                                     find_correlation_peaks_batch, get_fft_size)
+from s3_correlator import generate_pair_batches
+
+NUM_EPISODES = 5
+MIN_DURATION_SECS = 70
+MAX_DURATION_SECS = 150
+OPENING_SECS = 20
+# Бюджет на две самые тяжелые пары: в батч попадает не больше двух-трех пар
+PAIRS_PER_BATCH = 2
+SEED = 0
+
+
+def generate_episodes(folder: str, seed: int = SEED):
+    """
+    Сохраняет эпизоды разной длины с общим опенингом в разных местах, как после s2_extract_audio.py.
+    """
+    rng = np.random.default_rng(seed)
+    opening = rng.standard_normal(OPENING_SECS * RATE).astype(np.float32)
+    for episode in range(1, NUM_EPISODES + 1):
+        audio = rng.standard_normal(int(rng.integers(MIN_DURATION_SECS, MAX_DURATION_SECS)) * RATE).astype(np.float32)
+        begin = int(rng.integers(0, len(audio) - len(opening)))
+        audio[begin:begin + len(opening)] += opening
+        save_npy_audio(os.path.join(folder, f'{episode}.npy'), audio, RATE)
+
+
+def compare(name: str, expected: tuple[np.ndarray, np.ndarray], actual: tuple[np.ndarray, np.ndarray]) -> bool:
+    """
+    Смещения должны совпадать точно, пики - с точностью до округления float.
+    """
+    (expected_offsets, expected_peaks), (actual_offsets, actual_peaks) = expected, actual
+    if np.array_equal(expected_offsets, actual_offsets) \
+            and np.allclose(expected_peaks, actual_peaks, rtol=1e-5, atol=1e-6):
+        return True
+    print(f'Mismatch in {name}: per pair {expected_offsets}, {expected_peaks}; '
+          f'batched {actual_offsets}, {actual_peaks}')
+    return False
+
+
+def split_window_offsets(offsets: xp.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Результат correlation_with_async_moving_window - строки (offset1, offset2, corr)
+    offsets = asnumpy(offsets)
+    return offsets[:, :2], offsets[:, 2]
+
+
+def check_batches(folder: str) -> tuple[int, int, int, float, float]:
+    files = load_folder_lazy(folder)
+    memory_budget = PAIRS_PER_BATCH * estimate_pair_memory_bytes(MAX_DURATION_SECS * RATE, MAX_DURATION_SECS * RATE)
+
+    num_batches = num_pairs = mismatches = 0
+    single_secs = batched_secs = 0.0
+    for batch in generate_pair_batches(files, memory_budget):
+        pairs = [(audio1, audio2) for (_, audio1), (_, audio2) in batch]
+
+        t = time.perf_counter()
+        batched = correlation_with_async_moving_window_batch(pairs, multiresolution=False)
+        batched_secs += time.perf_counter() - t
+
+        t = time.perf_counter()
+        single = [correlation_with_async_moving_window(audio1, audio2, multiresolution=False)
+                  for audio1, audio2 in pairs]
+        single_secs += time.perf_counter() - t
+
+        for ((file1, _), (file2, _)), expected, actual in zip(batch, single, batched):
+            mismatches += not compare(f'{file1}, {file2}', split_window_offsets(expected), split_window_offsets(actual))
+        num_batches += 1
+        num_pairs += len(batch)
+
+    return num_batches, num_pairs, mismatches, single_secs, batched_secs
+
+
+def check_scales(folder: str, seed: int = SEED) -> int:
+    """
+    Пары с разными множителями по смещениям в одном батче против find_correlation_peaks с тем же множителем.
+    """
+    rng = np.random.default_rng(seed)
+    nfft = get_fft_size(WINDOW_BEAT)
+    audios = [xp.asarray(file.load()) for file in load_folder_lazy(folder)]
+    pairs = list(zip(audios[:-1], audios[1:]))
+
+    fragments_spectra = [compute_fragments_spectra(audio1[:len(audio1) // WINDOW_BEAT * WINDOW_BEAT]
+                                                   .reshape(-1, WINDOW_BEAT), nfft)
+                         for audio1, _ in pairs]
+    blocks_spectra = [compute_blocks_spectra(audio2, WINDOW_BEAT, nfft) for _, audio2 in pairs]
+    scales = [xp.asarray(rng.uniform(0.5, 2, len(audio2) - WINDOW_BEAT + 1)) for _, audio2 in pairs]
+
+    batched = find_correlation_peaks_batch(fragments_spectra, blocks_spectra, WINDOW_BEAT,
+                                           [len(audio2) for _, audio2 in pairs], nfft, scales)
+    mismatches = 0
+    for i, ((_, audio2), (offsets, peaks)) in enumerate(zip(pairs, batched)):
+        expected_offsets, expected_peaks = find_correlation_peaks(fragments_spectra[i], blocks_spectra[i],
+                                                                  WINDOW_BEAT, len(audio2), nfft, scales[i])
+        mismatches += not compare(f'scaled pair {i + 1}',
+                                  (asnumpy(expected_offsets), asnumpy(expected_peaks)),
+                                  (asnumpy(offsets), asnumpy(peaks)))
+    return mismatches
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        generate_episodes(folder)
+        num_batches, num_pairs, mismatches, single_secs, batched_secs = check_batches(folder)
+        scale_mismatches = check_scales(folder)
+
+    print(f'{num_pairs} pairs in {num_batches} batches, {mismatches} mismatches, '
+          f'{scale_mismatches} mismatches with scales')
+    print(f'per pair: {single_secs:.3f}s, batched: {batched_secs:.3f}s')
+    if num_batches < 2:
+        print('Memory budget did not split the pairs into several batches')
+        return 1
+    return 1 if mismatches or scale_mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
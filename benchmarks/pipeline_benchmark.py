@@ -0,0 +1,176 @@
+# Скорость и точность конвейера поиска опенингов на синтетических сезонах.
+# Сезон - эпизоды из шумовой или тональной подложки с общим опенингом на известных разных смещениях,
+# уникальными отвлекающими вставками и тишиной. Этапы s3 (асинхронное окно, выравнивание, синхронное окно)
+# и s4 (поиск сегментов и смещений) замеряются отдельно, найденные опенинги сравниваются с истинными.
+# Результат - JSON для сравнения между запусками.
+# С AOR_PAIR_SCHEDULER_ENABLED=1 пары выбираются адаптивным планировщиком вместо всех пар окна.
+# Запуск: python -m benchmarks.pipeline_benchmark [файл.json] [количество эпизодов]
+import json
+import platform
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from config import RATE, SERIES_WINDOW, WINDOW, BACKEND, MULTIRES_ENABLED, PAIR_SCHEDULER_ENABLED
+from services.backend import xp, asnumpy
+from services.correlator import correlation_with_async_moving_window, correlation_with_sync_moving_window
+from services.fragments_normalizer import normalize_fragments
+from services.pair_scheduler import PairScheduler
+from services.segment_detector import find_pair_openings
+from services.offset_searcher import solve_true_offsets
+from s4_offsets_calculator import find_offsets_by_pair, fix_offsets
+
+DURATION_SECS = 150
+OPENING_SECS = 40
+DISTRACTOR_SECS = 8
+SILENCE_SECS = 5
+# Опенинг считается найденным, если обе границы ошиблись не больше чем на столько секунд
+TOLERANCE_SECS = 2.0
+SEED = 0
+
+
+def generate_bed(rng: np.random.Generator, length: int, kind: str) -> np.ndarray:
+    if kind == 'tone':
+        t = np.arange(length) / RATE
+        frequencies = rng.uniform(100, 2000, 3)
+        bed = sum(np.sin(2 * np.pi * frequency * t + rng.uniform(0, 2 * np.pi)) for frequency in frequencies) / 3
+        return (bed + 0.3 * rng.standard_normal(length)).astype(np.float32)
+    return rng.standard_normal(length).astype(np.float32)
+
+
+def generate_season(num_episodes: int, seed: int = SEED) -> tuple[dict[str, np.ndarray], dict[str, tuple[float, float]]]:
+    """
+    :return: (audios, truth) - аудио эпизодов и истинные (начало, конец) опенинга в секундах по имени файла
+    """
+    rng = np.random.default_rng(seed)
+    opening = 2 * rng.standard_normal(OPENING_SECS * RATE).astype(np.float32)
+    audios = {}
+    truth = {}
+    for episode in range(1, num_episodes + 1):
+        audio = generate_bed(rng, DURATION_SECS * RATE, 'tone' if episode % 2 else 'noise')
+
+        begin_secs = int(rng.integers(5, DURATION_SECS - OPENING_SECS - DISTRACTOR_SECS - SILENCE_SECS - 5))
+        audio[begin_secs * RATE:(begin_secs + OPENING_SECS) * RATE] += opening
+
+        # Отвлекающая вставка и тишина - вне опенинга
+        free_secs = [secs for secs in range(DURATION_SECS - DISTRACTOR_SECS)
+                     if secs + DISTRACTOR_SECS <= begin_secs or secs >= begin_secs + OPENING_SECS]
+        distractor_secs = int(rng.choice(free_secs))
+        audio[distractor_secs * RATE:(distractor_secs + DISTRACTOR_SECS) * RATE] += \
+            2 * rng.standard_normal(DISTRACTOR_SECS * RATE).astype(np.float32)
+        silence_secs = int(rng.choice([secs for secs in free_secs
+                                       if secs + SILENCE_SECS <= distractor_secs
+                                       or secs >= distractor_secs + DISTRACTOR_SECS]))
+        audio[silence_secs * RATE:(silence_secs + SILENCE_SECS) * RATE] = 0
+
+        # Та же нормализация, что при загрузке в s3_correlator
+        audio = audio - audio.mean()
+        audios[f'{episode}.wav'] = audio / np.max(np.abs(audio))
+        truth[f'{episode}.wav'] = (float(begin_secs), float(begin_secs + OPENING_SECS))
+    return audios, truth
+
+
+class Timer:
+    def __init__(self):
+        self.elapsed = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def measure(self, stage: str, func, *args):
+        t = time.perf_counter()
+        result = func(*args)
+        self.elapsed[stage] += time.perf_counter() - t
+        self.calls[stage] += 1
+        return result
+
+    def to_dict(self) -> dict:
+        return {stage: {'total_secs': round(self.elapsed[stage], 6),
+                        'calls': self.calls[stage],
+                        'per_call_secs': round(self.elapsed[stage] / self.calls[stage], 6)}
+                for stage in self.elapsed}
+
+
+def run_pipeline(audios: dict[str, np.ndarray],
+                 timer: Timer,
+                 scheduler: PairScheduler | None = None) -> tuple[dict[str, tuple[float, float]], int]:
+    """
+    :return: (найденные опенинги, количество скоррелированных пар)
+    """
+    files = sorted(audios, key=lambda file: int(file.split('.')[0]))
+    gpu_audios = {file: xp.asarray(audio) for file, audio in audios.items()}
+    pairs = scheduler.iter_pairs() if scheduler is not None else \
+        [(files[i], files[j]) for i in range(len(files) - 1) for j in range(i + 1, min(len(files), i + SERIES_WINDOW))]
+
+    data = []
+    for file1, file2 in pairs:
+        audio1, audio2 = gpu_audios[file1], gpu_audios[file2]
+
+        offsets_by_windows = timer.measure('async_window', correlation_with_async_moving_window, audio1, audio2)
+        best_offset1, best_offset2, _ = offsets_by_windows[xp.argmax(offsets_by_windows[:, 2])]
+        truncated_audio1, truncated_audio2, offset1_secs, offset2_secs = \
+            timer.measure('normalize_fragments', normalize_fragments, best_offset1, best_offset2, audio1, audio2)
+        corr_by_beats = timer.measure('sync_window', correlation_with_sync_moving_window,
+                                      truncated_audio1, truncated_audio2)
+        data.append((file1, file2, float(offset1_secs), float(offset2_secs), asnumpy(corr_by_beats)))
+        if scheduler is not None:
+            scheduler.add((file1, file2), timer.measure('pair_scheduler', find_pair_openings, data[-1:])[0])
+
+    offsets_by_pair = timer.measure('s4_find_segments', find_offsets_by_pair, data)
+    true_offsets, _ = timer.measure('s4_true_offsets', solve_true_offsets, offsets_by_pair)
+    return timer.measure('s4_fix_offsets', fix_offsets, true_offsets), len(data)
+
+
+def evaluate(found: dict[str, tuple[float, float]], truth: dict[str, tuple[float, float]]) -> dict:
+    errors = []
+    for file, (true_begin, true_end) in truth.items():
+        if file in found:
+            begin, end = found[file]
+            errors.append((abs(begin - true_begin), abs(end - true_end)))
+
+    errors = np.array(errors, dtype=np.float64).reshape(-1, 2)
+    detected = int(np.sum(np.all(errors <= TOLERANCE_SECS, axis=1)))
+    return {
+        'episodes': len(truth),
+        'found': int(errors.shape[0]),
+        'detected_within_tolerance': detected,
+        'detection_rate': detected / len(truth),
+        'tolerance_secs': TOLERANCE_SECS,
+        'begin_error_secs': _summarize(errors[:, 0]),
+        'end_error_secs': _summarize(errors[:, 1]),
+    }
+
+
+def _summarize(values: np.ndarray) -> dict:
+    if len(values) == 0:
+        return {'mean': None, 'median': None, 'max': None}
+    return {'mean': float(np.mean(values)), 'median': float(np.median(values)), 'max': float(np.max(values))}
+
+
+def main(output_path: str | None = None, num_episodes: int = 6):
+    audios, truth = generate_season(num_episodes)
+
+    timer = Timer()
+    t = time.perf_counter()
+    found, num_pairs = run_pipeline(audios, timer, PairScheduler(list(audios)) if PAIR_SCHEDULER_ENABLED else None)
+    total_secs = time.perf_counter() - t
+
+    result = {
+        'environment': {'backend': BACKEND, 'python': platform.python_version(), 'machine': platform.machine()},
+        'parameters': {'rate': RATE, 'window': WINDOW, 'series_window': SERIES_WINDOW,
+                       'multiresolution': MULTIRES_ENABLED, 'pair_scheduler': PAIR_SCHEDULER_ENABLED,
+                       'episodes': num_episodes,
+                       'duration_secs': DURATION_SECS, 'opening_secs': OPENING_SECS, 'seed': SEED},
+        'timings': {'total_secs': round(total_secs, 6), 'pairs': num_pairs, 'stages': timer.to_dict()},
+        'accuracy': evaluate(found, truth),
+    }
+
+    text = json.dumps(result, indent=2)
+    print(text)
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else None, *(int(arg) for arg in sys.argv[2:]))
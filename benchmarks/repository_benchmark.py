@@ -0,0 +1,110 @@
+# Измеряет сканирования по статусам и накладные расходы на коммиты AnilibriaRepository
+# на синтетической базе до и после миграции схемы.
+# Запуск: python -m benchmarks.repository_benchmark [количество сериалов]
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from constants import episode_statuses, series_statuses
+from services.AnilibriaRepository import AnilibriaRepository
+
+EPISODES_PER_SERIES = 24
+SCENES_PER_EPISODE = 5
+QUERY_REPEATS = 200
+SETTER_REPEATS = 300
+
+
+def create_legacy_database(path: str, num_series: int):
+    """
+    Создает базу в исходной схеме: без первичных ключей и индексов на episodes и scenes.
+    """
+    database = sqlite3.connect(path)
+    database.executescript('''
+        CREATE TABLE series (id INTEGER PRIMARY KEY, name TEXT NOT NULL,
+                             downloading_status TEXT NOT NULL, cross_correlation_status TEXT);
+        CREATE TABLE episodes (series_id INTEGER NOT NULL, episode INTEGER NOT NULL, status TEXT NOT NULL,
+                               opening_begin_secs REAL, opening_end_secs REAL,
+                               FOREIGN KEY (series_id) REFERENCES series (id));
+        CREATE TABLE scenes (series_id INTEGER NOT NULL, episode INTEGER NOT NULL,
+                             scene_begin_secs REAL NOT NULL, scene_end_secs REAL NOT NULL, hash array NOT NULL,
+                             FOREIGN KEY (series_id) REFERENCES series (id));
+        CREATE TABLE screenshots (series_id INTEGER NOT NULL, episode INTEGER NOT NULL, timecode INTEGER NOT NULL,
+                                  FOREIGN KEY (series_id, episode) REFERENCES episodes (series_id, episode)
+                                  CONSTRAINT unique_screenshot UNIQUE (series_id, episode, timecode));
+    ''')
+
+    rng = np.random.default_rng(0)
+    hash_blob = AnilibriaRepository.adapt_array(rng.random((8, 8)) > 0.5)
+    database.executemany('INSERT INTO series VALUES (?, ?, ?, NULL)',
+                         ((series_id, f'Series {series_id}', series_statuses.downloaded)
+                          for series_id in range(num_series)))
+    database.executemany('INSERT INTO episodes (series_id, episode, status) VALUES (?, ?, ?)',
+                         ((series_id, episode,
+                           episode_statuses.hashed if rng.random() < 0.95 else episode_statuses.downloaded)
+                          for series_id in range(num_series)
+                          for episode in range(1, EPISODES_PER_SERIES + 1)))
+    database.executemany('INSERT INTO scenes VALUES (?, ?, ?, ?, ?)',
+                         ((series_id, episode, scene * 10.0, scene * 10.0 + 5, hash_blob)
+                          for series_id in range(num_series)
+                          for episode in range(1, EPISODES_PER_SERIES + 1)
+                          for scene in range(SCENES_PER_EPISODE)))
+    database.commit()
+    database.close()
+
+
+def measure(name: str, repeats: int, func) -> float:
+    t = time.perf_counter()
+    for i in range(repeats):
+        func(i)
+    elapsed = (time.perf_counter() - t) / repeats
+    print(f'{name:<40} {elapsed * 1000:9.3f} ms')
+    return elapsed
+
+
+def run_queries(database: sqlite3.Connection, num_series: int, prefix: str):
+    rng = np.random.default_rng(1)
+    measure(f'{prefix} next episode by status', QUERY_REPEATS, lambda _: database.execute(
+        'SELECT series_id, episode FROM episodes WHERE status = ? ORDER BY series_id, episode desc LIMIT 1',
+        (episode_statuses.downloaded,)).fetchone())
+    measure(f'{prefix} episode lookup', QUERY_REPEATS, lambda _: database.execute(
+        'SELECT 1 FROM episodes WHERE series_id = ? AND episode = ?',
+        (int(rng.integers(num_series)), int(rng.integers(1, EPISODES_PER_SERIES + 1)))).fetchone())
+    measure(f'{prefix} episode scenes', QUERY_REPEATS, lambda _: database.execute(
+        'SELECT scene_begin_secs, scene_end_secs FROM scenes WHERE series_id = ? AND episode = ?',
+        (int(rng.integers(num_series)), int(rng.integers(1, EPISODES_PER_SERIES + 1)))).fetchall())
+
+
+def main(num_series: int = 3000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'anilibria.sqlite3')
+        print(f'Creating synthetic database with {num_series} series...')
+        create_legacy_database(path, num_series)
+
+        legacy = sqlite3.connect(path)
+        run_queries(legacy, num_series, 'legacy:')
+        measure('legacy: status setter, commit per row', SETTER_REPEATS, lambda i: (
+            legacy.execute('UPDATE episodes SET status = ? WHERE series_id = ? AND episode = ?',
+                           (episode_statuses.hashing_error, i % num_series, 1)),
+            legacy.commit()))
+        legacy.close()
+
+        t = time.perf_counter()
+        repository = AnilibriaRepository(path)
+        print(f'{"migration":<40} {(time.perf_counter() - t) * 1000:9.3f} ms')
+
+        run_queries(repository.database, num_series, 'migrated:')
+        measure('migrated: status setter, commit per row', SETTER_REPEATS,
+                lambda i: repository.set_episode_status_hashing_error(i % num_series, 2))
+        bulk_elapsed = measure('migrated: bulk status setter, one commit', 1,
+                               lambda _: repository.set_episodes_status_hashing_error(
+                                   [(i % num_series, 3) for i in range(SETTER_REPEATS)]))
+        print(f'{"migrated: bulk status setter per row":<40} {bulk_elapsed / SETTER_REPEATS * 1000:9.3f} ms')
+        repository.database.close()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,116 @@
+# Проверяет, что векторный поиск опенингов (services.segment_detector.find_pair_openings) совпадает
+# с прежним поэлементным циклом s4_offsets_calculator.py - по кривым сериалов из хранилища .aorc
+# или, если каталог не указан, по случайным кривым (плато, провалы, константные и пустые кривые).
+# Каждый сериал проверяется и целиком (одним батчем), и по одной паре. При расхождении код возврата 1.
+# Запуск: python -m benchmarks.segment_detector_parity [каталог .aorc]
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from config import RATE
+from services.correlation_store import get_series_path, list_series, read_series
+from services.segment_detector import find_pair_openings
+
+NUM_SERIES = 100
+SEED = 0
+
+
+def find_pair_opening_loop(offset1: float, offset2: float, corr: np.ndarray):
+    """
+    Прежний цикл find_and_group_offsets_by_series для одной пары.
+    """
+    corr_values = corr[:, 1]
+    max_limit = np.mean(corr_values) + 3 * np.std(corr_values)
+    filtered = corr_values[corr_values < max_limit]
+
+    if np.mean(filtered) < np.median(filtered) * 2:
+        return None
+
+    if filtered.shape[0] == 0:
+        return None
+
+    filtered_max = np.max(filtered)
+    threshold = filtered_max / 2
+    begin_idx = np.argmax(corr_values > threshold)
+    begin_idx = begin_idx if begin_idx > 3 else 0
+
+    end_idx = begin_idx
+    bad_count = 0
+    for i in range(begin_idx, len(corr_values)):
+        if corr_values[i] > threshold:
+            end_idx = i
+        else:
+            bad_count += 1
+            if bad_count > 30:
+                break
+
+    offset_begin = corr[begin_idx, 0] / RATE
+    offset_end = corr[end_idx, 0] / RATE
+    return offset1 + offset_begin, offset1 + offset_end, offset2 + offset_begin, offset2 + offset_end
+
+
+def generate_curve(rng: np.random.Generator, dtype) -> np.ndarray:
+    length = int(rng.choice([0, 1, 5, int(rng.integers(10, 400))]))
+    kind = rng.choice(['noise', 'plateau', 'dropouts', 'constant'])
+    values = rng.random(length)
+    if kind == 'constant':
+        values[:] = rng.random()
+    elif length > 0 and kind in ('plateau', 'dropouts'):
+        begin = int(rng.integers(0, length))
+        end = int(rng.integers(begin, length + 1))
+        values[begin:end] += rng.uniform(1, 10)
+        if kind == 'dropouts':
+            values[rng.random(length) < 0.1] = 0
+    return np.stack((np.arange(length) * RATE, values), axis=-1).astype(dtype)
+
+
+def generate_series(num_series: int, seed: int = SEED):
+    rng = np.random.default_rng(seed)
+    for series_id in range(num_series):
+        dtype = np.float32 if series_id % 2 else np.float64
+        yield series_id, [(f'{i}.wav', f'{i + 1}.wav', float(rng.uniform(0, 100)), float(rng.uniform(0, 100)),
+                           generate_curve(rng, dtype))
+                          for i in range(int(rng.integers(1, 30)))]
+
+
+def load_store(store_dir: str):
+    for series_id in list_series(store_dir):
+        yield series_id, read_series(get_series_path(store_dir, series_id))
+
+
+def main(store_dir: str | None = None):
+    series = load_store(store_dir) if store_dir else generate_series(NUM_SERIES)
+
+    num_series = num_pairs = mismatches = 0
+    loop_secs = vectorized_secs = 0.0
+    for series_id, data in series:
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            # Пустые кривые дают в цикле предупреждения о среднем пустого массива
+            warnings.simplefilter('ignore', RuntimeWarning)
+            t = time.perf_counter()
+            expected = [find_pair_opening_loop(offset1, offset2, corr) for _, _, offset1, offset2, corr in data]
+            loop_secs += time.perf_counter() - t
+
+        t = time.perf_counter()
+        batched = find_pair_openings(data)
+        vectorized_secs += time.perf_counter() - t
+        single = [find_pair_openings([pair])[0] for pair in data]
+
+        for (file1, file2, *_), expected_opening, batched_opening, single_opening \
+                in zip(data, expected, batched, single):
+            if not expected_opening == batched_opening == single_opening:
+                mismatches += 1
+                print(f'Mismatch in series {series_id}, {file1}, {file2}: '
+                      f'loop {expected_opening}, batched {batched_opening}, single {single_opening}')
+        num_series += 1
+        num_pairs += len(data)
+
+    print(f'{num_series} series, {num_pairs} pairs, {mismatches} mismatches')
+    print(f'loop: {loop_secs:.3f}s, vectorized: {vectorized_secs:.3f}s')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else None))
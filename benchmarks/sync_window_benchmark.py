@@ -0,0 +1,50 @@
+# Сравнивает посекундную корреляцию по одному фрагменту с батчевой реализацией на паре 6-минутных аудио.
+# Запуск: python -m benchmarks.sync_window_benchmark
+import time
+
+import numpy as np
+
+from config import RATE
+from services.backend import xp, correlate, asnumpy
+from services.correlator import correlation_with_sync_moving_window
+
+DURATION_SECS = 6 * 60
+
+
+def correlation_per_second(audio1, audio2):
+    num_seconds = audio1.shape[0] // RATE
+    max_correlations = []
+    for i in range(num_seconds):
+        fragment1 = audio1[i * RATE:(i + 1) * RATE]
+        fragment2 = audio2[i * RATE:(i + 1) * RATE]
+        fragment1 = (fragment1 - fragment1.mean()) / fragment1.std()
+        fragment2 = (fragment2 - fragment2.mean()) / fragment2.std()
+        max_correlations.append(xp.max(correlate(fragment1, fragment2, mode='full')))
+
+    return xp.stack((xp.arange(num_seconds) * RATE, xp.array(max_correlations)), axis=-1)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    opening = rng.standard_normal(90 * RATE).astype(np.float32)
+    audio1 = rng.standard_normal(DURATION_SECS * RATE).astype(np.float32)
+    audio2 = rng.standard_normal(DURATION_SECS * RATE).astype(np.float32)
+    audio1[60 * RATE:150 * RATE] += opening
+    audio2[60 * RATE:150 * RATE] += opening
+    audio1, audio2 = xp.asarray(audio1), xp.asarray(audio2)
+
+    t = time.perf_counter()
+    before = asnumpy(correlation_per_second(audio1, audio2))
+    before_secs = time.perf_counter() - t
+
+    t = time.perf_counter()
+    after = asnumpy(correlation_with_sync_moving_window(audio1, audio2))
+    after_secs = time.perf_counter() - t
+
+    print(f'per-second: {before_secs:.3f}s')
+    print(f'batched:    {after_secs:.3f}s ({before_secs / after_secs:.1f}x)')
+    print(f'max abs diff: {np.max(np.abs(before[:, 1] - after[:, 1])):.3e}')
+
+
+if __name__ == '__main__':
+    main()
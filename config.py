@@ -1,3 +1,5 @@
+import os
+
 WINDOW = 30
 RATE = 44100
 WINDOW_BEAT = WINDOW * RATE
@@ -6,3 +8,90 @@ WINDOW_BEAT = WINDOW * RATE
 SERIES_WINDOW = 5
 
 SKIP_TIMESTAMPED = False
+
+# Вычислительный бэкенд: 'cupy' (GPU) или 'numpy' (CPU, NumPy/SciPy)
+BACKEND = os.environ.get('AOR_BACKEND', 'cupy')
+# Количество потоков для FFT на CPU-бэкенде
+FFT_WORKERS = int(os.environ.get('AOR_FFT_WORKERS', os.cpu_count() or 1))
+
+# Кэш предрассчитанных признаков эпизодов (спектры фрагментов и блоков)
+FEATURE_CACHE_MEMORY_BYTES = int(os.environ.get('AOR_FEATURE_CACHE_MEMORY_BYTES', 2 * 1024 ** 3))
+# Каталог дискового кэша признаков; пустое значение отключает дисковый кэш
+FEATURE_CACHE_PATH = os.environ.get('AOR_FEATURE_CACHE_PATH', '')
+FEATURE_CACHE_DISK_BYTES = int(os.environ.get('AOR_FEATURE_CACHE_DISK_BYTES', 20 * 1024 ** 3))
+
+# Поиск смещений от грубого к точному: сначала на прореженном аудио, затем уточнение лучших кандидатов
+MULTIRES_ENABLED = os.environ.get('AOR_MULTIRES_ENABLED', '0') == '1'
+# Во сколько раз прореживается аудио на грубом шаге; WINDOW_BEAT должен делиться на это значение
+MULTIRES_DECIMATION = int(os.environ.get('AOR_MULTIRES_DECIMATION', 20))
+# Количество фрагментов-кандидатов, уточняемых на полной частоте
+MULTIRES_CANDIDATES = int(os.environ.get('AOR_MULTIRES_CANDIDATES', 3))
+# Радиус окна уточнения вокруг грубого смещения, в секундах
+MULTIRES_REFINE_RADIUS_SECS = float(os.environ.get('AOR_MULTIRES_REFINE_RADIUS_SECS', 0.1))
+
+# Адаптивный выбор пар вместо всех пар в окне SERIES_WINDOW: пары перебираются кругами от соседних эпизодов
+# к более далеким (до PAIR_SCHEDULER_MAX_WINDOW), и эпизод больше не сравнивается, как только у него набралось
+# PAIR_SCHEDULER_CONSENSUS оценок опенинга, согласных между собой с точностью PAIR_SCHEDULER_TOLERANCE_SECS
+PAIR_SCHEDULER_ENABLED = os.environ.get('AOR_PAIR_SCHEDULER_ENABLED', '0') == '1'
+PAIR_SCHEDULER_CONSENSUS = int(os.environ.get('AOR_PAIR_SCHEDULER_CONSENSUS', 3))
+PAIR_SCHEDULER_TOLERANCE_SECS = float(os.environ.get('AOR_PAIR_SCHEDULER_TOLERANCE_SECS', 1.5))
+PAIR_SCHEDULER_MAX_WINDOW = int(os.environ.get('AOR_PAIR_SCHEDULER_MAX_WINDOW', SERIES_WINDOW))
+
+# Согласование смещений опенингов сериала (services.offset_searcher): вес относительного ограничения пары
+# (разность начал в двух эпизодах известна точнее самих границ), число итераций взвешенного МНК
+# и нижняя граница масштаба невязок, в секундах (границы найдены с точностью до секунды)
+OFFSET_SOLVER_RELATIVE_WEIGHT = float(os.environ.get('AOR_OFFSET_SOLVER_RELATIVE_WEIGHT', 4))
+OFFSET_SOLVER_ITERATIONS = int(os.environ.get('AOR_OFFSET_SOLVER_ITERATIONS', 20))
+OFFSET_SOLVER_MIN_SCALE_SECS = float(os.environ.get('AOR_OFFSET_SOLVER_MIN_SCALE_SECS', 0.5))
+
+# Количество процессов, параллельно обрабатывающих сериалы; 1 - последовательная обработка
+POOL_WORKERS = int(os.environ.get('AOR_POOL_WORKERS', 1))
+# Потоков BLAS/FFT на один процесс; по умолчанию ядра делятся между процессами поровну
+THREADS_PER_WORKER = int(os.environ.get('AOR_THREADS_PER_WORKER', max(1, (os.cpu_count() or 1) // POOL_WORKERS)))
+# Через сколько секунд без обновления захват сериала считается брошенным
+CLAIM_TIMEOUT_SECS = int(os.environ.get('AOR_CLAIM_TIMEOUT_SECS', 10 * 60))
+# Срок аренды задач в базе (эпизодов и сериалов); без продления задача возвращается в очередь
+LEASE_SECS = int(os.environ.get('AOR_LEASE_SECS', 10 * 60))
+
+# Извлечение аудио: сколько секунд с конца видео берется, частота дискретизации и число параллельных ffmpeg
+TRUNCATE_SECS = int(os.environ.get('AOR_TRUNCATE_SECS', 6 * 60))
+EXTRACT_RATE = int(os.environ.get('AOR_EXTRACT_RATE', RATE))
+EXTRACT_WORKERS = int(os.environ.get('AOR_EXTRACT_WORKERS', os.cpu_count() or 1))
+
+# Бюджет памяти на батч пар, коррелируемых одним вызовом
+PAIR_BATCH_MEMORY_BYTES = int(os.environ.get('AOR_PAIR_BATCH_MEMORY_BYTES', 2 * 1024 ** 3))
+
+# Индекс похожих сцен: на сколько полос делится хэш сцены (точное совпадение хотя бы одной полосы
+# гарантировано при расстоянии Хэмминга меньше числа полос) и проверять ли соседние ключи полос на 1 бит
+SCENE_INDEX_BANDS = int(os.environ.get('AOR_SCENE_INDEX_BANDS', 4))
+SCENE_INDEX_MULTI_PROBE = os.environ.get('AOR_SCENE_INDEX_MULTI_PROBE', '1') == '1'
+
+# Библиотека известных опенингов: каталог с шаблонами; пустое значение отключает поиск по библиотеке
+OPENING_LIBRARY_PATH = os.environ.get('AOR_OPENING_LIBRARY_PATH', '')
+# Длина шаблона - начало опенинга, в секундах
+OPENING_TEMPLATE_SECS = int(os.environ.get('AOR_OPENING_TEMPLATE_SECS', 30))
+# Минимальная нормированная корреляция, при которой эпизод считается содержащим опенинг из библиотеки
+OPENING_LIBRARY_MIN_CORR = float(os.environ.get('AOR_OPENING_LIBRARY_MIN_CORR', 0.6))
+
+# Априорная область поиска опенинга в асинхронном окне: 'off' - поиск по всему аудио,
+# 'series' - область по уже найденным опенингам того же сериала,
+# 'catalogue' - по сериалу, а если его данных не хватает - по опенингам всех сериалов.
+# Пара коррелируется по всему аудио, если данных мало, область шире SEARCH_PRIOR_MAX_REGION_SECS
+# или корреляция Пирсона найденного фрагмента ниже SEARCH_PRIOR_MIN_CORR
+SEARCH_PRIOR_MODE = os.environ.get('AOR_SEARCH_PRIOR_MODE', 'off')
+# Сколько найденных опенингов нужно, чтобы по ним строить область
+SEARCH_PRIOR_MIN_EPISODES = int(os.environ.get('AOR_SEARCH_PRIOR_MIN_EPISODES', 3))
+# Запас по краям области, в секундах
+SEARCH_PRIOR_MARGIN_SECS = float(os.environ.get('AOR_SEARCH_PRIOR_MARGIN_SECS', WINDOW))
+SEARCH_PRIOR_MAX_REGION_SECS = float(os.environ.get('AOR_SEARCH_PRIOR_MAX_REGION_SECS', 4 * 60))
+# Квантили начал и концов опенингов всех сериалов, задающие область каталога (отсекают ошибочные опенинги)
+SEARCH_PRIOR_CATALOGUE_QUANTILE = float(os.environ.get('AOR_SEARCH_PRIOR_CATALOGUE_QUANTILE', 0.05))
+SEARCH_PRIOR_MIN_CORR = float(os.environ.get('AOR_SEARCH_PRIOR_MIN_CORR', 0.5))
+
+# Скриншоты: число процессов, декодирующих видео, и наибольший промежуток между кадрами,
+# которые достаются одной перемоткой с последовательным декодированием вперед, в секундах
+SCREENSHOT_WORKERS = int(os.environ.get('AOR_SCREENSHOT_WORKERS', os.cpu_count() or 1))
+SCREENSHOT_CLUSTER_GAP_SECS = float(os.environ.get('AOR_SCREENSHOT_CLUSTER_GAP_SECS', 10))
+
+# Замеры этапов конвейера: каталог для JSONL-трассы и текстового файла Prometheus; пустое значение отключает замеры
+INSTRUMENTATION_PATH = os.environ.get('AOR_INSTRUMENTATION_PATH', '')
@@ -4,5 +4,6 @@ hashing = 'ep_hashing'
 hashed = 'ep_hashed'
 hashing_error = 'ep_hashing_error'
 
+finalizing = 'ep_finalizing'
 finalized = 'ep_finalized'
 finalizing_error = 'ep_finalizing_error'
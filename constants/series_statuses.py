@@ -6,5 +6,6 @@ few_episodes = 'sr_few_episodes'
 downloaded = 'sr_downloaded'
 downloading_error = 'sr_downloading_error'
 
+cross_correlating = 'sr_cross_correlating'
 cross_correlated = 'sr_cross_correlated'
 cross_correlation_error = 'sr_cross_correlation_error'
@@ -2,24 +2,31 @@ import os
 import time
 from typing import Tuple
 
-import cupy as cp
-
-from config import RATE, SERIES_WINDOW
-from services.audio_loader import load_folder
-from services.correlator import correlation_with_async_moving_window, correlation_with_sync_moving_window
+from config import (RATE, SERIES_WINDOW, POOL_WORKERS, OPENING_LIBRARY_PATH, SEARCH_PRIOR_MODE,
+                    PAIR_SCHEDULER_ENABLED)
+from services.backend import xp, fuse, asnumpy
+from services.audio_loader import LazyAudio, load_folder_lazy
+from services.feature_cache import FeatureCache
+from services.correlator import correlation_with_sync_moving_window
+from services import instrumentation
 from services.fragments_normalizer import normalize_fragments
-from services.offset_searcher import find_true_offsets
+from services.opening_library import OpeningLibrary, find_offsets_by_library
+from services.pair_ledger import PairLedger, get_ledger_path, get_window_pairs
+from services.pair_scheduler import PairScheduler
+from services.search_prior import SearchPrior, SearchPriors, correlate_with_prior, read_offsets_dir
+from services.series_pool import run_series_pool, get_interrupted_series, reset_done_series
+from services.offset_searcher import solve_true_offsets
 
 
 def find_longest_same_fragment(corr_by_secs) -> Tuple[float, float, bool]:
     # Вычисление среднего значения по оси y
-    mean_y = cp.mean(corr_by_secs[:, 1])
-    median_y = cp.median(corr_by_secs[:, 1])
+    mean_y = xp.mean(corr_by_secs[:, 1])
+    median_y = xp.median(corr_by_secs[:, 1])
 
     # Создание булевого массива, где True - значения выше среднего
     above_mean = corr_by_secs[:, 1] > mean_y
 
-    bools = cp.where(above_mean)[0]
+    bools = xp.where(above_mean)[0]
     if len(bools) == 0:
         return 0, 0, False
 
@@ -34,19 +41,22 @@ def find_longest_same_fragment(corr_by_secs) -> Tuple[float, float, bool]:
     return start_secs, end_secs, is_average_bigger
 
 
-def find_offsets_by_window(audio1, audio2):
-    offsets_by_windows = correlation_with_async_moving_window(audio1, audio2)
-    best_offset1, best_offset2, max_corr = offsets_by_windows[cp.argmax(offsets_by_windows[:, 2])]
+def find_offsets_by_window(audio1, audio2, cache: FeatureCache | None = None, prior: SearchPrior | None = None):
+    with instrumentation.stage('async_window', pairs=1, bytes=audio1.nbytes + audio2.nbytes):
+        offsets_by_windows = correlate_with_prior(audio1, audio2, prior, cache)
+    best_offset1, best_offset2, max_corr = offsets_by_windows[xp.argmax(offsets_by_windows[:, 2])]
 
-    truncated_audio1, truncated_audio2, offset1_secs, offset2_secs = \
-        normalize_fragments(best_offset1, best_offset2, audio1, audio2)
+    with instrumentation.stage('normalize_fragments', pairs=1):
+        truncated_audio1, truncated_audio2, offset1_secs, offset2_secs = \
+            normalize_fragments(best_offset1, best_offset2, audio1, audio2)
 
-    corr_by_secs = correlation_with_sync_moving_window(truncated_audio1, truncated_audio2)
-    print(corr_by_secs.get())
+    with instrumentation.stage('sync_window', pairs=1, bytes=truncated_audio1.nbytes + truncated_audio2.nbytes):
+        corr_by_secs = correlation_with_sync_moving_window(truncated_audio1, truncated_audio2)
+    print(asnumpy(corr_by_secs))
 
     start_secs, end_secs, is_correlate = find_longest_same_fragment(corr_by_secs)
     if not is_correlate:
-        return cp.array([0, 0, 0, 0])
+        return xp.array([0, 0, 0, 0])
 
     file1_start_secs = offset1_secs + start_secs
     file1_end_secs = offset1_secs + end_secs
@@ -57,75 +67,158 @@ def find_offsets_by_window(audio1, audio2):
     return [file1_start_secs, file1_end_secs, file2_start_secs, file2_end_secs]
 
 
-@cp.fuse()
-def load_to_gpu_if_needed(filename, audio, registry):
-    if filename in registry:
+@fuse()
+def load_to_gpu_if_needed(file: LazyAudio, registry):
+    if file.filename in registry:
         return
-    registry[filename] = cp.asarray(audio, dtype=cp.float32)
-    registry[filename] = registry[filename] / cp.max(cp.abs(registry[filename]))
-    registry[filename] = registry[filename] - cp.mean(registry[filename])
+    registry[file.filename] = xp.asarray(file.load(), dtype=xp.float32)
+    registry[file.filename] = registry[file.filename] / xp.max(xp.abs(registry[file.filename]))
+    registry[file.filename] = registry[file.filename] - xp.mean(registry[file.filename])
+
+
+def generate_pairs(files: list[LazyAudio],
+                   skip_pairs: set[tuple[str, str]] = frozenset(),
+                   scheduler: PairScheduler | None = None):
+    """
+    Выдает пары эпизодов в пределах окна SERIES_WINDOW, кроме skip_pairs,
+    или в порядке адаптивного планировщика scheduler (см. services.pair_scheduler).
+    Аудио загружается только при входе эпизода в окно и освобождается, как только эпизод из него выходит,
+    поэтому в памяти одновременно находится не больше SERIES_WINDOW (scheduler.window) эпизодов.
+    Эпизод, все пары которого пропускаются, не загружается вовсе.
+    """
+    files_tmp = sorted(files, key=lambda x: int(x.filename.split('.')[0]))
+    positions = {file.filename: i for i, file in enumerate(files_tmp)}
+    pairs = scheduler.iter_pairs() if scheduler is not None else get_window_pairs(files_tmp)
+    window = scheduler.window if scheduler is not None else SERIES_WINDOW
+
+    gpu_audios = {}
 
+    for filename1, filename2 in pairs:
+        if (filename1, filename2) in skip_pairs:
+            continue
 
-def generate_pairs(files):
-    files_tmp = files.copy()
-    files_tmp.sort(key=lambda x: int(x[0].split('.')[0]))
+        # Пары идут по возрастанию первого эпизода (в адаптивном режиме - внутри круга),
+        # поэтому эпизоды вне окна [i, i + window) до следующего круга не понадобятся
+        i = positions[filename1]
+        for filename in [filename for filename in gpu_audios if not i <= positions[filename] < i + window]:
+            del gpu_audios[filename]
+
+        load_to_gpu_if_needed(files_tmp[i], gpu_audios)
+        load_to_gpu_if_needed(files_tmp[positions[filename2]], gpu_audios)
+        yield (filename1, gpu_audios[filename1]), (filename2, gpu_audios[filename2])
 
-    gpu_audios = {}
 
-    for i in range(len(files_tmp) - 1):
-        filename1, audio1 = files_tmp[i]
-        load_to_gpu_if_needed(filename1, audio1, gpu_audios)
+_opening_library: OpeningLibrary | None = None
 
-        for j in range(i + 1, min(len(files_tmp), i + SERIES_WINDOW)):
-            load_to_gpu_if_needed(files_tmp[j][0], files_tmp[j][1], gpu_audios)
-            yield (filename1, gpu_audios[filename1]), (files_tmp[j][0], gpu_audios[files_tmp[j][0]])
 
-        del gpu_audios[filename1]
+def get_opening_library() -> OpeningLibrary | None:
+    global _opening_library
+    if _opening_library is None and OPENING_LIBRARY_PATH:
+        _opening_library = OpeningLibrary(OPENING_LIBRARY_PATH)
+    return _opening_library
 
 
-def find_all_offsets(files):
-    offsets_by_audio: dict[str, list[tuple[float, float]]] = {file: [] for file, _ in files}
+def find_all_offsets(files,
+                     skip_pairs: set[tuple[str, str]] = frozenset(),
+                     prior: SearchPrior | None = None,
+                     scheduler: PairScheduler | None = None):
+    """
+    :return: словарь (file1, file2) -> (file1_start_secs, file1_end_secs, file2_start_secs, file2_end_secs)
+      для всех посчитанных пар
+    """
+    offsets_by_pair: dict[tuple[str, str], list[float]] = {}
+    cache = FeatureCache()
 
-    for pair1, pair2 in generate_pairs(files):
+    for pair1, pair2 in generate_pairs(files, skip_pairs, scheduler):
         file1, audio1 = pair1
         file2, audio2 = pair2
         if (file1, file2) not in [('11.wav', '12.wav')]:
             continue
 
         file1_start_secs, file1_end_secs, file2_start_secs, file2_end_secs = \
-            find_offsets_by_window(audio1, audio2)
+            find_offsets_by_window(audio1, audio2, cache, prior)
 
-        offsets_by_audio[file1].append((file1_start_secs.get(), file1_end_secs.get()))
-        offsets_by_audio[file2].append((file2_start_secs.get(), file2_end_secs.get()))
+        offsets_by_pair[(file1, file2)] = [float(asnumpy(offset)) for offset in
+                                           (file1_start_secs, file1_end_secs, file2_start_secs, file2_end_secs)]
+        if scheduler is not None:
+            scheduler.add((file1, file2), get_pair_opening(offsets_by_pair[(file1, file2)]))
 
         print(f'{file1},{file2},'
               f'{file1_start_secs:.3f},{file1_end_secs:.3f},'
               f'{file2_start_secs:.3f},{file2_end_secs:.3f},'
               f'{file1_end_secs - file1_start_secs:.3f}')
 
-    return offsets_by_audio
+    return offsets_by_pair
+
+
+def get_pair_opening(offsets: list[float]) -> tuple[float, float, float, float] | None:
+    # Нулевые смещения означают, что опенинг в паре не найден
+    return tuple(offsets) if offsets[1] != 0 else None
+
+
+LEDGERS_DIR = r'D:\AOR\artifacts\ledgers\offsets'
+OFFSETS_DIR = r'D:\AOR\artifacts\offsets'
+
+_search_priors: SearchPriors | None = None
+
+
+def get_search_priors() -> SearchPriors:
+    # Опенинги прошлых запусков, по которым сужается поиск; читаются один раз на процесс
+    global _search_priors
+    if _search_priors is None:
+        _search_priors = SearchPriors(read_offsets_dir(OFFSETS_DIR) if SEARCH_PRIOR_MODE != 'off' else {})
+    return _search_priors
 
 
 def analyze_season(series_id):
     print(rf'Loading files for season {series_id}...')
     t = time.time()
-    files = load_folder(rf'D:\AOR\artifacts\audio\{series_id}')
+    files = load_folder_lazy(rf'D:\AOR\artifacts\audio\{series_id}')
+
+    library_offsets = find_offsets_by_library(files, get_opening_library())
+    pair_files = [file for file in files if file.filename not in library_offsets]
+
+    # Пары, посчитанные в прошлых запусках по тем же файлам, берутся из журнала
+    ledger = PairLedger(get_ledger_path(LEDGERS_DIR, series_id))
+    unchanged_pairs = ledger.get_unchanged_pairs(pair_files)
+    offsets_by_pair = {pair: ledger.pairs[pair] for pair in unchanged_pairs}
+
+    scheduler = None
+    if PAIR_SCHEDULER_ENABLED:
+        scheduler = PairScheduler([file.filename for file in pair_files])
+        for pair, offsets in offsets_by_pair.items():
+            scheduler.add(pair, get_pair_opening(offsets))
 
-    all_offsets_by_audio = find_all_offsets(files)
-    filtered_offsets = find_true_offsets(all_offsets_by_audio)
+    offsets_by_pair.update(find_all_offsets(pair_files, unchanged_pairs, get_search_priors().get(series_id),
+                                            scheduler))
+    print(f'Reused {len(unchanged_pairs)} pairs, correlated {len(offsets_by_pair) - len(unchanged_pairs)} pairs')
 
-    csv_content = 'File,Start,End,Length\n'
+    # Опенинги из библиотеки - отдельные наблюдения эпизодов, не связанные парами
+    filtered_offsets, confidence = solve_true_offsets(
+        offsets_by_pair, {file: [offsets] for file, offsets in library_offsets.items()})
+
+    # В CSV - номер эпизода без расширения файла (.npy после s2_extract_audio.py, .wav раньше)
+    csv_content = 'File,Start,End,Length,Confidence\n'
     for file, (start, end) in filtered_offsets.items():
-        print(f'{file},{start:.3f},{end:.3f},{end - start:.3f}')
-        csv_content += f'{file},{start:.3f},{end:.3f},{end - start:.3f}\n'
+        episode = os.path.splitext(file)[0]
+        print(f'{episode},{start:.3f},{end:.3f},{end - start:.3f},{confidence[file]:.2f}')
+        csv_content += f'{episode},{start:.3f},{end:.3f},{end - start:.3f},{confidence[file]:.2f}\n'
 
-    with open(fr'D:\AOR\artifacts\offsets\{series_id}.csv', 'w') as f:
-        f.write(csv_content)
+    with instrumentation.stage('save', series_id=series_id, bytes=len(csv_content)):
+        with open(fr'D:\AOR\artifacts\offsets\{series_id}.csv', 'w') as f:
+            f.write(csv_content)
+    ledger.record(files, offsets_by_pair)
+    instrumentation.flush()
 
     print(time.time() - t)
 
 
-def main():
+def is_series_up_to_date(series_id: int) -> bool:
+    ledger = PairLedger(get_ledger_path(LEDGERS_DIR, series_id))
+    return ledger.exists() and ledger.is_up_to_date(load_folder_lazy(rf'D:\AOR\artifacts\audio\{series_id}'))
+
+
+def main(workers: int = POOL_WORKERS):
     all_series_folders = os.listdir(r'D:\AOR\artifacts\audio')
     all_series_ids = [int(folder)
                       for folder in all_series_folders
@@ -135,11 +228,20 @@ def main():
     processed_series = [int(file.split('.')[0])
                         for file in os.listdir(r'D:\AOR\artifacts\offsets')]
 
+    # Обработанный сериал пересчитывается, если у него появились новые или изменились старые эпизоды.
+    # В CSV сериалов, обработанных до появления журнала, нет результатов пар, поэтому они пересчитываются целиком
     series_to_process = [series_id
                          for series_id in all_series_ids
-                         if series_id not in processed_series]
-    for series_id in series_to_process:
-        analyze_season(series_id)
+                         if series_id not in processed_series or not is_series_up_to_date(series_id)]
+    if workers <= 1:
+        for series_id in series_to_process:
+            analyze_season(series_id)
+        return
+
+    claims_dir = r'D:\AOR\artifacts\claims\offsets'
+    series_to_process = sorted(set(series_to_process) | set(get_interrupted_series(claims_dir)))
+    reset_done_series(claims_dir, series_to_process)
+    run_series_pool(series_to_process, analyze_season, claims_dir, workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+# Извлекает аудио из последних TRUNCATE_SECS секунд каждого видео в float32-массивы .npy.
+# Заменяет s2_extract_audio.ps1: ffmpeg декодирует прямо в pipe, без промежуточного WAV,
+# несколько ffmpeg запускаются параллельно, результаты пишутся в audio/extraction.jsonl.
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from config import TRUNCATE_SECS, EXTRACT_RATE, EXTRACT_WORKERS
+from services.audio_loader import NPY_META_EXTENSION, save_npy_audio, write_npy_rate
+
+ARTIFACTS_PATH = r'D:\AOR\artifacts'
+# Допустимая нехватка длительности извлеченного аудио, в секундах
+MIN_DURATION_TOLERANCE_SECS = 10
+
+
+def probe_duration(video_path: str) -> float | None:
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json',
+                                 video_path],
+                                capture_output=True)
+    except FileNotFoundError:
+        return None
+
+    if result.returncode != 0:
+        return None
+
+    duration = json.loads(result.stdout).get('format', {}).get('duration')
+    return float(duration) if duration is not None else None
+
+
+def decode_tail(video_path: str,
+                truncate_secs: int = TRUNCATE_SECS,
+                rate: int = EXTRACT_RATE,
+                threads: int = 1) -> tuple[np.ndarray, str]:
+    """
+    Декодирует последние truncate_secs секунд видео в моно float32 с частотой rate.
+    :return: (audio, stderr) - аудио и вывод ffmpeg; при ошибке (ненулевой код возврата
+      или поток не из целых float32-отсчетов) audio пустой
+    """
+    result = subprocess.run(['ffmpeg', '-v', 'error', '-nostdin',
+                             '-sseof', f'-{truncate_secs}', '-i', video_path,
+                             '-threads', str(threads), '-vn', '-ac', '1', '-ar', str(rate),
+                             '-f', 'f32le', '-'],
+                            capture_output=True)
+    stderr = result.stderr.decode('utf-8', errors='replace')
+    if result.returncode != 0 or len(result.stdout) % np.dtype('<f4').itemsize != 0:
+        return np.zeros(0, dtype=np.float32), stderr
+
+    return np.frombuffer(result.stdout, dtype='<f4'), stderr
+
+
+def extract_episode(series_id: int, video_path: str, audio_dir: str) -> dict:
+    episode = os.path.splitext(os.path.basename(video_path))[0]
+    record = {'series_id': series_id, 'episode': episode, 'video': video_path,
+              'rate': EXTRACT_RATE, 'duration_secs': None, 'samples': 0, 'status': 'ok', 'error': None,
+              'warnings': None}
+
+    t0 = time.time()
+    record['duration_secs'] = probe_duration(video_path)
+    audio, stderr = decode_tail(video_path, TRUNCATE_SECS, EXTRACT_RATE)
+    record['samples'] = int(audio.shape[0])
+    record['elapsed_secs'] = round(time.time() - t0, 3)
+
+    # Некритичные сообщения ffmpeg (например, о битых кадрах) не делают извлечение неудачным
+    if audio.shape[0] == 0:
+        record['status'] = 'error'
+        record['error'] = stderr.strip()
+        return record
+    record['warnings'] = stderr.strip() or None
+
+    if audio.shape[0] < (TRUNCATE_SECS - MIN_DURATION_TOLERANCE_SECS) * EXTRACT_RATE:
+        record['status'] = 'too_short'
+        return record
+
+    save_npy_audio(os.path.join(audio_dir, f'{episode}.npy'), audio, EXTRACT_RATE)
+    return record
+
+
+def extract_series(series_id: int, executor: ThreadPoolExecutor, log_file):
+    video_dir = os.path.join(ARTIFACTS_PATH, 'video', str(series_id))
+    # Каталог переименовывается только после обработки всех эпизодов, поэтому незавершенные сериалы
+    # не попадают в корреляцию и при перезапуске обрабатываются заново
+    tmp_audio_dir = os.path.join(ARTIFACTS_PATH, 'audio', f'_{series_id}')
+    os.makedirs(tmp_audio_dir, exist_ok=True)
+
+    videos = [os.path.join(video_dir, file) for file in os.listdir(video_dir) if file.endswith('.mp4')]
+    futures = [executor.submit(extract_episode, series_id, video, tmp_audio_dir) for video in videos]
+    for future in as_completed(futures):
+        record = future.result()
+        print(f'{record["video"]}: {record["status"]} ({record["elapsed_secs"]}s)')
+        log_file.write(json.dumps(record) + '\n')
+        log_file.flush()
+
+    os.rename(tmp_audio_dir, os.path.join(ARTIFACTS_PATH, 'audio', str(series_id)))
+
+
+def write_missing_rates(audio_root: str):
+    """
+    Записывает частоту массивов, извлеченных до появления файлов частоты, по журналу extraction.jsonl.
+    """
+    log_path = os.path.join(audio_root, 'extraction.jsonl')
+    if not os.path.exists(log_path):
+        return
+
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            path = os.path.join(audio_root, str(record['series_id']), f'{record["episode"]}.npy')
+            if record['status'] == 'ok' and os.path.exists(path) and not os.path.exists(f'{path}{NPY_META_EXTENSION}'):
+                write_npy_rate(path, record['rate'])
+
+
+def main(workers: int = EXTRACT_WORKERS):
+    audio_root = os.path.join(ARTIFACTS_PATH, 'audio')
+    os.makedirs(audio_root, exist_ok=True)
+
+    write_missing_rates(audio_root)
+
+    processed = set(os.listdir(audio_root))
+    series_ids = sorted((int(folder)
+                         for folder in os.listdir(os.path.join(ARTIFACTS_PATH, 'video'))
+                         if folder.isdigit() and folder not in processed),
+                        reverse=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            open(os.path.join(audio_root, 'extraction.jsonl'), 'a', encoding='utf-8') as log_file:
+        for series_id in series_ids:
+            print(f'Processing series {series_id}')
+            extract_series(series_id, executor, log_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+# Конвертирует корреляции старого формата (CSV на каждую пару) в бинарные файлы сериалов.
+import os
+
+from services.correlation_store import convert_directory, convert_zip, get_series_path
+
+CORRELATIONS_PATH = r'D:\AOR\artifacts\correlations'
+ARCHIVE_PATH = r'D:\AOR\artifacts\correlations.zip'
+
+
+def main():
+    if os.path.exists(ARCHIVE_PATH):
+        print(f'Converting {ARCHIVE_PATH}...')
+        convert_zip(ARCHIVE_PATH, CORRELATIONS_PATH)
+
+    for folder in os.listdir(CORRELATIONS_PATH):
+        corr_dir = os.path.join(CORRELATIONS_PATH, folder)
+        if not folder.isdigit() or not os.path.isdir(corr_dir):
+            continue
+        print(f'Converting {corr_dir}...')
+        convert_directory(corr_dir, get_series_path(CORRELATIONS_PATH, int(folder)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,91 +2,252 @@
 import os
 import time
 
-import cupy as cp
+import numpy as np
 
-from config import RATE, SERIES_WINDOW
-from services.audio_loader import load_folder
-from services.correlator import correlation_with_async_moving_window, correlation_with_sync_moving_window
+from config import (RATE, SERIES_WINDOW, POOL_WORKERS, PAIR_BATCH_MEMORY_BYTES, SEARCH_PRIOR_MODE,
+                    PAIR_SCHEDULER_ENABLED, OPENING_LIBRARY_PATH)
+from services.backend import xp, fuse, asnumpy
+from services.audio_loader import LazyAudio, load_folder_lazy
+from services.correlation_store import read_series, write_series, get_series_path
+from services.correlator import correlation_with_sync_moving_window_batch, estimate_pair_memory_bytes
+from services.feature_cache import FeatureCache
+from services import instrumentation
 from services.fragments_normalizer import normalize_fragments
+from services.opening_library import OpeningLibrary, find_offsets_by_library
+from services.segment_detector import find_pair_openings
+from services.pair_ledger import PairLedger, get_ledger_path, get_window_pairs
+from services.pair_scheduler import PairScheduler
+from services.search_prior import SearchPrior, SearchPriors, correlate_with_prior_batch, read_offsets_csv
+from services.series_pool import run_series_pool, get_interrupted_series, reset_done_series
 
 
-@cp.fuse()
-def load_to_gpu_if_needed(filename, audio, registry):
-    if filename in registry:
+@fuse()
+def load_to_gpu_if_needed(file: LazyAudio, registry):
+    if file.filename in registry:
         return
-    registry[filename] = cp.asarray(audio, dtype=cp.float32)
-    registry[filename] = registry[filename] - cp.mean(registry[filename])
-    registry[filename] = registry[filename] / cp.max(cp.abs(registry[filename]))
+    registry[file.filename] = xp.asarray(file.load(), dtype=xp.float32)
+    registry[file.filename] = registry[file.filename] - xp.mean(registry[file.filename])
+    registry[file.filename] = registry[file.filename] / xp.max(xp.abs(registry[file.filename]))
 
 
-def generate_pairs(files):
-    files_tmp = files.copy()
-    files_tmp.sort(key=lambda x: int(x[0].split('.')[0]))
+def generate_pairs(files: list[LazyAudio],
+                   skip_pairs: set[tuple[str, str]] = frozenset(),
+                   scheduler: PairScheduler | None = None):
+    """
+    Выдает пары эпизодов в пределах окна SERIES_WINDOW, кроме skip_pairs,
+    или в порядке адаптивного планировщика scheduler (см. services.pair_scheduler).
+    Аудио загружается только при входе эпизода в окно и освобождается, как только эпизод из него выходит,
+    поэтому в памяти одновременно находится не больше SERIES_WINDOW (scheduler.window) эпизодов.
+    Эпизод, все пары которого пропускаются, не загружается вовсе.
+    """
+    files_tmp = sorted(files, key=lambda x: int(x.filename.split('.')[0]))
+    positions = {file.filename: i for i, file in enumerate(files_tmp)}
+    pairs = scheduler.iter_pairs() if scheduler is not None else get_window_pairs(files_tmp)
+    window = scheduler.window if scheduler is not None else SERIES_WINDOW
 
     gpu_audios = {}
 
-    for i in range(len(files_tmp) - 1):
-        filename1, audio1 = files_tmp[i]
-        load_to_gpu_if_needed(filename1, audio1, gpu_audios)
+    for filename1, filename2 in pairs:
+        if (filename1, filename2) in skip_pairs:
+            continue
+
+        # Пары идут по возрастанию первого эпизода (в адаптивном режиме - внутри круга),
+        # поэтому эпизоды вне окна [i, i + window) до следующего круга не понадобятся
+        i = positions[filename1]
+        for filename in [filename for filename in gpu_audios if not i <= positions[filename] < i + window]:
+            del gpu_audios[filename]
+
+        load_to_gpu_if_needed(files_tmp[i], gpu_audios)
+        load_to_gpu_if_needed(files_tmp[positions[filename2]], gpu_audios)
+        yield (filename1, gpu_audios[filename1]), (filename2, gpu_audios[filename2])
+
 
-        for j in range(i + 1, min(len(files_tmp), i + SERIES_WINDOW)):
-            load_to_gpu_if_needed(files_tmp[j][0], files_tmp[j][1], gpu_audios)
-            yield ((filename1, gpu_audios[filename1]),
-                   (files_tmp[j][0], gpu_audios[files_tmp[j][0]]))
+def generate_pair_batches(files: list[LazyAudio],
+                          memory_budget: int = PAIR_BATCH_MEMORY_BYTES,
+                          skip_pairs: set[tuple[str, str]] = frozenset(),
+                          scheduler: PairScheduler | None = None):
+    """
+    Собирает пары из generate_pairs в батчи, оценочный объем памяти которых не превышает memory_budget.
+    Пара, которая одна не помещается в бюджет, образует отдельный батч.
+    С планировщиком пары выбираются по результатам уже посчитанных батчей, а батч не выходит за круг планировщика:
+    пары следующего круга выбираются только после того, как результаты предыдущего переданы в scheduler.add.
+    """
+    batch = []
+    batch_bytes = 0
+    batch_round = None
+    for pair1, pair2 in generate_pairs(files, skip_pairs, scheduler):
+        pair_round = scheduler.get_round((pair1[0], pair2[0])) if scheduler is not None else None
+        if batch and pair_round != batch_round:
+            yield batch
+            batch = []
+            batch_bytes = 0
+            # Первая пара круга выбрана до результатов отданного батча - проверяем ее заново
+            if not scheduler.is_needed((pair1[0], pair2[0])):
+                continue
 
-        del gpu_audios[filename1]
+        pair_bytes = estimate_pair_memory_bytes(pair1[1].shape[0], pair2[1].shape[0])
+        if batch and batch_bytes + pair_bytes > memory_budget:
+            yield batch
+            batch = []
+            batch_bytes = 0
 
+        batch.append((pair1, pair2))
+        batch_bytes += pair_bytes
+        batch_round = pair_round
 
-def analyze_files(files):
+    if batch:
+        yield batch
+
+
+def analyze_files(files,
+                  skip_pairs: set[tuple[str, str]] = frozenset(),
+                  prior: SearchPrior | None = None,
+                  scheduler: PairScheduler | None = None):
     results = []
-    for pair1, pair2 in generate_pairs(files):
-        file1, audio1 = pair1
-        file2, audio2 = pair2
-        print(f'Correlating {file1} and {file2}...')
-        # if (file1, file2) not in [('14.wav', '15.wav')]:
-        #     continue
-        if audio1.shape[0] < 30 * RATE or audio2.shape[0] < 30 * RATE:
-            print(f'One of the audios is shorter than 30 seconds: {file1}, {file2}. Skipping.')
+    full_scan_pairs = 0
+    cache = FeatureCache()
+    for batch in generate_pair_batches(files, skip_pairs=skip_pairs, scheduler=scheduler):
+        pairs = []
+        for pair1, pair2 in batch:
+            file1, audio1 = pair1
+            file2, audio2 = pair2
+            print(f'Correlating {file1} and {file2}...')
+            # if (file1, file2) not in [('14.wav', '15.wav')]:
+            #     continue
+            if audio1.shape[0] < 30 * RATE or audio2.shape[0] < 30 * RATE:
+                print(f'One of the audios is shorter than 30 seconds: {file1}, {file2}. Skipping.')
+                if scheduler is not None:
+                    scheduler.add((file1, file2), None)
+                continue
+            pairs.append((file1, file2, audio1, audio2))
+
+        if not pairs:
             continue
 
-        offsets_by_windows = correlation_with_async_moving_window(audio1, audio2)
-        best_offset1, best_offset2, max_corr = offsets_by_windows[cp.argmax(offsets_by_windows[:, 2])]
+        with instrumentation.stage('async_window', pairs=len(pairs),
+                                   bytes=sum(audio1.nbytes + audio2.nbytes for *_, audio1, audio2 in pairs)):
+            offsets_by_windows_batch, batch_full_scan_pairs = correlate_with_prior_batch(
+                [(audio1, audio2) for _, _, audio1, audio2 in pairs], prior, cache)
+        full_scan_pairs += batch_full_scan_pairs
 
-        truncated_audio1, truncated_audio2, offset1_secs, offset2_secs = \
-            normalize_fragments(best_offset1, best_offset2, audio1, audio2)
-        if (truncated_audio1.shape[0] == 0
-                or truncated_audio2.shape[0] == 0
-                or truncated_audio1.shape[0] != truncated_audio2.shape[0]):
-            print(f'One of the audios is shorter than the other: {file1}, {file2}. Skipping.')
+        truncated_pairs = []
+        for (file1, file2, audio1, audio2), offsets_by_windows in zip(pairs, offsets_by_windows_batch):
+            best_offset1, best_offset2, max_corr = offsets_by_windows[xp.argmax(offsets_by_windows[:, 2])]
+
+            with instrumentation.stage('normalize_fragments', pairs=1):
+                truncated_audio1, truncated_audio2, offset1_secs, offset2_secs = \
+                    normalize_fragments(best_offset1, best_offset2, audio1, audio2)
+            if (truncated_audio1.shape[0] == 0
+                    or truncated_audio2.shape[0] == 0
+                    or truncated_audio1.shape[0] != truncated_audio2.shape[0]):
+                print(f'One of the audios is shorter than the other: {file1}, {file2}. Skipping.')
+                if scheduler is not None:
+                    scheduler.add((file1, file2), None)
+                continue
+            truncated_pairs.append((file1, file2, offset1_secs, offset2_secs, truncated_audio1, truncated_audio2))
+
+        if not truncated_pairs:
             continue
 
-        corr_by_beats = correlation_with_sync_moving_window(truncated_audio1, truncated_audio2)
+        with instrumentation.stage('sync_window', pairs=len(truncated_pairs),
+                                   bytes=sum(audio1.nbytes + audio2.nbytes for *_, audio1, audio2 in truncated_pairs)):
+            corr_by_beats_batch = correlation_with_sync_moving_window_batch(
+                [(truncated_audio1, truncated_audio2) for *_, truncated_audio1, truncated_audio2 in truncated_pairs])
 
-        results.append((file1, file2, offset1_secs, offset2_secs, corr_by_beats.get()))
+        batch_results = [(file1, file2, float(offset1_secs), float(offset2_secs), asnumpy(corr_by_beats))
+                         for (file1, file2, offset1_secs, offset2_secs, _, _), corr_by_beats
+                         in zip(truncated_pairs, corr_by_beats_batch)]
+        results += batch_results
+        if scheduler is not None:
+            for (file1, file2, *_), opening in zip(batch_results, find_pair_openings(batch_results)):
+                scheduler.add((file1, file2), opening)
 
+    if prior is not None:
+        print(f'Searched within {prior}, {full_scan_pairs} pairs fell back to the full search')
     return results
 
 
+LEDGERS_DIR = r'D:\AOR\artifacts\ledgers\correlations'
+# Результат s4_offsets_calculator.py - опенинги прошлых запусков, по которым сужается поиск
+OFFSETS_PATH = r'D:\AOR\artifacts\offsets.csv'
+
+_search_priors: SearchPriors | None = None
+
+
+def get_search_priors() -> SearchPriors:
+    global _search_priors
+    if _search_priors is None:
+        _search_priors = SearchPriors(read_offsets_csv(OFFSETS_PATH) if SEARCH_PRIOR_MODE != 'off' else {})
+    return _search_priors
+
+
+_opening_library: OpeningLibrary | None = None
+
+
+def get_opening_library() -> OpeningLibrary | None:
+    global _opening_library
+    if _opening_library is None and OPENING_LIBRARY_PATH:
+        _opening_library = OpeningLibrary(OPENING_LIBRARY_PATH)
+    return _opening_library
+
+
 def analyze_season(series_id):
     print(rf'Loading files for season {series_id}...')
     t = time.time()
 
-    files = load_folder(rf'D:\AOR\artifacts\audio\{series_id}')
-    correlations = analyze_files(files)
-    del files
+    files = load_folder_lazy(rf'D:\AOR\artifacts\audio\{series_id}')
+    store_dir = r'D:\AOR\artifacts\correlations'
+    series_path = get_series_path(store_dir, series_id)
+
+    ledger = PairLedger(get_ledger_path(LEDGERS_DIR, series_id))
+    previous = read_series(series_path) if os.path.exists(series_path) else []
+    if not ledger.exists() and previous:
+        # Корреляции, посчитанные до появления журнала, считаются посчитанными по текущим файлам
+        ledger.record(files, [(file1, file2) for file1, file2, *_ in previous])
+
+    # Эпизоды с опенингом из библиотеки не коррелируются попарно; их опенинги сохраняются вместе с кривыми
+    library_offsets = find_offsets_by_library(files, get_opening_library())
+    pair_files = [file for file in files if file.filename not in library_offsets]
+
+    # Кривые копируются из отображенного в память файла, который будет перезаписан
+    unchanged_pairs = ledger.get_unchanged_pairs(pair_files)
+    kept = [(file1, file2, offset1, offset2, np.array(corr))
+            for file1, file2, offset1, offset2, corr in previous
+            if (file1, file2) in unchanged_pairs]
+    del previous
+
+    scheduler = None
+    if PAIR_SCHEDULER_ENABLED:
+        # Оценки опенингов по переиспользуемым кривым сразу учитываются планировщиком
+        scheduler = PairScheduler([file.filename for file in pair_files])
+        for pair in unchanged_pairs:
+            scheduler.add(pair, None)
+        for (file1, file2, *_), opening in zip(kept, find_pair_openings(kept)):
+            scheduler.add((file1, file2), opening)
+
+    correlations = analyze_files(pair_files, unchanged_pairs, get_search_priors().get(series_id), scheduler)
+    print(f'Reused {len(kept)} pairs, correlated {len(correlations)} pairs, '
+          f'{len(library_offsets)} episodes matched by library')
 
     print('Saving results...')
-    corr_dir = rf'D:\AOR\artifacts\correlations\{series_id}'
-    os.makedirs(corr_dir, exist_ok=True)
-    for file1, file2, offset1, offset2, corr in correlations:
-        filename = f'{file1}_{file2}_{int(offset1 * 1000)}_{int(offset2 * 1000)}.csv'
-        filepath = os.path.join(corr_dir, filename)
-        cp.savetxt(filepath, corr, delimiter=',', fmt='%1.3e')
+    os.makedirs(store_dir, exist_ok=True)
+    with instrumentation.stage('save', pairs=len(kept) + len(correlations), series_id=series_id) as stage:
+        write_series(series_path, kept + correlations, library_offsets)
+        stage.add(bytes=os.path.getsize(series_path))
+    # Планировщик мог пропустить часть пар окна: в журнал попадают только рассмотренные,
+    # чтобы остальные посчитались, если они понадобятся (или при выключении планировщика)
+    ledger.record(files, scheduler.tried if scheduler is not None else get_window_pairs(pair_files))
+    instrumentation.flush()
 
     print(time.time() - t)
 
 
-def main():
+def is_series_up_to_date(series_id: int) -> bool:
+    ledger = PairLedger(get_ledger_path(LEDGERS_DIR, series_id))
+    return ledger.exists() and ledger.is_up_to_date(load_folder_lazy(rf'D:\AOR\artifacts\audio\{series_id}'))
+
+
+def main(workers: int = POOL_WORKERS):
     all_series_folders = os.listdir(r'D:\AOR\artifacts\audio')
     all_series_ids = [int(folder)
                       for folder in all_series_folders
@@ -96,12 +257,20 @@ def main():
     processed_series = [int(file.split('.')[0])
                         for file in os.listdir(r'D:\AOR\artifacts\correlations')]
 
+    # Обработанный сериал пересчитывается, если у него появились новые или изменились старые эпизоды
     series_to_process = [series_id
                          for series_id in all_series_ids
-                         if series_id not in processed_series]
+                         if series_id not in processed_series or not is_series_up_to_date(series_id)]
+
+    if workers <= 1:
+        for series_id in series_to_process:
+            analyze_season(series_id)
+        return
 
-    for series_id in series_to_process:
-        analyze_season(series_id)
+    claims_dir = r'D:\AOR\artifacts\claims\correlations'
+    series_to_process = sorted(set(series_to_process) | set(get_interrupted_series(claims_dir)))
+    reset_done_series(claims_dir, series_to_process)
+    run_series_pool(series_to_process, analyze_season, claims_dir, workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+# Пополняет библиотеку опенингов (см. services.opening_library) опенингами, найденными кросс-корреляцией.
+# Для каждого сериала берется эпизод с длиной опенинга, ближайшей к медианной по сериалу.
+import json
+import os
+
+import numpy as np
+
+from config import OPENING_LIBRARY_PATH
+from services.AnilibriaRepository import AnilibriaRepository
+from services.opening_library import OpeningLibrary
+
+ARTIFACTS_PATH = r'D:\AOR\artifacts'
+
+
+def load_extraction_log(audio_root: str) -> dict[tuple[int, str], dict]:
+    """
+    Записи s2_extract_audio.py по эпизодам; нужны, чтобы перевести время видео во время извлеченного аудио.
+    """
+    records = {}
+    with open(os.path.join(audio_root, 'extraction.jsonl'), 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['status'] == 'ok':
+                records[(int(record['series_id']), str(record['episode']))] = record
+    return records
+
+
+def main(library_path: str = OPENING_LIBRARY_PATH or os.path.join(ARTIFACTS_PATH, 'openings')):
+    audio_root = os.path.join(ARTIFACTS_PATH, 'audio')
+    repository = AnilibriaRepository()
+    library = OpeningLibrary(library_path)
+    records = load_extraction_log(audio_root)
+    known_series = {entry['series_id'] for entry in library.entries}
+
+    for series_id, openings in repository.get_series_openings():
+        if series_id in known_series:
+            continue
+
+        lengths = [end - begin for _, begin, end in openings]
+        episode, begin, end = openings[int(np.argmin(np.abs(np.array(lengths) - np.median(lengths))))]
+        record = records.get((series_id, str(episode)))
+        audio_path = os.path.join(audio_root, str(series_id), f'{episode}.npy')
+        if record is None or record['duration_secs'] is None or not os.path.exists(audio_path):
+            print(f'No audio for {series_id}/{episode}. Skipping.')
+            continue
+
+        # Аудио - последние секунды видео, поэтому время в аудио сдвинуто на начало извлеченного фрагмента
+        audio_begin_secs = record['duration_secs'] - record['samples'] / record['rate']
+        if library.add(series_id, str(episode), np.load(audio_path),
+                       begin - audio_begin_secs, end - audio_begin_secs):
+            print(f'Added opening of {series_id}/{episode} ({begin:.1f}, {end:.1f})')
+            library.save()
+
+
+if __name__ == '__main__':
+    main()
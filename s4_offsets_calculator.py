@@ -1,35 +1,90 @@
+import multiprocessing
+import os
 import zipfile
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 
 import numpy as np
 
-from config import RATE
+from config import POOL_WORKERS
+from services import instrumentation
+from services.correlation_store import read_series, read_series_openings, get_series_path, list_series
+from services.offset_searcher import solve_true_offsets
+from services.segment_detector import find_pair_openings
 
 
-def main():
+def main(workers: int = POOL_WORKERS):
+    store_dir = r'D:\AOR\artifacts\correlations'
     archive_path = r'D:\AOR\artifacts\correlations.zip'
-    archive = zipfile.ZipFile(archive_path, 'r')
-    correlations = load_archive(archive)
-    results = []
-    i = 0
-    for series_id, data in correlations.items():
-        i += 1
-        print(f'Processing series {series_id} ({i}/{len(correlations)})')
-        offsets = find_and_group_offsets_by_series(data)
-        true_offsets = find_true_offsets(offsets)
+    tasks = list(iter_store_tasks(store_dir)) if os.path.isdir(store_dir) else list(iter_archive_tasks(archive_path))
+
+    # Сериалы обрабатываются по одному, поэтому память не зависит от размера архива.
+    # imap сохраняет порядок сериалов и отдает результаты по мере готовности.
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = pool.imap(process_series, tasks) if pool else map(process_series, tasks)
+    try:
+        with open(r'D:\AOR\artifacts\offsets.csv', 'w') as f:
+            for i, (series_id, fixed_offsets, confidence) in enumerate(results, start=1):
+                print(f'Processed series {series_id} ({i}/{len(tasks)})')
+                f.writelines(f'{series_id},{os.path.splitext(file)[0]},{offset1:.1f},{offset2:.1f},'
+                             f'{confidence[file]:.2f}\n'
+                             for file, (offset1, offset2) in fixed_offsets.items())
+                f.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def iter_store_tasks(store_dir) -> Iterator[Tuple[int, str, List[str] | None]]:
+    for series_id in list_series(store_dir):
+        yield series_id, get_series_path(store_dir, series_id), None
+
+
+def iter_archive_tasks(archive_path) -> Iterator[Tuple[int, str, List[str] | None]]:
+    """
+    Группирует файлы архива по сериалам, не читая их содержимое.
+    """
+    with zipfile.ZipFile(archive_path, 'r') as archive:
+        members_by_series = {}
+        for file in archive.namelist():
+            if not file.endswith('.csv'):
+                continue
+            _, series_id, _ = file.split('/')
+            members_by_series.setdefault(int(series_id), []).append(file)
+
+    for series_id, members in members_by_series.items():
+        yield series_id, archive_path, members
+
+
+def process_series(task: Tuple[int, str, List[str] | None]
+                   ) -> Tuple[int, Dict[str, Tuple[float, float]], Dict[str, float]]:
+    series_id, path, members = task
+    with instrumentation.stage('s4_load', series_id=series_id) as stage:
+        if members is None:
+            data = read_series(path)
+            library_offsets = read_series_openings(path)
+        else:
+            with zipfile.ZipFile(path, 'r') as archive:
+                data = load_archive(archive, members)[series_id]
+            library_offsets = {}
+        stage.add(bytes=sum(corr.nbytes for *_, corr in data), pairs=len(data))
+
+    with instrumentation.stage('s4_find_segments', pairs=len(data), series_id=series_id):
+        offsets_by_pair = find_offsets_by_pair(data)
+    with instrumentation.stage('s4_true_offsets', pairs=len(offsets_by_pair), series_id=series_id):
+        # Опенинги из библиотеки (см. s3_correlator.py) - отдельные наблюдения эпизодов, не связанные парами
+        true_offsets, confidence = solve_true_offsets(
+            offsets_by_pair, {file: [offsets] for file, offsets in library_offsets.items()})
+    with instrumentation.stage('s4_fix_offsets', series_id=series_id):
         fixed_offsets = fix_offsets(true_offsets)
-        for file, offsets in fixed_offsets.items():
-            results.append((series_id, file, offsets[0], offsets[1]))
-    csv = '\n'.join([f'{series_id},{file.replace(".wav", "")},{offset1:.1f},{offset2:.1f}'
-                     for series_id, file, offset1, offset2 in results])
-    with open(r'D:\AOR\artifacts\offsets.csv', 'w') as f:
-        f.write(csv)
+    instrumentation.flush()
+    return series_id, fixed_offsets, confidence
 
 
-def load_archive(archive) -> Dict[int, List[Tuple[str, str, float, float, np.ndarray]]]:
+def load_archive(archive, members=None) -> Dict[int, List[Tuple[str, str, float, float, np.ndarray]]]:
     results = {}
     i = 0
-    for file in archive.namelist():
+    for file in members or archive.namelist():
         if not file.endswith('.csv'):
             continue
         i += 1
@@ -45,66 +100,22 @@ def load_archive(archive) -> Dict[int, List[Tuple[str, str, float, float, np.nda
     return results
 
 
-def find_and_group_offsets_by_series(data):
-    offsets = {}
-    for file1, file2, offset1, offset2, corr in data:
-        # print(file1, file2, offset1, offset2, corr.shape)
-
-        corr_values = corr[:, 1]
-        max_limit = np.mean(corr_values) + 3 * np.std(corr_values)
-        filtered = corr_values[corr_values < max_limit]
-
-        if np.mean(filtered) < np.median(filtered) * 2:
-            # print(f'Not enough correlation: {file1}, {file2}. An opening not found. Skipping.')
-            continue
-
-        if filtered.shape[0] == 0:
-            print(f'Fragments are the same: {file1}, {file2}. An opening not found. Skipping.')
-            continue
-
-        filtered_max = np.max(filtered)
-        threshold = filtered_max / 2
-        begin_idx = np.argmax(corr_values > threshold)
-        begin_idx = begin_idx if begin_idx > 3 else 0
-
-        end_idx = begin_idx
-        bad_count = 0
-        for i in range(begin_idx, len(corr_values)):
-            if corr_values[i] > threshold:
-                end_idx = i
-            else:
-                bad_count += 1
-                if bad_count > 30:
-                    break
-
-        offset_begin = corr[begin_idx, 0] / RATE
-        offset_end = corr[end_idx, 0] / RATE
-
-        offsets.setdefault(file1, []).append((offset1 + offset_begin, offset1 + offset_end))
-        offsets.setdefault(file2, []).append((offset2 + offset_begin, offset2 + offset_end))
-
-    # for file, file_offsets in offsets.items():
-    #     print(file)
-    #     print(file_offsets)
-
-    return offsets
-
-
-def find_true_offsets(offsets_by_audio):
-    true_offsets_by_audio = {}
-    for file, offsets in offsets_by_audio.items():
-        # if file != '5.wav':
-        #     continue
-        start_offsets = [offset[0] for offset in offsets if offset[1] != 0]
-        end_offsets = [offset[1] for offset in offsets if offset[1] != 0]
-
-        start_median = np.median(start_offsets)
-        end_median = np.median(end_offsets)
+def load_store(store_dir) -> Dict[int, List[Tuple[str, str, float, float, np.ndarray]]]:
+    """
+    Загружает бинарные файлы корреляций (см. services.correlation_store).
+    Старый correlations.zip конвертируется скриптом s31_convert_correlations.py.
+    """
+    return {series_id: read_series(get_series_path(store_dir, series_id))
+            for series_id in list_series(store_dir)}
 
-        true_offsets_by_audio[file] = (start_median, end_median)
-        # print(f'{file}: {start_median:.1f}, {end_median:.1f} ({end_median - start_median:.1f}s)')
 
-    return true_offsets_by_audio
+def find_offsets_by_pair(data) -> Dict[Tuple[str, str], Tuple[float, float, float, float]]:
+    """
+    :return: (file1, file2) -> (begin1, end1, begin2, end2) для пар, в которых найден опенинг
+    """
+    return {(file1, file2): opening
+            for (file1, file2, *_), opening in zip(data, find_pair_openings(data))
+            if opening is not None}
 
 
 def fix_offsets(true_offsets):
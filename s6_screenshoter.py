@@ -1,66 +1,110 @@
-import asyncio
-import csv
 import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
 import cv2
-import zipfile
-from concurrent.futures import ThreadPoolExecutor
 
+from config import SCREENSHOT_WORKERS
+from services.AnilibriaRepository import AnilibriaRepository, make_worker_id
+from services.screenshots import get_screenshot_offsets, plan_clusters
 
-def extract_screenshots(title_id, episode, op_begin_secs, op_end_secs):
-    video_path = os.path.join(fr'D:\AOR\artifacts\video\{title_id}\{episode}.mp4')
-    offsets = [
-        op_begin_secs - 2,
-        op_begin_secs + 2,
-        op_end_secs - 2,
-        op_end_secs + 2,
-    ]
+VIDEO_PATH = r'D:\AOR\artifacts\video'
+SCREENSHOTS_PATH = r'D:\AOR\artifacts\screenshots'
+JPEG_QUALITY = 10
 
-    cap = cv2.VideoCapture(video_path)
+
+def read_frames(cap, offsets: list[float]) -> list[tuple[int, object]]:
+    """
+    Достает кадры на смещениях offsets: одна перемотка на группу (см. plan_clusters),
+    внутри группы кадры только пропускаются (grab) и декодируются в изображение (retrieve) лишь на нужных смещениях.
+    :return: список (timecode_ms, frame) - фактическое время кадра и сам кадр
+    """
     frames = []
+    for cluster in plan_clusters(offsets):
+        cap.set(cv2.CAP_PROP_POS_MSEC, cluster[0] * 1000)
+        for offset in cluster:
+            # После grab позиция равна времени захваченного кадра; кадры до offset только пропускаются
+            is_grabbed = cap.grab()
+            while is_grabbed and cap.get(cv2.CAP_PROP_POS_MSEC) < offset * 1000:
+                is_grabbed = cap.grab()
+            if not is_grabbed:
+                break
 
-    for offset in offsets:
-        cap.set(cv2.CAP_PROP_POS_MSEC, offset * 1000)
-        success, frame = cap.read()
-        if success:
-            _, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 10])
-            frames.append(buffer.tobytes())
+            success, frame = cap.retrieve()
+            if success:
+                frames.append((int(round(cap.get(cv2.CAP_PROP_POS_MSEC))), frame))
+    return frames
 
-    for i, frame in enumerate(frames):
-        with open(os.path.join(fr'D:\AOR\artifacts\screenshots\{title_id}\{episode}_{i}.png'), 'wb') as f:
-            f.write(frame)
-    print(f'Extracted screenshots for {title_id}, {episode}')
 
-    cap.release()
-    return frames
+def extract_screenshots(series_id: int, episode: int, op_begin_secs: float, op_end_secs: float) -> set[int]:
+    """
+    Сохраняет скриншоты начала и конца опенинга эпизода в JPEG.
+    Выполняется в процессе пула; кадры не возвращаются в основной процесс, только их время.
+    :return: время сохраненных кадров, в миллисекундах
+    """
+    video_path = os.path.join(VIDEO_PATH, str(series_id), f'{episode}.mp4')
+    screenshots_dir = os.path.join(SCREENSHOTS_PATH, str(series_id))
+    os.makedirs(screenshots_dir, exist_ok=True)
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise FileNotFoundError(f'Cannot open video {video_path}')
+
+    try:
+        frames = read_frames(cap, get_screenshot_offsets(op_begin_secs, op_end_secs))
+    finally:
+        cap.release()
+
+    for i, (_, frame) in enumerate(frames):
+        _, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+        with open(os.path.join(screenshots_dir, f'{episode}_{i}.jpg'), 'wb') as f:
+            f.write(buffer.tobytes())
+
+    return {timecode for timecode, _ in frames}
+
 
+def main(workers: int = SCREENSHOT_WORKERS):
+    """
+    Захватывает эпизоды для финализации и извлекает скриншоты в пуле процессов.
+    В работе одновременно не больше 2 * workers эпизодов, поэтому декодированные кадры не копятся в памяти.
+    """
+    repository = AnilibriaRepository()
+    worker_id = make_worker_id()
+    max_in_flight = 2 * workers
+    processed = 0
 
-async def process_row(executor, row):
-    title_id, title_name, episode, status, op_begin_secs, op_end_secs = row
-    op_begin_secs = float(op_begin_secs)
-    op_end_secs = float(op_end_secs)
-    os.makedirs(os.path.join(fr'D:\AOR\artifacts\screenshots\{title_id}'), exist_ok=True)
-    frames = await asyncio.get_event_loop().run_in_executor(
-        executor, extract_screenshots, title_id, episode, op_begin_secs, op_end_secs
-    )
-    return title_id, episode, frames
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        while True:
+            claimed = repository.claim_episodes_to_finalize(worker_id, max_in_flight - len(in_flight))
+            for series_id, episode, op_begin_secs, op_end_secs in claimed:
+                if op_begin_secs is None or op_end_secs is None:
+                    print(f'No opening for {series_id}, {episode}')
+                    repository.set_episode_finalizing_error(series_id, episode)
+                    continue
+                future = executor.submit(extract_screenshots, series_id, episode, op_begin_secs, op_end_secs)
+                in_flight[future] = (series_id, episode)
 
+            if not in_flight:
+                if not claimed:
+                    break
+                continue
 
-async def main():
-    with open(r'D:\AOR\artifacts\AOR - export.csv', 'r', encoding='utf-8') as file:
-        reader = csv.reader(file)
-        next(reader)  # Skip header
-        data = list(reader)
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                series_id, episode = in_flight.pop(future)
+                try:
+                    timecodes = future.result()
+                except Exception as e:
+                    print(f'Failed to extract screenshots for {series_id}, {episode}: {e}')
+                    repository.set_episode_finalizing_error(series_id, episode)
+                    continue
 
-    existing = set(os.listdir(r'D:\AOR\artifacts\screenshots'))
-    data = [row for row in data if row[0] not in existing]
-    print(f'Found {len(data)} rows to process')
+                repository.set_episode_finalized(series_id, episode, timecodes)
+                processed += 1
+                print(f'Extracted screenshots for {series_id}, {episode} ({processed} processed)')
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        tasks = [asyncio.ensure_future(process_row(executor, row)) for row in data]
-        for i, future in enumerate(asyncio.as_completed(tasks)):
-            await future
-            print(f'Processed {i + 1}/{len(data)}')
+            repository.renew_episodes_lease(worker_id, list(in_flight.values()))
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
@@ -1,20 +1,48 @@
 import io
+import math
+import os
+import socket
 import sqlite3
+import time
+import uuid
+from typing import Iterator
 
 import numpy as np
 from numpy import ndarray
 
+from config import LEASE_SECS
 from constants import episode_statuses, series_statuses
+from services.scene_index import SceneIndex
+
+# Статусы эпизода в порядке продвижения по конвейеру
+EPISODE_STATUS_PROGRESS = (episode_statuses.downloaded,
+                           episode_statuses.hashing, episode_statuses.hashing_error, episode_statuses.hashed,
+                           episode_statuses.finalizing, episode_statuses.finalizing_error, episode_statuses.finalized)
+
+
+def make_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
 
 
 class AnilibriaRepository:
     database: sqlite3
 
-    def __init__(self):
+    SCHEMA_VERSION = 4
+
+    def __init__(self, database_path: str = './anilibria.sqlite3'):
+        # Конвертер нужен только для чтения хэшей старого формата при миграции
         sqlite3.register_adapter(np.ndarray, AnilibriaRepository.adapt_array)
         sqlite3.register_converter("array", AnilibriaRepository.convert_array)
-        self.database = sqlite3.connect('./anilibria.sqlite3', detect_types=sqlite3.PARSE_DECLTYPES)
+        self.database_path = database_path
+        self.database = sqlite3.connect(database_path, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.configure()
         self.create()
+        self.migrate()
+        self.create_indexes()
+        self.create_triggers()
+        self.scene_index = SceneIndex(SceneIndex.get_index_path(database_path))
+        if self.scene_index.rebuild_required:
+            self.rebuild_scene_index()
 
     # <editor-fold desc="Downloading">
 
@@ -54,9 +82,12 @@ class AnilibriaRepository:
         self.database.commit()
 
     def register_episode(self, series_id: int, episode: int):
+        self.register_episodes([(series_id, episode)])
+
+    def register_episodes(self, episodes: list[tuple[int, int]]):
         cursor = self.database.cursor()
-        cursor.execute('INSERT INTO episodes (series_id, episode, status) VALUES (?, ?, ?)',
-                       (series_id, episode, episode_statuses.downloaded))
+        cursor.executemany('INSERT OR IGNORE INTO episodes (series_id, episode, status) VALUES (?, ?, ?)',
+                           ((series_id, episode, episode_statuses.downloaded) for series_id, episode in episodes))
         self.database.commit()
 
     def is_episode_downloaded(self, series_id: int, episode: int) -> bool:
@@ -69,37 +100,86 @@ class AnilibriaRepository:
 
     # <editor-fold desc="Scenes">
 
-    def get_next_episode_to_hash_and_lock(self) -> tuple[int | None, int | None]:
+    def get_next_episode_to_hash_and_lock(self, worker_id: str | None = None) -> tuple[int | None, int | None]:
+        """
+        Захватывает один эпизод для хэширования.
+        Без worker_id продлить аренду нельзя, поэтому эпизод блокируется бессрочно, как до появления аренды:
+        он освобождается только сменой статуса (register_episode_scenes, set_episode_status_hashing_error).
+        """
+        episodes = self.claim_episodes_to_hash(*self._get_legacy_lease(worker_id))
+        return episodes[0] if episodes else (None, None)
+
+    def claim_episodes_to_hash(self,
+                               worker_id: str,
+                               limit: int = 1,
+                               lease_secs: float = LEASE_SECS) -> list[tuple[int, int]]:
+        """
+        Атомарно захватывает до limit эпизодов для хэширования: скачанные и те, чья аренда истекла
+        (процесс упал или перестал продлевать аренду).
+        """
+        now = time.time()
+        episodes = self._claim('UPDATE episodes SET status = ?, worker_id = ?, lease_expires_at = ? '
+                               'WHERE (series_id, episode) IN ( '
+                               '    SELECT series_id, episode '
+                               '    FROM episodes '
+                               '    WHERE status = ? '
+                               '        OR (status = ? AND IFNULL(lease_expires_at, 0) < ?) '
+                               '    ORDER BY series_id, episode DESC '
+                               '    LIMIT ? '
+                               ') '
+                               'RETURNING series_id, episode',
+                               (episode_statuses.hashing, worker_id, now + lease_secs,
+                                episode_statuses.downloaded, episode_statuses.hashing, now, limit))
+        return sorted(episodes, key=lambda pair: (pair[0], -pair[1]))
+
+    def renew_episodes_lease(self,
+                             worker_id: str,
+                             episodes: list[tuple[int, int]],
+                             lease_secs: float = LEASE_SECS) -> list[tuple[int, int]]:
+        """
+        Продлевает аренду эпизодов, захваченных worker_id (хэширование или финализация).
+        :return: эпизоды, аренда которых продлена; остальные уже забрал другой процесс
+        """
         cursor = self.database.cursor()
-        cursor.execute('SELECT series_id, episode '
-                       'FROM episodes '
-                       'WHERE status = ? '
-                       'ORDER BY series_id, episode desc '
-                       'LIMIT 1', (episode_statuses.downloaded,))
-        pair = cursor.fetchone()
-        if pair is None:
-            return None, None
-
-        cursor.execute('UPDATE episodes SET status = ? WHERE series_id = ? AND episode = ?',
-                       (episode_statuses.hashing, pair[0], pair[1]))
-        self.database.commit()
-        return pair
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            renewed = [pair for series_id, episode in episodes
+                       for pair in cursor.execute('UPDATE episodes SET lease_expires_at = ? '
+                                                  'WHERE series_id = ? AND episode = ? '
+                                                  '    AND worker_id = ? AND status IN (?, ?) '
+                                                  'RETURNING series_id, episode',
+                                                  (time.time() + lease_secs, series_id, episode, worker_id,
+                                                   episode_statuses.hashing, episode_statuses.finalizing))]
+            self.database.commit()
+        except Exception:
+            self.database.rollback()
+            raise
+        return renewed
 
     def register_episode_scenes(self, series_id: int, episode: int, scenes: list[tuple[float, float, ndarray]]):
+        self.register_episodes_scenes([(series_id, episode, scenes)])
+
+    def register_episodes_scenes(self, episodes: list[tuple[int, int, list[tuple[float, float, ndarray]]]]):
         cursor = self.database.cursor()
-        cursor.execute('DELETE FROM scenes WHERE series_id = ? AND episode = ?', (series_id, episode))
-        cursor.executemany('INSERT INTO scenes (series_id, episode, scene_begin_secs, scene_end_secs, hash) '
-                           'VALUES (?, ?, ?, ?, ?)',
-                           ((series_id, episode, scene[0], scene[1], scene[2]) for scene in scenes))
-        cursor.execute('UPDATE episodes SET status = ? WHERE series_id = ? AND episode = ?',
-                       (episode_statuses.hashed, series_id, episode))
+        cursor.executemany('DELETE FROM scenes WHERE series_id = ? AND episode = ?',
+                           ((series_id, episode) for series_id, episode, _ in episodes))
+        cursor.executemany('INSERT INTO scenes '
+                           '(series_id, episode, scene_begin_secs, scene_end_secs, hash, hash_dtype, hash_shape) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           ((series_id, episode, scene[0], scene[1], *AnilibriaRepository.encode_hash(scene[2]))
+                            for series_id, episode, scenes in episodes
+                            for scene in scenes))
+        cursor.executemany('UPDATE episodes SET status = ?, worker_id = NULL, lease_expires_at = NULL '
+                           'WHERE series_id = ? AND episode = ?',
+                           ((episode_statuses.hashed, series_id, episode) for series_id, episode, _ in episodes))
         self.database.commit()
+        self.scene_index.add_episodes(episodes)
 
     def set_episode_status_hashing_error(self, series_id: int, episode: int):
-        cursor = self.database.cursor()
-        cursor.execute('UPDATE episodes SET status = ? WHERE series_id = ? AND episode = ?',
-                       (episode_statuses.hashing_error, series_id, episode))
-        self.database.commit()
+        self.set_episodes_status_hashing_error([(series_id, episode)])
+
+    def set_episodes_status_hashing_error(self, episodes: list[tuple[int, int]]):
+        self._set_episodes_status(episodes, episode_statuses.hashing_error)
 
     # </editor-fold>
 
@@ -111,35 +191,173 @@ class AnilibriaRepository:
         Иначе ничего не берем
         """
         cursor = self.database.cursor()
-        cursor.execute('SELECT series_id, episode, scene_begin_secs, scene_end_secs, hash '
+        cursor.execute('SELECT series_id, episode, scene_begin_secs, scene_end_secs, hash, hash_dtype, hash_shape '
                        'FROM scenes '
                        'WHERE series_id IN ( '
                        '    SELECT id '
                        '    FROM series '
                        '    WHERE downloading_status = ? '
                        '        AND cross_correlation_status IS NULL '
-                       '        AND NOT EXISTS ( '
-                       '            SELECT 1 '
-                       '            FROM episodes '
-                       '            WHERE series_id = series.id '
-                       '                AND status != ? '
-                       '        ) '
+                       '        AND hashed_episodes_count = episodes_count '
                        ') ',
-                       (series_statuses.downloaded, episode_statuses.hashed))
-        return cursor.fetchall()
+                       (series_statuses.downloaded,))
+        return [(series_id, episode, begin, end, AnilibriaRepository.decode_hash(hash_bytes, dtype, shape))
+                for series_id, episode, begin, end, hash_bytes, dtype, shape in cursor.fetchall()]
+
+    def iter_series_scenes_to_cross_correlate(self, chunk_size: int = 10000) -> Iterator[tuple[int, ndarray, ndarray]]:
+        """
+        Потоковый вариант get_next_scenes_to_cross_correlate: отдает сериалы по одному
+        в виде (series_id, scenes, hashes), как get_series_scenes. Сцены читаются курсором порциями по chunk_size,
+        поэтому в памяти держится только текущий сериал.
+        Чтение идет через отдельное соединение: в режиме WAL его снимок не мешает записывать результаты
+        через self.database, пока генератор не исчерпан.
+        """
+        database = sqlite3.connect(self.database_path)
+        try:
+            self.configure(database)
+            cursor = database.execute('SELECT scenes.series_id, episode, scene_begin_secs, scene_end_secs, '
+                                      '    hash, hash_dtype, hash_shape '
+                                      'FROM scenes '
+                                      'JOIN series ON series.id = scenes.series_id '
+                                      'WHERE series.downloading_status = ? '
+                                      '    AND series.cross_correlation_status IS NULL '
+                                      '    AND series.hashed_episodes_count = series.episodes_count '
+                                      'ORDER BY scenes.series_id, episode, scene_begin_secs',
+                                      (series_statuses.downloaded,))
+            series_id, rows = None, []
+            while chunk := cursor.fetchmany(chunk_size):
+                for row in chunk:
+                    if row[0] != series_id:
+                        if rows:
+                            yield series_id, *AnilibriaRepository.stack_scenes(rows)
+                        series_id, rows = row[0], []
+                    rows.append(row[1:])
+            if rows:
+                yield series_id, *AnilibriaRepository.stack_scenes(rows)
+        finally:
+            database.close()
+
+    def claim_series_to_cross_correlate(self, worker_id: str, lease_secs: float = LEASE_SECS) -> int | None:
+        """
+        Атомарно захватывает сериал для кросс-корреляции: скачанный, со всеми хэшированными эпизодами
+        и еще не обработанный либо с истекшей арендой. Сцены берутся через get_series_scenes.
+        """
+        now = time.time()
+        series = self._claim('UPDATE series SET cross_correlation_status = ?, worker_id = ?, lease_expires_at = ? '
+                             'WHERE id = ( '
+                             '    SELECT id '
+                             '    FROM series '
+                             '    WHERE downloading_status = ? '
+                             '        AND (cross_correlation_status IS NULL '
+                             '             OR (cross_correlation_status = ? AND IFNULL(lease_expires_at, 0) < ?)) '
+                             '        AND hashed_episodes_count = episodes_count '
+                             '    ORDER BY id '
+                             '    LIMIT 1 '
+                             ') '
+                             'RETURNING id',
+                             (series_statuses.cross_correlating, worker_id, now + lease_secs,
+                              series_statuses.downloaded, series_statuses.cross_correlating, now))
+        return series[0][0] if series else None
+
+    def renew_series_lease(self, worker_id: str, series_id: int, lease_secs: float = LEASE_SECS) -> bool:
+        """
+        :return: False, если аренду сериала уже забрал другой процесс
+        """
+        renewed = self._claim('UPDATE series SET lease_expires_at = ? '
+                              'WHERE id = ? AND worker_id = ? AND cross_correlation_status = ? '
+                              'RETURNING id',
+                              (time.time() + lease_secs, series_id, worker_id, series_statuses.cross_correlating))
+        return bool(renewed)
+
+    def find_similar_scenes(self,
+                            scene_hash: ndarray,
+                            max_distance: int,
+                            series_id: int | None = None,
+                            limit: int | None = None) -> list[tuple[int, int, float, float, int]]:
+        """
+        Сцены сериала (или всего каталога, если series_id не задан), похожие на scene_hash. См. SceneIndex.search.
+        """
+        return self.scene_index.search(scene_hash, max_distance, series_id, limit)
+
+    def rebuild_scene_index(self, chunk_size: int = 10000):
+        """
+        Заново строит индекс похожих сцен по всем сценам базы, например для базы, заполненной до появления индекса,
+        или если индекс отстал от базы (он фиксируется отдельно, см. SceneIndex).
+        Вызывается при открытии базы, если индекс новый (например, файл индекса потерян), построен с другим
+        числом полос или его перестройка была прервана.
+        """
+        self.scene_index.clear()
+        cursor = self.database.cursor()
+        cursor.execute('SELECT series_id, episode, scene_begin_secs, scene_end_secs, hash, hash_dtype, hash_shape '
+                       'FROM scenes '
+                       'ORDER BY series_id, episode')
+        episodes = {}
+        while rows := cursor.fetchmany(chunk_size):
+            for series_id, episode, begin, end, hash_bytes, dtype, shape in rows:
+                episodes.setdefault((series_id, episode), []).append(
+                    (begin, end, AnilibriaRepository.decode_hash(hash_bytes, dtype, shape)))
+            # Последний эпизод порции может продолжиться в следующей, а add_episodes заменяет сцены эпизода целиком
+            last_episode = rows[-1][:2]
+            self.scene_index.add_episodes((series_id, episode, scenes)
+                                          for (series_id, episode), scenes in episodes.items()
+                                          if (series_id, episode) != last_episode)
+            episodes = {last_episode: episodes[last_episode]}
+        self.scene_index.add_episodes((series_id, episode, scenes)
+                                      for (series_id, episode), scenes in episodes.items())
+        self.scene_index.finish_rebuild()
+
+    def get_series_scenes(self, series_id: int) -> tuple[ndarray, ndarray]:
+        """
+        Возвращает все сцены сериала, упорядоченные по эпизоду и началу сцены.
+        :return: (scenes, hashes), где scenes - ndarray (N, 3) с (episode, scene_begin_secs, scene_end_secs),
+          hashes - непрерывная матрица (N, hash_size) хэшей сцен
+        """
+        cursor = self.database.cursor()
+        cursor.execute('SELECT episode, scene_begin_secs, scene_end_secs, hash, hash_dtype, hash_shape '
+                       'FROM scenes '
+                       'WHERE series_id = ? '
+                       'ORDER BY episode, scene_begin_secs',
+                       (series_id,))
+        return AnilibriaRepository.stack_scenes(cursor.fetchall())
 
     def register_episodes_openings(self, series_id: int, openings: list[tuple[int, float, float]]):
         cursor = self.database.cursor()
         cursor.executemany('UPDATE episodes SET opening_begin_secs = ?, opening_end_secs = ? '
                            'WHERE series_id = ? AND episode = ?',
                            ((opening[1], opening[2], series_id, opening[0]) for opening in openings))
-        cursor.execute('UPDATE series SET cross_correlation_status = ? WHERE id = ?',
+        cursor.execute('UPDATE series SET cross_correlation_status = ?, worker_id = NULL, lease_expires_at = NULL '
+                       'WHERE id = ?',
                        (series_statuses.cross_correlated, series_id))
         self.database.commit()
 
+    def get_series_openings(self) -> Iterator[tuple[int, list[tuple[int, float, float]]]]:
+        """
+        Отдает найденные опенинги кросс-коррелированных сериалов: (series_id, [(episode, begin_secs, end_secs)]).
+        """
+        cursor = self.database.cursor()
+        cursor.execute('SELECT series_id, episode, opening_begin_secs, opening_end_secs '
+                       'FROM episodes '
+                       'JOIN series ON series.id = episodes.series_id '
+                       'WHERE series.cross_correlation_status = ? '
+                       '    AND opening_begin_secs IS NOT NULL '
+                       '    AND opening_end_secs IS NOT NULL '
+                       'ORDER BY series_id, episode',
+                       (series_statuses.cross_correlated,))
+        series_id, openings = None, []
+        while rows := cursor.fetchmany(10000):
+            for row in rows:
+                if row[0] != series_id:
+                    if openings:
+                        yield series_id, openings
+                    series_id, openings = row[0], []
+                openings.append(row[1:])
+        if openings:
+            yield series_id, openings
+
     def set_series_status_cross_correlation_error(self, series_id: int):
         cursor = self.database.cursor()
-        cursor.execute('UPDATE series SET cross_correlation_status = ? WHERE id = ?',
+        cursor.execute('UPDATE series SET cross_correlation_status = ?, worker_id = NULL, lease_expires_at = NULL '
+                       'WHERE id = ?',
                        (series_statuses.cross_correlation_error, series_id))
         self.database.commit()
 
@@ -147,15 +365,42 @@ class AnilibriaRepository:
 
     # <editor-fold desc="Finalization">
 
-    def get_next_episode_to_finalize(self) -> tuple[int, int, float, float]:
-        cursor = self.database.cursor()
-        cursor.execute('SELECT series_id, episode, opening_begin_secs, opening_end_secs '
-                       'FROM episodes '
-                       'JOIN series ON series.id = episodes.series_id '
-                       'WHERE series.cross_correlation_status is not null '
-                       '    AND episodes.status NOT IN (?, ?) '
-                       'LIMIT 1', (episode_statuses.finalized, episode_statuses.finalizing_error))
-        return cursor.fetchone()
+    def get_next_episode_to_finalize(self, worker_id: str | None = None) -> tuple[int, int, float, float] | None:
+        """
+        Захватывает один эпизод для финализации. Без worker_id эпизод блокируется бессрочно
+        (см. get_next_episode_to_hash_and_lock) до set_episode_finalized или set_episode_finalizing_error.
+        """
+        episodes = self.claim_episodes_to_finalize(*self._get_legacy_lease(worker_id))
+        return episodes[0] if episodes else None
+
+    def claim_episodes_to_finalize(self,
+                                   worker_id: str,
+                                   limit: int = 1,
+                                   lease_secs: float = LEASE_SECS) -> list[tuple[int, int, float, float]]:
+        """
+        Атомарно захватывает до limit эпизодов кросс-коррелированных сериалов для финализации,
+        включая эпизоды с истекшей арендой.
+        :return: список (series_id, episode, opening_begin_secs, opening_end_secs)
+        """
+        now = time.time()
+        episodes = self._claim('UPDATE episodes SET status = ?, worker_id = ?, lease_expires_at = ? '
+                               'WHERE (series_id, episode) IN ( '
+                               '    SELECT series_id, episode '
+                               '    FROM episodes '
+                               '    JOIN series ON series.id = episodes.series_id '
+                               '    WHERE series.cross_correlation_status IS NOT NULL '
+                               '        AND series.cross_correlation_status != ? '
+                               '        AND (episodes.status NOT IN (?, ?, ?) '
+                               '             OR (episodes.status = ? AND IFNULL(episodes.lease_expires_at, 0) < ?)) '
+                               '    LIMIT ? '
+                               ') '
+                               'RETURNING series_id, episode, opening_begin_secs, opening_end_secs',
+                               (episode_statuses.finalizing, worker_id, now + lease_secs,
+                                series_statuses.cross_correlating,
+                                episode_statuses.finalized, episode_statuses.finalizing_error,
+                                episode_statuses.finalizing,
+                                episode_statuses.finalizing, now, limit))
+        return sorted(episodes)
 
     def get_scenes_for_episode(self, series_id: int, episode: int) -> list[tuple[float, float]]:
         cursor = self.database.cursor()
@@ -166,29 +411,80 @@ class AnilibriaRepository:
         return cursor.fetchall()
 
     def set_episode_finalized(self, series_id: int, episode: int, screenshot_timecodes: set[int]) -> None:
+        self.set_episodes_finalized([(series_id, episode, screenshot_timecodes)])
+
+    def set_episodes_finalized(self, episodes: list[tuple[int, int, set[int]]]) -> None:
         cursor = self.database.cursor()
-        cursor.execute('UPDATE episodes SET status = ? WHERE series_id = ? AND episode = ?',
-                       (episode_statuses.finalized, series_id, episode))
+        cursor.executemany('UPDATE episodes SET status = ?, worker_id = NULL, lease_expires_at = NULL '
+                           'WHERE series_id = ? AND episode = ?',
+                           ((episode_statuses.finalized, series_id, episode) for series_id, episode, _ in episodes))
         cursor.executemany('INSERT INTO screenshots (series_id, episode, timecode) VALUES (?, ?, ?)',
-                           ((series_id, episode, timecode) for timecode in screenshot_timecodes))
+                           ((series_id, episode, timecode)
+                            for series_id, episode, screenshot_timecodes in episodes
+                            for timecode in screenshot_timecodes))
         self.database.commit()
 
     def set_episode_finalizing_error(self, series_id: int, episode: int):
+        self.set_episodes_finalizing_error([(series_id, episode)])
+
+    def set_episodes_finalizing_error(self, episodes: list[tuple[int, int]]):
+        self._set_episodes_status(episodes, episode_statuses.finalizing_error)
+
+    def _set_episodes_status(self, episodes: list[tuple[int, int]], status: str):
         cursor = self.database.cursor()
-        cursor.execute('UPDATE episodes SET status = ? WHERE series_id = ? AND episode = ?',
-                       (episode_statuses.finalizing_error, series_id, episode))
+        cursor.executemany('UPDATE episodes SET status = ?, worker_id = NULL, lease_expires_at = NULL '
+                           'WHERE series_id = ? AND episode = ?',
+                           ((status, series_id, episode) for series_id, episode in episodes))
         self.database.commit()
 
+    @staticmethod
+    def _get_legacy_lease(worker_id: str | None) -> tuple[str, int, float]:
+        # (worker_id, limit, lease_secs) для захвата одной задачи; аренда бессрочна, если продлевать ее некому
+        if worker_id is None:
+            return make_worker_id(), 1, math.inf
+        return worker_id, 1, LEASE_SECS
+
+    def _claim(self, query: str, parameters: tuple) -> list[tuple]:
+        # BEGIN IMMEDIATE сразу берет блокировку записи: процессы ждут друг друга по busy_timeout,
+        # а не получают SQLITE_BUSY при повышении блокировки посреди транзакции
+        cursor = self.database.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            rows = cursor.execute(query, parameters).fetchall()
+            self.database.commit()
+        except Exception:
+            self.database.rollback()
+            raise
+        return rows
+
     # </editor-fold>
 
+    def configure(self, database: sqlite3.Connection | None = None):
+        """
+        Настраивает соединение database (по умолчанию self.database). Дополнительные соединения,
+        например потоковое чтение в iter_series_scenes_to_cross_correlate, настраиваются так же.
+        """
+        cursor = (database or self.database).cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.execute('PRAGMA cache_size = -65536')
+        cursor.execute('PRAGMA mmap_size = 268435456')
+        cursor.execute('PRAGMA busy_timeout = 30000')
+
     def create(self):
         cursor = self.database.cursor()
+        is_new = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'series'").fetchone() is None
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS series (
                 id INTEGER PRIMARY KEY,
                 name TEXT NOT NULL,
                 downloading_status TEXT NOT NULL,
-                cross_correlation_status TEXT
+                cross_correlation_status TEXT,
+                worker_id TEXT,
+                lease_expires_at REAL,
+                episodes_count INTEGER NOT NULL DEFAULT 0,
+                hashed_episodes_count INTEGER NOT NULL DEFAULT 0
             )
         ''')
         cursor.execute('''
@@ -198,6 +494,9 @@ class AnilibriaRepository:
                 status TEXT NOT NULL,
                 opening_begin_secs REAL,
                 opening_end_secs REAL,
+                worker_id TEXT,
+                lease_expires_at REAL,
+                PRIMARY KEY (series_id, episode),
                 FOREIGN KEY (series_id) REFERENCES series (id)
             )
         ''')
@@ -207,7 +506,9 @@ class AnilibriaRepository:
                 episode INTEGER NOT NULL,
                 scene_begin_secs REAL NOT NULL,
                 scene_end_secs REAL NOT NULL,
-                hash array NOT NULL,
+                hash BLOB NOT NULL,
+                hash_dtype TEXT NOT NULL,
+                hash_shape TEXT NOT NULL,
                 FOREIGN KEY (series_id) REFERENCES series (id)
             )
         ''')
@@ -220,8 +521,180 @@ class AnilibriaRepository:
                 CONSTRAINT unique_screenshot UNIQUE (series_id, episode, timecode)
             )
         ''')
+        if is_new:
+            # Новая база сразу создается в актуальной схеме
+            cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.database.commit()
+
+    def create_indexes(self):
+        cursor = self.database.cursor()
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_episodes_status ON episodes (status, series_id, episode DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_scenes_series_episode ON scenes (series_id, episode)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_series_downloading_status '
+                       'ON series (downloading_status, cross_correlation_status)')
+        self.database.commit()
+
+    def create_triggers(self):
+        # Счетчики эпизодов сериала заменяют проверку NOT EXISTS по всем эпизодам при выборе сериалов
+        cursor = self.database.cursor()
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_episodes_insert AFTER INSERT ON episodes
+            BEGIN
+                UPDATE series
+                SET episodes_count = episodes_count + 1,
+                    hashed_episodes_count = hashed_episodes_count + (NEW.status = '{episode_statuses.hashed}')
+                WHERE id = NEW.series_id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_episodes_delete AFTER DELETE ON episodes
+            BEGIN
+                UPDATE series
+                SET episodes_count = episodes_count - 1,
+                    hashed_episodes_count = hashed_episodes_count - (OLD.status = '{episode_statuses.hashed}')
+                WHERE id = OLD.series_id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_episodes_update AFTER UPDATE OF series_id, status ON episodes
+            BEGIN
+                UPDATE series
+                SET episodes_count = episodes_count - 1,
+                    hashed_episodes_count = hashed_episodes_count - (OLD.status = '{episode_statuses.hashed}')
+                WHERE id = OLD.series_id;
+                UPDATE series
+                SET episodes_count = episodes_count + 1,
+                    hashed_episodes_count = hashed_episodes_count + (NEW.status = '{episode_statuses.hashed}')
+                WHERE id = NEW.series_id;
+            END
+        ''')
         self.database.commit()
 
+    def migrate(self):
+        """
+        Доводит схему существующей базы до SCHEMA_VERSION. Версия хранится в PRAGMA user_version.
+        """
+        cursor = self.database.cursor()
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        migrations = [self._migrate_to_1, self._migrate_to_2, self._migrate_to_3, self._migrate_to_4]
+        for target_version, migration in enumerate(migrations[version:self.SCHEMA_VERSION], start=version + 1):
+            cursor.execute('BEGIN')
+            try:
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {target_version}')
+                self.database.commit()
+            except Exception:
+                self.database.rollback()
+                raise
+
+    @staticmethod
+    def _migrate_to_1(cursor: sqlite3.Cursor):
+        # Первичный ключ в SQLite нельзя добавить к существующей таблице - пересоздаем episodes
+        cursor.execute('''
+            CREATE TABLE episodes_new (
+                series_id INTEGER NOT NULL,
+                episode INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                opening_begin_secs REAL,
+                opening_end_secs REAL,
+                PRIMARY KEY (series_id, episode),
+                FOREIGN KEY (series_id) REFERENCES series (id)
+            )
+        ''')
+        # Из дубликатов (series_id, episode) остается самая полная строка: с найденным опенингом,
+        # затем с самым поздним статусом, затем первая добавленная
+        status_rank = ' '.join(f"WHEN '{status}' THEN {rank}" for rank, status in enumerate(EPISODE_STATUS_PROGRESS))
+        cursor.execute(f'''
+            INSERT INTO episodes_new
+            SELECT series_id, episode, status, opening_begin_secs, opening_end_secs
+            FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY series_id, episode
+                    ORDER BY opening_begin_secs IS NOT NULL AND opening_end_secs IS NOT NULL DESC,
+                             CASE status {status_rank} ELSE -1 END DESC,
+                             rowid
+                ) AS duplicate_number
+                FROM episodes
+            )
+            WHERE duplicate_number = 1
+        ''')
+        cursor.execute('DROP TABLE episodes')
+        cursor.execute('ALTER TABLE episodes_new RENAME TO episodes')
+
+    @staticmethod
+    def _migrate_to_2(cursor: sqlite3.Cursor):
+        # Хэши из формата np.save переводятся в сырые байты с отдельными dtype и shape
+        cursor.execute('''
+            CREATE TABLE scenes_new (
+                series_id INTEGER NOT NULL,
+                episode INTEGER NOT NULL,
+                scene_begin_secs REAL NOT NULL,
+                scene_end_secs REAL NOT NULL,
+                hash BLOB NOT NULL,
+                hash_dtype TEXT NOT NULL,
+                hash_shape TEXT NOT NULL,
+                FOREIGN KEY (series_id) REFERENCES series (id)
+            )
+        ''')
+        select_cursor = cursor.connection.cursor()
+        select_cursor.execute('SELECT series_id, episode, scene_begin_secs, scene_end_secs, hash FROM scenes')
+        while rows := select_cursor.fetchmany(10000):
+            cursor.executemany('INSERT INTO scenes_new VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               ((series_id, episode, begin, end, *AnilibriaRepository.encode_hash(hash_array))
+                                for series_id, episode, begin, end, hash_array in rows))
+        cursor.execute('DROP TABLE scenes')
+        cursor.execute('ALTER TABLE scenes_new RENAME TO scenes')
+
+    @staticmethod
+    def _migrate_to_3(cursor: sqlite3.Cursor):
+        # Аренда задач; эпизоды, зависшие в ep_hashing без аренды, будут перезахвачены как просроченные
+        for table in ('episodes', 'series'):
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN worker_id TEXT')
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN lease_expires_at REAL')
+
+    @staticmethod
+    def _migrate_to_4(cursor: sqlite3.Cursor):
+        # Дальше счетчики поддерживаются триггерами (см. create_triggers)
+        cursor.execute('ALTER TABLE series ADD COLUMN episodes_count INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('ALTER TABLE series ADD COLUMN hashed_episodes_count INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('UPDATE series '
+                       'SET episodes_count = (SELECT COUNT(*) FROM episodes WHERE series_id = series.id), '
+                       '    hashed_episodes_count = (SELECT COUNT(*) FROM episodes '
+                       '                             WHERE series_id = series.id AND status = ?)',
+                       (episode_statuses.hashed,))
+
+    @staticmethod
+    def encode_hash(hash_array: ndarray) -> tuple[bytes, str, str]:
+        hash_array = np.ascontiguousarray(hash_array)
+        return hash_array.tobytes(), hash_array.dtype.str, ','.join(map(str, hash_array.shape))
+
+    @staticmethod
+    def decode_hash(hash_bytes: bytes, dtype: str, shape: str) -> ndarray:
+        return np.frombuffer(hash_bytes, dtype=dtype).reshape(AnilibriaRepository._parse_shape(shape))
+
+    @staticmethod
+    def stack_scenes(rows: list[tuple[int, float, float, bytes, str, str]]) -> tuple[ndarray, ndarray]:
+        """
+        Собирает строки (episode, begin, end, hash, hash_dtype, hash_shape) в матрицу сцен и матрицу хэшей
+        одним копированием байтов.
+        """
+        if not rows:
+            return np.zeros((0, 3)), np.zeros((0, 0), dtype=np.uint8)
+
+        dtypes = {row[4] for row in rows}
+        shapes = {row[5] for row in rows}
+        if len(dtypes) != 1 or len(shapes) != 1:
+            raise ValueError(f'Scene hashes have different formats: {dtypes}, {shapes}')
+
+        scenes = np.array([row[:3] for row in rows], dtype=np.float64)
+        hash_size = int(np.prod(AnilibriaRepository._parse_shape(rows[0][5])))
+        hashes = np.frombuffer(b''.join(row[3] for row in rows), dtype=rows[0][4]).reshape(len(rows), hash_size)
+        return scenes, hashes
+
+    @staticmethod
+    def _parse_shape(shape: str) -> tuple[int, ...]:
+        return tuple(int(dim) for dim in shape.split(',')) if shape else ()
+
     @staticmethod
     def adapt_array(arr):
         """
@@ -1,16 +1,21 @@
+import json
 import os
+import struct
 import time
 from typing import List, Tuple
 
-import librosa
-import cupy as cp
 import numpy as np
 
 from config import RATE
 import soundfile as sf
 
+from services import instrumentation
 
-def _load_audio(file: str) -> cp.ndarray:
+# Частота дискретизации массива {episode}.npy хранится рядом с ним в {episode}.npy.json
+NPY_META_EXTENSION = '.json'
+
+
+def _load_audio(file: str) -> np.ndarray:
     t0 = time.time()
     audio, rate = sf.read(file)
     if rate != RATE:
@@ -21,7 +26,7 @@ def _load_audio(file: str) -> cp.ndarray:
     return audio
 
 
-def load_folder(folder: str) -> List[Tuple[str, cp.ndarray]]:
+def load_folder(folder: str) -> List[Tuple[str, np.ndarray]]:
     files = os.listdir(folder)
 
     audios = []
@@ -30,3 +35,97 @@ def load_folder(folder: str) -> List[Tuple[str, cp.ndarray]]:
         audios.append((file, audio))
 
     return audios
+
+
+class LazyAudio:
+    """
+    Ссылка на аудиофайл, который читается как float32 только при вызове load().
+    Массивы .npy и несжатые float32 WAV отображаются в память без копирования,
+    остальные форматы читаются блоком через soundfile.
+    Вызывающий код сам решает, когда отпустить загруженный массив.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.filename = os.path.basename(path)
+
+    def __repr__(self):
+        return f'LazyAudio({self.path!r})'
+
+    def load(self) -> np.ndarray:
+        with instrumentation.stage('load', file=self.path) as stage:
+            audio = self._load()
+            stage.add(bytes=audio.nbytes)
+        return audio
+
+    def _load(self) -> np.ndarray:
+        t0 = time.time()
+
+        if self.path.endswith('.npy'):
+            # Массивы от s2_extract_audio.py уже моно float32; частота записана при извлечении
+            rate = read_npy_rate(self.path)
+            if rate != RATE:
+                raise ValueError(f'Wrong rate: {rate} != {RATE}')
+
+            audio = np.load(self.path, mmap_mode='r')
+            print(f'{self.path} loaded ({round(time.time() - t0, 3)}s)')
+            return audio
+
+        info = sf.info(self.path)
+        if info.samplerate != RATE:
+            raise ValueError(f'Wrong rate: {info.samplerate} != {RATE}')
+
+        data_offset = _find_wav_data_offset(self.path) if info.format == 'WAV' else None
+        if info.subtype == 'FLOAT' and info.channels == 1 and data_offset is not None:
+            audio = np.memmap(self.path, dtype='<f4', mode='r', offset=data_offset, shape=(info.frames,))
+        else:
+            audio, _ = sf.read(self.path, dtype='float32', always_2d=False)
+
+        print(f'{self.path} loaded ({round(time.time() - t0, 3)}s)')
+
+        return audio
+
+
+def load_folder_lazy(folder: str) -> List[LazyAudio]:
+    """
+    Возвращает ссылки на все аудиофайлы папки, отсортированные по номеру эпизода, ничего не загружая.
+    """
+    files = sorted((file for file in os.listdir(folder) if not file.endswith(NPY_META_EXTENSION)),
+                   key=lambda file: int(file.split('.')[0]))
+    return [LazyAudio(os.path.join(folder, file)) for file in files]
+
+
+def save_npy_audio(path: str, audio: np.ndarray, rate: int):
+    np.save(path, audio)
+    write_npy_rate(path, rate)
+
+
+def write_npy_rate(path: str, rate: int):
+    with open(f'{path}{NPY_META_EXTENSION}', 'w', encoding='utf-8') as f:
+        json.dump({'rate': rate}, f)
+
+
+def read_npy_rate(path: str) -> int:
+    try:
+        with open(f'{path}{NPY_META_EXTENSION}', 'r', encoding='utf-8') as f:
+            return int(json.load(f)['rate'])
+    except FileNotFoundError:
+        raise ValueError(f'Unknown rate of {path}: no {path}{NPY_META_EXTENSION}, run s2_extract_audio.py') from None
+
+
+def _find_wav_data_offset(path: str) -> int | None:
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            return None
+
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'data':
+                return f.tell()
+
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
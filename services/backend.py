@@ -0,0 +1,61 @@
+"""
+Выбор вычислительного бэкенда: CuPy (GPU) или NumPy/SciPy (CPU).
+Переключается через config.BACKEND (переменная окружения AOR_BACKEND).
+"""
+from config import BACKEND, FFT_WORKERS
+
+if BACKEND == 'cupy':
+    import cupy as xp
+    import numpy as np
+
+    is_gpu = True
+
+    def fuse(*args, **kwargs):
+        return xp.fuse(*args, **kwargs)
+
+    def asnumpy(array) -> np.ndarray:
+        return xp.asnumpy(array)
+
+    def correlate(a, v, mode='valid'):
+        return xp.correlate(a, v, mode=mode)
+
+    def rfft(a, n=None, axis=-1):
+        return xp.fft.rfft(a, n=n, axis=axis)
+
+    def irfft(a, n=None, axis=-1):
+        return xp.fft.irfft(a, n=n, axis=axis)
+
+    def next_fast_len(target: int) -> int:
+        import cupyx.scipy.fft
+        return cupyx.scipy.fft.next_fast_len(target)
+
+elif BACKEND == 'numpy':
+    import numpy as xp
+    import numpy as np
+    import scipy.fft
+    import scipy.signal
+
+    is_gpu = False
+
+    def fuse(*args, **kwargs):
+        # На CPU слияние ядер не требуется, функция исполняется как есть
+        return lambda func: func
+
+    def asnumpy(array) -> np.ndarray:
+        return np.asarray(array)
+
+    def correlate(a, v, mode='valid'):
+        with scipy.fft.set_workers(FFT_WORKERS):
+            return scipy.signal.correlate(a, v, mode=mode)
+
+    def rfft(a, n=None, axis=-1):
+        return scipy.fft.rfft(a, n=n, axis=axis, workers=FFT_WORKERS)
+
+    def irfft(a, n=None, axis=-1):
+        return scipy.fft.irfft(a, n=n, axis=axis, workers=FFT_WORKERS)
+
+    def next_fast_len(target: int) -> int:
+        return scipy.fft.next_fast_len(target, real=True)
+
+else:
+    raise ValueError(f'Unknown backend: {BACKEND}')
@@ -0,0 +1,150 @@
+import io
+import json
+import os
+import struct
+import zipfile
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+# Формат файла сериала:
+#   MAGIC (4 байта), версия (uint32), длина заголовка (uint64),
+#   заголовок JSON с индексом пар (и опенингами эпизодов, найденными по библиотеке), выравнивание до DATA_ALIGNMENT,
+#   float32-матрица (сумма длин всех кривых, COLUMNS) - кривые корреляции всех пар подряд.
+MAGIC = b'AORC'
+VERSION = 1
+COLUMNS = 2
+DATA_ALIGNMENT = 64
+EXTENSION = '.aorc'
+
+Correlation = Tuple[str, str, float, float, np.ndarray]
+Opening = Tuple[float, float]
+
+
+def write_series(path: str, correlations: Iterable[Correlation], openings: Dict[str, Opening] | None = None):
+    """
+    Сохраняет кривые корреляции всех пар сериала в один бинарный файл.
+    :param path: путь к файлу
+    :param correlations: кортежи (file1, file2, offset1, offset2, corr), где corr - ndarray (N, 2)
+    :param openings: опенинги эпизодов, найденные без пар (см. services.opening_library): file -> (begin, end)
+    """
+    pairs = []
+    curves = []
+    start = 0
+    for file1, file2, offset1, offset2, corr in correlations:
+        corr = np.asarray(corr, dtype=np.float32).reshape(-1, COLUMNS)
+        pairs.append({'file1': file1, 'file2': file2,
+                      'offset1': float(offset1), 'offset2': float(offset2),
+                      'start': start, 'length': corr.shape[0]})
+        curves.append(corr)
+        start += corr.shape[0]
+
+    openings = {file: [float(begin), float(end)] for file, (begin, end) in (openings or {}).items()}
+    header = json.dumps({'columns': COLUMNS, 'rows': start, 'pairs': pairs, 'openings': openings}).encode('utf-8')
+    prefix_length = len(MAGIC) + struct.calcsize('<IQ') + len(header)
+    padding = b'\0' * (-prefix_length % DATA_ALIGNMENT)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<IQ', VERSION, len(header)))
+        f.write(header)
+        f.write(padding)
+        for corr in curves:
+            f.write(corr.astype('<f4', copy=False).tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_series(path: str) -> List[Correlation]:
+    """
+    Читает файл сериала. Кривые - представления одной отображенной в память матрицы, без разбора текста.
+    """
+    with open(path, 'rb') as f:
+        header, data_offset = _read_header(f)
+
+    if header['rows'] == 0:
+        data = np.zeros((0, header['columns']), dtype=np.float32)
+    else:
+        data = np.memmap(path, dtype='<f4', mode='r', offset=data_offset, shape=(header['rows'], header['columns']))
+
+    return [(pair['file1'], pair['file2'], pair['offset1'], pair['offset2'],
+             data[pair['start']:pair['start'] + pair['length']])
+            for pair in header['pairs']]
+
+
+def read_series_openings(path: str) -> Dict[str, Opening]:
+    """
+    Читает из заголовка файла сериала опенинги эпизодов, найденные без пар. В файлах, записанных
+    до появления поля, их нет.
+    """
+    with open(path, 'rb') as f:
+        header, _ = _read_header(f)
+    return {file: (begin, end) for file, (begin, end) in header.get('openings', {}).items()}
+
+
+def get_series_path(store_dir: str, series_id: int) -> str:
+    return os.path.join(store_dir, f'{series_id}{EXTENSION}')
+
+
+def list_series(store_dir: str) -> List[int]:
+    return sorted(int(file[:-len(EXTENSION)])
+                  for file in os.listdir(store_dir)
+                  if file.endswith(EXTENSION))
+
+
+def parse_legacy_filename(filename: str) -> Tuple[str, str, float, float]:
+    """
+    Разбирает имя CSV-файла старого формата '{file1}_{file2}_{offset1_ms}_{offset2_ms}.csv'.
+    """
+    file1, file2, offset1, offset2 = filename.replace('.csv', '').split('_')
+    return file1, file2, float(offset1) / 1000, float(offset2) / 1000
+
+
+def convert_directory(corr_dir: str, path: str):
+    """
+    Конвертирует каталог с CSV-файлами корреляций одного сериала в бинарный файл.
+    """
+    correlations = []
+    for filename in sorted(os.listdir(corr_dir)):
+        if not filename.endswith('.csv'):
+            continue
+        corr = np.loadtxt(os.path.join(corr_dir, filename), delimiter=',', ndmin=2)
+        correlations.append((*parse_legacy_filename(filename), corr))
+
+    write_series(path, correlations)
+
+
+def convert_zip(archive_path: str, store_dir: str):
+    """
+    Конвертирует архив correlations.zip (correlations/{series_id}/{file}.csv) в файлы сериалов в store_dir.
+    Архив обрабатывается по одному сериалу.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    with zipfile.ZipFile(archive_path, 'r') as archive:
+        members_by_series = {}
+        for member in archive.namelist():
+            if not member.endswith('.csv'):
+                continue
+            _, series_id, filename = member.split('/')
+            members_by_series.setdefault(int(series_id), []).append((member, filename))
+
+        for series_id, members in members_by_series.items():
+            correlations = []
+            for member, filename in sorted(members, key=lambda member: member[1]):
+                corr = np.loadtxt(io.TextIOWrapper(archive.open(member)), delimiter=',', ndmin=2)
+                correlations.append((*parse_legacy_filename(filename), corr))
+            write_series(get_series_path(store_dir, series_id), correlations)
+
+
+def _read_header(f) -> Tuple[dict, int]:
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError(f'Not a correlation store file: {f.name}')
+
+    version, header_length = struct.unpack('<IQ', f.read(struct.calcsize('<IQ')))
+    if version != VERSION:
+        raise ValueError(f'Unsupported correlation store version: {version}')
+
+    header = json.loads(f.read(header_length).decode('utf-8'))
+    prefix_length = len(MAGIC) + struct.calcsize('<IQ') + header_length
+    return header, prefix_length + (-prefix_length % DATA_ALIGNMENT)
@@ -1,66 +1,258 @@
 import logging
-import cupy as cp
+from typing import List, Tuple
 
-from config import WINDOW_BEAT, RATE
+from config import (WINDOW_BEAT, RATE, MULTIRES_ENABLED, MULTIRES_DECIMATION, MULTIRES_CANDIDATES,
+                    MULTIRES_REFINE_RADIUS_SECS)
+from services.backend import xp, asnumpy
+from services.feature_cache import FeatureCache
+from services.fft_correlator import (batched_correlation_peaks, batched_full_correlation_max,
+                                     compute_blocks_spectra, compute_fragments_spectra,
+                                     find_correlation_peaks, find_correlation_peaks_batch, get_fft_size)
 
 logger = logging.getLogger(__name__)
 
 
-def correlation_with_async_moving_window(audio1: cp.ndarray,
-                                         audio2: cp.ndarray) -> cp.stack:
+def correlation_with_async_moving_window(audio1: xp.ndarray,
+                                         audio2: xp.ndarray,
+                                         cache: FeatureCache | None = None,
+                                         multiresolution: bool = MULTIRES_ENABLED,
+                                         region: Tuple[int, int] | None = None) -> xp.stack:
     """
     Разбивает файл audio1 на фрагменты размером WINDOW_BEAT и рассчитывает корреляцию с audio2.
     Возвращает список кортежей (offset1, offset2, corr), содержащий данные о смещении наиболее похожего фрагмента
     audio2 на каждый фрагмент audio1.
     :param audio1: ndarray с аудио
     :param audio2: ndarray с аудио
+    :param cache: кэш признаков эпизодов; спектры фрагментов audio1 и блоков audio2 берутся из него
+    :param multiresolution: искать от грубого к точному (см. _correlation_coarse_to_fine)
+    :param region: (begin, end) в отсчетах - искать только фрагменты audio1 и смещения audio2 внутри этой области;
+      смещения результата все равно отсчитываются от начала аудио
     :return: список кортежей (offset1, offset2, corr),
       где offset1 - смещение в audio1,
           offset2 - смещение в audio2,
           corr - коэффициент корреляции
     """
-    num_fragments = (len(audio1) + WINDOW_BEAT - 1) // WINDOW_BEAT
-    fragments = cp.stack([audio1[i * WINDOW_BEAT: i * WINDOW_BEAT + WINDOW_BEAT]
-                          for i in range(num_fragments - 1)])
+    if region is not None:
+        begin, end = region
+        offsets = correlation_with_async_moving_window(audio1[begin:end], audio2[begin:end], cache, multiresolution)
+        return _shift_offsets(offsets, begin)
 
-    corr_per_fragment = cp.array([cp.correlate(audio2, fragment, mode='valid')
-                                  for fragment in fragments])
+    if multiresolution:
+        return _correlation_coarse_to_fine(audio1, audio2, cache)
 
-    audio2_offsets = cp.argmax(corr_per_fragment, axis=1)
-    corr_peaks_per_fragment = cp.max(corr_per_fragment, axis=1)
+    num_fragments = (len(audio1) + WINDOW_BEAT - 1) // WINDOW_BEAT
+    audio2_offsets, corr_peaks_per_fragment = _find_fragments_peaks(audio1, audio2, WINDOW_BEAT, cache)
 
-    offsets = cp.stack((cp.arange(num_fragments - 1) * WINDOW_BEAT,
+    offsets = xp.stack((xp.arange(num_fragments - 1) * WINDOW_BEAT,
                         audio2_offsets,
                         corr_peaks_per_fragment), axis=-1)
 
     return offsets
 
 
-def correlation_with_sync_moving_window(audio1: cp.ndarray, audio2: cp.ndarray) -> cp.ndarray:
-    if audio1.shape[0] > audio2.shape[0]:
-        raise ValueError("audio2 должен быть не короче, чем audio1")
+def correlation_with_async_moving_window_batch(pairs: List[Tuple[xp.ndarray, xp.ndarray]],
+                                               cache: FeatureCache | None = None,
+                                               multiresolution: bool = MULTIRES_ENABLED,
+                                               region: Tuple[int, int] | None = None) -> List[xp.ndarray]:
+    """
+    То же, что correlation_with_async_moving_window, но для нескольких пар (audio1, audio2) за один батч FFT.
+    :return: список результатов correlation_with_async_moving_window в порядке пар
+    """
+    if region is not None:
+        begin, end = region
+        batch = correlation_with_async_moving_window_batch([(audio1[begin:end], audio2[begin:end])
+                                                            for audio1, audio2 in pairs],
+                                                           cache, multiresolution)
+        return [_shift_offsets(offsets, begin) for offsets in batch]
+
+    if multiresolution:
+        return [_correlation_coarse_to_fine(audio1, audio2, cache) for audio1, audio2 in pairs]
+
+    nfft = get_fft_size(WINDOW_BEAT)
+    spectra = [_get_spectra(audio1, audio2, WINDOW_BEAT, nfft, cache) for audio1, audio2 in pairs]
+    peaks = find_correlation_peaks_batch([fragments_spectra for fragments_spectra, _ in spectra],
+                                         [blocks_spectra for _, blocks_spectra in spectra],
+                                         WINDOW_BEAT,
+                                         [len(audio2) for _, audio2 in pairs],
+                                         nfft)
+
+    return [xp.stack((xp.arange(len(audio2_offsets)) * WINDOW_BEAT,
+                      audio2_offsets,
+                      corr_peaks_per_fragment), axis=-1)
+            for audio2_offsets, corr_peaks_per_fragment in peaks]
+
+
+def get_match_corr(audio1: xp.ndarray, audio2: xp.ndarray, offsets: xp.ndarray) -> float:
+    """
+    Коэффициент корреляции Пирсона лучшего фрагмента audio1 с найденным для него окном audio2.
+    В отличие от corr в результате correlation_with_async_moving_window не зависит от громкости,
+    поэтому годится как порог уверенности в найденном смещении.
+    :param offsets: результат correlation_with_async_moving_window для этой пары
+    """
+    offset1, offset2, _ = (int(value) for value in asnumpy(offsets[xp.argmax(offsets[:, 2])]))
+    fragment1 = audio1[offset1:offset1 + WINDOW_BEAT].astype(xp.float64)
+    fragment2 = audio2[offset2:offset2 + WINDOW_BEAT].astype(xp.float64)
+    length = min(len(fragment1), len(fragment2))
+    if length == 0:
+        return 0.0
+
+    fragment1 = fragment1[:length] - fragment1[:length].mean()
+    fragment2 = fragment2[:length] - fragment2[:length].mean()
+    norm = float(xp.linalg.norm(fragment1) * xp.linalg.norm(fragment2))
+    return float(xp.dot(fragment1, fragment2)) / norm if norm > 0 else 0.0
+
+
+def estimate_pair_memory_bytes(audio1_length: int, audio2_length: int) -> int:
+    """
+    Оценивает пиковый объем памяти под спектры и корреляции одной пары в батче.
+    """
+    nfft = get_fft_size(WINDOW_BEAT)
+    num_fragments = max(0, (audio1_length + WINDOW_BEAT - 1) // WINDOW_BEAT - 1)
+    num_blocks = max(1, (audio2_length - 2 * WINDOW_BEAT + nfft + 1) // (nfft - WINDOW_BEAT + 1))
+    spectrum_bytes = (nfft // 2 + 1) * 2 * 4
+
+    # Спектры фрагментов и блоков + произведение спектров и результат irfft для одного блока
+    return (num_fragments + num_blocks) * spectrum_bytes + num_fragments * (spectrum_bytes + nfft * 4)
+
+
+def _correlation_coarse_to_fine(audio1: xp.ndarray,
+                                audio2: xp.ndarray,
+                                cache: FeatureCache | None) -> xp.ndarray:
+    """
+    Ищет смещения фрагментов на прореженном в MULTIRES_DECIMATION раз аудио,
+    затем уточняет MULTIRES_CANDIDATES лучших фрагментов на полной частоте в окне
+    радиусом MULTIRES_REFINE_RADIUS_SECS вокруг грубого смещения.
+    Возвращает строки (offset1, offset2, corr) только для уточненных кандидатов.
+    """
+    if WINDOW_BEAT % MULTIRES_DECIMATION != 0:
+        raise ValueError(f'WINDOW_BEAT ({WINDOW_BEAT}) must be divisible by decimation ({MULTIRES_DECIMATION})')
+
+    coarse_fragment_length = WINDOW_BEAT // MULTIRES_DECIMATION
+    if cache is None:
+        coarse_audio1 = decimate(audio1)
+        coarse_audio2 = decimate(audio2)
+    else:
+        coarse_audio1 = cache.get(audio1, f'decimated_{MULTIRES_DECIMATION}', decimate)
+        coarse_audio2 = cache.get(audio2, f'decimated_{MULTIRES_DECIMATION}', decimate)
+
+    coarse_offsets, coarse_peaks = \
+        _find_fragments_peaks(coarse_audio1, coarse_audio2, coarse_fragment_length, cache)
+
+    radius = int(MULTIRES_REFINE_RADIUS_SECS * RATE)
+    candidates = asnumpy(xp.argsort(-coarse_peaks)[:MULTIRES_CANDIDATES])
+    coarse_offsets = asnumpy(coarse_offsets)
+
+    offsets = []
+    for fragment_idx in candidates:
+        offset1 = int(fragment_idx) * WINDOW_BEAT
+        fragment = audio1[offset1:offset1 + WINDOW_BEAT]
+
+        center = int(coarse_offsets[fragment_idx]) * MULTIRES_DECIMATION
+        window_start = max(0, center - radius)
+        window_end = min(len(audio2), center + radius + WINDOW_BEAT)
 
-    num_seconds = audio1.shape[0] // RATE
-    offsets = cp.arange(num_seconds) * RATE
+        refined_offsets, refined_peaks = batched_correlation_peaks(audio2[window_start:window_end], fragment[None])
+        offsets.append(xp.stack((xp.asarray(offset1, dtype=refined_peaks.dtype),
+                                 refined_offsets[0] + window_start,
+                                 refined_peaks[0])))
 
-    # Создаем массивы для фрагментов
-    fragments1 = cp.array([audio1[i * RATE:(i + 1) * RATE] for i in range(num_seconds)])
-    fragments2 = cp.array([audio2[i * RATE:(i + 1) * RATE] for i in range(num_seconds)])
+    return xp.stack(offsets)
 
-    # Нормализация фрагментов
-    mean1 = fragments1.mean(axis=1, keepdims=True)
-    std1 = fragments1.std(axis=1, keepdims=True)
-    normalized_fragments1 = (fragments1 - mean1) / std1
 
-    mean2 = fragments2.mean(axis=1, keepdims=True)
-    std2 = fragments2.std(axis=1, keepdims=True)
-    normalized_fragments2 = (fragments2 - mean2) / std2
+def _shift_offsets(offsets: xp.ndarray, begin: int) -> xp.ndarray:
+    return offsets + xp.asarray([begin, begin, 0], dtype=offsets.dtype)
+
+
+def decimate(audio: xp.ndarray, factor: int = MULTIRES_DECIMATION) -> xp.ndarray:
+    # Усреднение по блокам служит простым антиалиасинговым фильтром
+    length = len(audio) // factor * factor
+    return audio[:length].reshape(-1, factor).mean(axis=1)
+
+
+def _find_fragments_peaks(audio1: xp.ndarray,
+                          audio2: xp.ndarray,
+                          fragment_length: int,
+                          cache: FeatureCache | None):
+    if cache is None:
+        return batched_correlation_peaks(audio2, _split_to_fragments(audio1, fragment_length))
+
+    nfft = get_fft_size(fragment_length)
+    fragments_spectra, blocks_spectra = _get_spectra(audio1, audio2, fragment_length, nfft, cache)
+
+    return find_correlation_peaks(fragments_spectra, blocks_spectra, fragment_length, len(audio2), nfft)
+
+
+def _get_spectra(audio1: xp.ndarray,
+                 audio2: xp.ndarray,
+                 fragment_length: int,
+                 nfft: int,
+                 cache: FeatureCache | None) -> Tuple[xp.ndarray, xp.ndarray]:
+    if cache is None:
+        return (compute_fragments_spectra(_split_to_fragments(audio1, fragment_length), nfft),
+                compute_blocks_spectra(audio2, fragment_length, nfft))
+
+    fragments_spectra = cache.get(
+        audio1, f'fragments_{fragment_length}_{nfft}',
+        lambda audio: compute_fragments_spectra(_split_to_fragments(audio, fragment_length), nfft))
+    blocks_spectra = cache.get(
+        audio2, f'blocks_{fragment_length}_{nfft}',
+        lambda audio: compute_blocks_spectra(audio, fragment_length, nfft))
+
+    return fragments_spectra, blocks_spectra
+
+
+def _split_to_fragments(audio: xp.ndarray, fragment_length: int) -> xp.ndarray:
+    # Последний, возможно неполный, фрагмент отбрасывается
+    num_fragments = (len(audio) + fragment_length - 1) // fragment_length
+    return audio[:(num_fragments - 1) * fragment_length].reshape(num_fragments - 1, fragment_length)
+
+
+def correlation_with_sync_moving_window(audio1: xp.ndarray, audio2: xp.ndarray) -> xp.ndarray:
+    return correlation_with_sync_moving_window_batch([(audio1, audio2)])[0]
+
+
+def correlation_with_sync_moving_window_batch(pairs: List[Tuple[xp.ndarray, xp.ndarray]]) -> List[xp.ndarray]:
+    """
+    Посекундная нормированная корреляция выровненных аудио для нескольких пар:
+    секунды всех пар независимы, поэтому коррелируются одним батчем.
+    :return: список ndarray (num_seconds, 2) с (offset, max_corr) для каждой пары
+    """
+    normalized_fragments1 = []
+    normalized_fragments2 = []
+    for audio1, audio2 in pairs:
+        if audio1.shape[0] > audio2.shape[0]:
+            raise ValueError("audio2 должен быть не короче, чем audio1")
+
+        num_seconds = audio1.shape[0] // RATE
+
+        # Представления посекундных блоков без копирования
+        fragments1 = audio1[:num_seconds * RATE].reshape(num_seconds, RATE)
+        fragments2 = audio2[:num_seconds * RATE].reshape(num_seconds, RATE)
+
+        # Нормализация фрагментов
+        normalized_fragments1.append(_normalize_fragments(fragments1))
+        normalized_fragments2.append(_normalize_fragments(fragments2))
 
     # Вычисление корреляций и нахождение максимальных значений
-    max_correlations = cp.array([cp.max(cp.correlate(norm_frag1, norm_frag2, mode='full'))
-                                 for norm_frag1, norm_frag2 in zip(normalized_fragments1, normalized_fragments2)])
+    max_correlations = batched_full_correlation_max(xp.concatenate(normalized_fragments1),
+                                                    xp.concatenate(normalized_fragments2))
 
     # Объединение отступов и максимальных значений корреляции
-    results = cp.stack((offsets, max_correlations), axis=-1)
+    results = []
+    start = 0
+    for fragments in normalized_fragments1:
+        num_seconds = fragments.shape[0]
+        results.append(xp.stack((xp.arange(num_seconds) * RATE, max_correlations[start:start + num_seconds]), axis=-1))
+        start += num_seconds
 
     return results
+
+
+def _normalize_fragments(fragments: xp.ndarray) -> xp.ndarray:
+    mean = fragments.mean(axis=1, keepdims=True)
+    std = fragments.std(axis=1, keepdims=True)
+
+    # В тишине std == 0, такие секунды дают нулевую корреляцию вместо NaN
+    std = xp.where(std == 0, 1, std)
+
+    return (fragments - mean) / std
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import weakref
+from collections import OrderedDict
+from typing import Callable
+
+import numpy as np
+
+from config import FEATURE_CACHE_MEMORY_BYTES, FEATURE_CACHE_PATH, FEATURE_CACHE_DISK_BYTES
+from services.backend import xp, asnumpy
+
+
+class FeatureCache:
+    """
+    Кэш признаков эпизода, рассчитываемых один раз и переиспользуемых во всех парах окна SERIES_WINDOW.
+    Ключ - хэш содержимого аудио и параметров признака.
+    Хранится в памяти (LRU с ограничением по объему) и, опционально, на диске с вытеснением самых старых файлов.
+    """
+
+    def __init__(self,
+                 max_memory_bytes: int = FEATURE_CACHE_MEMORY_BYTES,
+                 disk_path: str = FEATURE_CACHE_PATH,
+                 max_disk_bytes: int = FEATURE_CACHE_DISK_BYTES):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_path = disk_path
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory: OrderedDict[str, xp.ndarray] = OrderedDict()
+        self._memory_bytes = 0
+        self._content_keys: dict[int, tuple[weakref.ref, str]] = {}
+
+        if self.disk_path:
+            os.makedirs(self.disk_path, exist_ok=True)
+
+    def get(self, audio: xp.ndarray, feature: str, compute: Callable[[xp.ndarray], xp.ndarray]) -> xp.ndarray:
+        """
+        Возвращает признак feature для audio, рассчитывая его через compute только при промахе кэша.
+        :param audio: аудио эпизода
+        :param feature: имя признака вместе с параметрами, например 'fragments_2646000'
+        :param compute: функция расчета признака по аудио
+        """
+        key = f'{self._get_content_key(audio)}_{feature}'
+
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+        value = self._load_from_disk(key)
+        if value is None:
+            value = compute(audio)
+            self._save_to_disk(key, value)
+
+        self._put_to_memory(key, value)
+        return value
+
+    def clear(self):
+        self._memory.clear()
+        self._memory_bytes = 0
+        self._content_keys.clear()
+
+    def _get_content_key(self, audio: xp.ndarray) -> str:
+        # Хэш содержимого считается один раз на объект массива
+        cached = self._content_keys.get(id(audio))
+        if cached is not None and cached[0]() is audio:
+            return cached[1]
+
+        host_audio = np.ascontiguousarray(asnumpy(audio))
+        digest = hashlib.blake2b(host_audio.view(np.uint8), digest_size=16)
+        digest.update(f'{host_audio.dtype.str}_{host_audio.shape}'.encode())
+        key = digest.hexdigest()
+
+        audio_id = id(audio)
+
+        def forget(ref):
+            if self._content_keys.get(audio_id, (None,))[0] is ref:
+                del self._content_keys[audio_id]
+
+        try:
+            self._content_keys[audio_id] = (weakref.ref(audio, forget), key)
+        except TypeError:
+            # Массив не поддерживает слабые ссылки, хэш будет пересчитан при следующем обращении
+            pass
+
+        return key
+
+    def _put_to_memory(self, key: str, value: xp.ndarray):
+        if value.nbytes > self.max_memory_bytes:
+            return
+
+        self._memory[key] = value
+        self._memory_bytes += value.nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def _load_from_disk(self, key: str) -> xp.ndarray | None:
+        if not self.disk_path:
+            return None
+
+        path = os.path.join(self.disk_path, f'{key}.npy')
+        if not os.path.exists(path):
+            return None
+
+        os.utime(path)
+        return xp.asarray(np.load(path))
+
+    def _save_to_disk(self, key: str, value: xp.ndarray):
+        if not self.disk_path:
+            return
+
+        path = os.path.join(self.disk_path, f'{key}.npy')
+        np.save(path, asnumpy(value))
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = [entry for entry in os.scandir(self.disk_path) if entry.name.endswith('.npy')]
+        total_bytes = sum(entry.stat().st_size for entry in entries)
+        if total_bytes <= self.max_disk_bytes:
+            return
+
+        # Вытесняем файлы, к которым дольше всего не обращались
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if total_bytes <= self.max_disk_bytes:
+                break
+            total_bytes -= entry.stat().st_size
+            os.remove(entry.path)
@@ -0,0 +1,165 @@
+from typing import List, Tuple
+
+from services.backend import xp, rfft, irfft, next_fast_len
+
+
+def get_fft_size(fragment_length: int) -> int:
+    """
+    Размер FFT для overlap-save: не меньше двух длин фрагмента, чтобы на каждый блок
+    приходилось хотя бы fragment_length валидных отсчетов корреляции.
+    """
+    return next_fast_len(2 * fragment_length)
+
+
+def compute_fragments_spectra(fragments: xp.ndarray, nfft: int) -> xp.ndarray:
+    """
+    Считает спектры фрагментов одним батчем.
+    :param fragments: ndarray (num_fragments, fragment_length)
+    :param nfft: размер FFT
+    :return: ndarray (num_fragments, nfft // 2 + 1), комплексно-сопряженные спектры
+    """
+    return xp.conj(rfft(fragments, n=nfft, axis=-1))
+
+
+def compute_blocks_spectra(audio: xp.ndarray, fragment_length: int, nfft: int) -> xp.ndarray:
+    """
+    Разбивает audio на перекрывающиеся блоки длиной nfft с шагом nfft - fragment_length + 1
+    (overlap-save) и считает их спектры одним батчем. Блоки - представление дополненного нулями аудио
+    без копирования перекрытий.
+    :return: ndarray (num_blocks, nfft // 2 + 1)
+    """
+    if len(audio) < fragment_length:
+        raise ValueError(f'Audio of length {len(audio)} is shorter than fragment of length {fragment_length}')
+
+    step = nfft - fragment_length + 1
+    num_valid = len(audio) - fragment_length + 1
+    num_blocks = (num_valid + step - 1) // step
+
+    padded = xp.zeros((num_blocks - 1) * step + nfft, dtype=audio.dtype)
+    padded[:len(audio)] = audio
+    blocks = xp.lib.stride_tricks.sliding_window_view(padded, nfft)[::step]
+
+    return rfft(blocks, n=nfft, axis=-1)
+
+
+def find_correlation_peaks(fragments_spectra: xp.ndarray,
+                           blocks_spectra: xp.ndarray,
+                           fragment_length: int,
+                           audio_length: int,
+                           nfft: int,
+                           scale: xp.ndarray | None = None) -> Tuple[xp.ndarray, xp.ndarray]:
+    """
+    Рассчитывает корреляцию в режиме 'valid' каждого фрагмента со всем аудио и возвращает только пики,
+    не материализуя матрицу (num_fragments, audio_length).
+    :param scale: множители корреляции по смещениям в аудио (длиной audio_length - fragment_length + 1),
+      применяются до поиска максимума - например, обратные нормы окон аудио для нормированной корреляции
+    :return: (offsets, peaks) - смещения максимума корреляции в аудио и значения максимума для каждого фрагмента
+    """
+    return find_correlation_peaks_batch([fragments_spectra], [blocks_spectra], fragment_length, [audio_length], nfft,
+                                        None if scale is None else [scale])[0]
+
+
+def find_correlation_peaks_batch(fragments_spectra: List[xp.ndarray],
+                                 blocks_spectra: List[xp.ndarray],
+                                 fragment_length: int,
+                                 audio_lengths: List[int],
+                                 nfft: int,
+                                 scales: List[xp.ndarray] | None = None) -> List[Tuple[xp.ndarray, xp.ndarray]]:
+    """
+    То же, что find_correlation_peaks, но сразу для нескольких пар (фрагменты audio1, блоки audio2):
+    i-е блоки всех пар обрабатываются одним вызовом irfft.
+    :param scales: множители корреляции по смещениям для каждой пары (см. find_correlation_peaks)
+    :return: список (offsets, peaks) для каждой пары
+    """
+    step = nfft - fragment_length + 1
+    counts = [spectra.shape[0] for spectra in fragments_spectra]
+    num_valid = [audio_length - fragment_length + 1 for audio_length in audio_lengths]
+    total = sum(counts)
+
+    best_offsets = xp.zeros(total, dtype=xp.int64)
+    best_peaks = xp.full(total, -xp.inf, dtype=xp.float64)
+    positions = xp.arange(step)
+    for i in range(max(spectra.shape[0] for spectra in blocks_spectra)):
+        products = []
+        rows = []
+        block_valid = []
+        block_scales = []
+        start = 0
+        for fragments, blocks, count, valid, scale in zip(fragments_spectra, blocks_spectra, counts, num_valid,
+                                                          scales or [None] * len(counts)):
+            if blocks.shape[0] > i:
+                products.append(fragments * blocks[i])
+                rows.append(xp.arange(start, start + count))
+                block_valid.append((count, min(step, valid - i * step)))
+                if scale is not None:
+                    block_scale = xp.zeros(step, dtype=xp.float64)
+                    block_scale[:len(scale[i * step:(i + 1) * step])] = scale[i * step:(i + 1) * step]
+                    block_scales.append(xp.broadcast_to(block_scale, (count, step)))
+            start += count
+
+        rows = xp.concatenate(rows)
+        corr = irfft(xp.concatenate(products), n=nfft, axis=-1)[:, :step]
+        if scales is not None:
+            corr = corr * xp.concatenate(block_scales)
+        # Последний блок пары валиден не целиком - исключаем его хвост из поиска максимума
+        if min(valid for _, valid in block_valid) < step:
+            block_valid = xp.asarray(
+                [valid for count, valid in block_valid for _ in range(count)])
+            corr = xp.where(positions[None, :] < block_valid[:, None], corr, -xp.inf)
+
+        block_offsets = xp.argmax(corr, axis=1)
+        block_peaks = corr[xp.arange(corr.shape[0]), block_offsets]
+
+        is_better = block_peaks > best_peaks[rows]
+        best_offsets[rows] = xp.where(is_better, block_offsets + i * step, best_offsets[rows])
+        best_peaks[rows] = xp.where(is_better, block_peaks, best_peaks[rows])
+
+    bounds = [0]
+    for count in counts:
+        bounds.append(bounds[-1] + count)
+
+    return [(best_offsets[begin:end], best_peaks[begin:end]) for begin, end in zip(bounds[:-1], bounds[1:])]
+
+
+def batched_correlation_peaks(audio: xp.ndarray, fragments: xp.ndarray) -> Tuple[xp.ndarray, xp.ndarray]:
+    """
+    Коррелирует все фрагменты одинаковой длины с audio в одном батче rfft/irfft.
+    Аналог argmax/max от cp.correlate(audio, fragment, mode='valid') для каждого фрагмента.
+    """
+    fragment_length = fragments.shape[1]
+    nfft = get_fft_size(fragment_length)
+
+    fragments_spectra = compute_fragments_spectra(fragments, nfft)
+    blocks_spectra = compute_blocks_spectra(audio, fragment_length, nfft)
+
+    return find_correlation_peaks(fragments_spectra, blocks_spectra, fragment_length, len(audio), nfft)
+
+
+def batched_full_correlation_max(fragments1: xp.ndarray,
+                                 fragments2: xp.ndarray,
+                                 batch_size: int = 64) -> xp.ndarray:
+    """
+    Аналог max(cp.correlate(fragment1, fragment2, mode='full')) для каждой пары строк,
+    рассчитанный батчами FFT.
+    :param fragments1: ndarray (num_fragments, fragment_length)
+    :param fragments2: ndarray (num_fragments, fragment_length)
+    :param batch_size: количество строк в одном батче, ограничивает потребление памяти
+    :return: ndarray (num_fragments,)
+    """
+    fragment_length = fragments1.shape[1]
+    nfft = next_fast_len(2 * fragment_length - 1)
+
+    max_correlations = []
+    for i in range(0, fragments1.shape[0], batch_size):
+        spectra1 = rfft(fragments1[i:i + batch_size], n=nfft, axis=-1)
+        spectra2 = rfft(fragments2[i:i + batch_size], n=nfft, axis=-1)
+        corr = irfft(spectra1 * xp.conj(spectra2), n=nfft, axis=-1)
+
+        # Неотрицательные сдвиги лежат в начале, отрицательные - в конце циклической корреляции
+        max_correlations.append(xp.maximum(corr[:, :fragment_length].max(axis=1),
+                                           corr[:, nfft - fragment_length + 1:].max(axis=1)))
+
+    if not max_correlations:
+        return xp.zeros(0, dtype=fragments1.dtype)
+
+    return xp.concatenate(max_correlations)
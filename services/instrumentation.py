@@ -0,0 +1,165 @@
+"""
+Замеры этапов конвейера: время (настенное и процессорное), обработанные байты и пары, пиковая память.
+Включается непустым config.INSTRUMENTATION_PATH (переменная окружения AOR_INSTRUMENTATION_PATH).
+Каждый процесс пишет в этот каталог:
+  trace-{run_id}.jsonl - запись на каждый завершенный этап,
+  aor-{run_id}.prom - накопленные метрики в текстовом формате Prometheus (для node_exporter textfile collector).
+Выключенные замеры сводятся к проверке флага и возврату общего пустого контекста.
+
+Пример:
+    with stage('sync_window', pairs=len(pairs)) as s:
+        ...
+        s.add(bytes=audio.nbytes)
+"""
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from config import INSTRUMENTATION_PATH
+
+try:
+    import resource
+except ImportError:
+    # На Windows модуля resource нет, пиковая память не замеряется
+    resource = None
+
+METRICS = ('wall_seconds', 'cpu_seconds', 'bytes', 'pairs', 'calls')
+
+
+class _NoopStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, bytes: int = 0, pairs: int = 0):
+        pass
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+class _Stage:
+    def __init__(self, recorder: '_Recorder', name: str, bytes: int, pairs: int, labels: dict):
+        self.recorder = recorder
+        self.name = name
+        self.bytes = bytes
+        self.pairs = pairs
+        self.labels = labels
+
+    def __enter__(self):
+        _synchronize_device()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        _synchronize_device()
+        self.recorder.record(self.name,
+                             time.perf_counter() - self.wall_start,
+                             time.process_time() - self.cpu_start,
+                             self.bytes, self.pairs, self.labels, exc_type is None)
+        return False
+
+    def add(self, bytes: int = 0, pairs: int = 0):
+        self.bytes += bytes
+        self.pairs += pairs
+
+
+class _Recorder:
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.run_id = f'{socket.gethostname()}-{os.getpid()}-{int(time.time())}'
+        self.trace_path = os.path.join(path, f'trace-{self.run_id}.jsonl')
+        self.prometheus_path = os.path.join(path, f'aor-{self.run_id}.prom')
+        self.totals = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+        self.lock = threading.Lock()
+        self.trace = open(self.trace_path, 'a', encoding='utf-8')
+
+    def record(self, name: str, wall: float, cpu: float, bytes: int, pairs: int, labels: dict, ok: bool):
+        event = {'ts': time.time(), 'run_id': self.run_id, 'stage': name,
+                 'wall_seconds': round(wall, 6), 'cpu_seconds': round(cpu, 6),
+                 'bytes': bytes, 'pairs': pairs,
+                 'pairs_per_second': round(pairs / wall, 3) if pairs and wall > 0 else None,
+                 'peak_memory_bytes': get_peak_memory_bytes(), 'ok': ok, **labels}
+        with self.lock:
+            totals = self.totals[name]
+            totals['wall_seconds'] += wall
+            totals['cpu_seconds'] += cpu
+            totals['bytes'] += bytes
+            totals['pairs'] += pairs
+            totals['calls'] += 1
+            self.trace.write(json.dumps(event) + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.trace.flush()
+            lines = []
+            for metric in METRICS:
+                lines.append(f'# TYPE aor_stage_{metric}_total counter')
+                lines += [f'aor_stage_{metric}_total{{stage="{name}",run_id="{self.run_id}"}} {totals[metric]}'
+                          for name, totals in sorted(self.totals.items())]
+            lines.append('# TYPE aor_stage_pairs_per_second gauge')
+            lines += [f'aor_stage_pairs_per_second{{stage="{name}",run_id="{self.run_id}"}} '
+                      f'{totals["pairs"] / totals["wall_seconds"]}'
+                      for name, totals in sorted(self.totals.items())
+                      if totals['pairs'] and totals['wall_seconds'] > 0]
+            peak_memory = get_peak_memory_bytes()
+            if peak_memory is not None:
+                lines.append('# TYPE aor_peak_memory_bytes gauge')
+                lines.append(f'aor_peak_memory_bytes{{run_id="{self.run_id}"}} {peak_memory}')
+
+            # Запись через временный файл, чтобы коллектор не прочитал файл наполовину
+            with open(f'{self.prometheus_path}.tmp', 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(f'{self.prometheus_path}.tmp', self.prometheus_path)
+
+
+_recorder: _Recorder | None = None
+
+
+def stage(name: str, bytes: int = 0, pairs: int = 0, **labels):
+    """
+    Контекст замера этапа name. bytes и pairs можно передать сразу или добавить внутри контекста через add().
+    Дополнительные labels попадают в запись трассы (например, series_id).
+    """
+    if not INSTRUMENTATION_PATH:
+        return _NOOP_STAGE
+    return _Stage(_get_recorder(), name, bytes, pairs, labels)
+
+
+def flush():
+    """
+    Сбрасывает трассу и переписывает файл Prometheus. Вызывается после каждого сериала:
+    процессы пулов завершаются без atexit.
+    """
+    if _recorder is not None:
+        _recorder.flush()
+
+
+def get_peak_memory_bytes() -> int | None:
+    if resource is None:
+        return None
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def _get_recorder() -> _Recorder:
+    global _recorder
+    if _recorder is None:
+        _recorder = _Recorder(INSTRUMENTATION_PATH)
+        atexit.register(flush)
+    return _recorder
+
+
+def _synchronize_device():
+    # Ядра GPU выполняются асинхронно; без синхронизации их время досталось бы следующему этапу
+    from services.backend import xp, is_gpu
+    if is_gpu:
+        xp.cuda.Device().synchronize()
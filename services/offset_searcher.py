@@ -1,51 +1,126 @@
-import numpy as np
-from scipy.stats import gaussian_kde
-
+from typing import Dict, List, Sequence, Tuple
 
-def find_true_offset(offsets: list[float]) -> float:
-    # Добавление небольшого случайного смещения к данным для предотвращения сингулярности
-    random_noise = np.random.normal(0, 0.01, len(offsets))
-    data_with_noise = [d + noise for d, noise in zip(offsets, random_noise)]
-
-    kde = gaussian_kde(data_with_noise)
+import numpy as np
 
-    grid = np.linspace(min(data_with_noise) - 1, max(data_with_noise) + 1, 1000)
-    density = kde(grid)
+from config import OFFSET_SOLVER_RELATIVE_WEIGHT, OFFSET_SOLVER_ITERATIONS, OFFSET_SOLVER_MIN_SCALE_SECS
 
-    most_likely_value = grid[np.argmax(density)]
+# Константа биквадратной функции Тьюки: невязки дальше TUKEY_C масштабов получают нулевой вес (выбросы)
+TUKEY_C = 4.685
+# Вес слабой привязки эпизода к начальному приближению: определяет решение, если все наблюдения эпизода - выбросы
+ANCHOR_WEIGHT = 1e-6
 
-    return float(most_likely_value)
+Pair = Tuple[str, str]
 
 
-def find_true_offsets_kde(offsets_by_audio: dict[str, list[tuple[float, float]]]) -> dict[str, tuple[float, float]]:
+def solve_true_offsets(offsets_by_pair: Dict[Pair, Sequence[float]],
+                       offsets_by_audio: Dict[str, List[Tuple[float, float]]] | None = None
+                       ) -> Tuple[Dict[str, Tuple[float, float]], Dict[str, float]]:
     """
-    Находит наиболее вероятные смещения для каждого файла.
+    Согласует опенинги всех эпизодов сериала одним робастным взвешенным МНК.
+    Каждая пара с найденным опенингом дает наблюдения начала и конца в обоих эпизодах и относительное
+    ограничение: начало во втором эпизоде минус начало в первом равно разности найденных смещений (так же для конца).
+    Начала и концы решаются независимо, итерациями взвешенного МНК с весами Тьюки: выбросы получают нулевой вес.
+    Начальное приближение - медианы наблюдений эпизодов; результат детерминирован.
+    :param offsets_by_pair: (file1, file2) -> (begin1, end1, begin2, end2); нулевой end1 - опенинг не найден
+    :param offsets_by_audio: дополнительные наблюдения (begin, end) отдельных эпизодов, например из библиотеки опенингов
+    :return: (offsets, confidence) - (begin, end) по эпизодам и доля наблюдений эпизода, согласных с решением
+      (от 0 до 1, меньшая из долей для начала и конца)
     """
-    true_offsets_by_audio: dict[str, tuple[float, float]] = {}
-    for file, offsets in offsets_by_audio.items():
-        start_offsets = [offset[0] for offset in offsets if offset[1] != 0]
-        end_offsets = [offset[1] for offset in offsets if offset[1] != 0]
-
-        start_offset = find_true_offset(start_offsets)
-        end_offset = find_true_offset(end_offsets)
-
-        true_offsets_by_audio[file] = (start_offset, end_offset)
-
-    return true_offsets_by_audio
-
-
-def find_true_offsets(offsets_by_audio: dict[str, list[tuple[float, float]]]) -> dict[str, tuple[float, float]]:
+    pairs = [(pair, opening) for pair, opening in offsets_by_pair.items() if opening is not None and opening[1] != 0]
+    singles = [(file, opening) for file, openings in (offsets_by_audio or {}).items()
+               for opening in openings if opening[1] != 0]
+
+    files = sorted({file for pair, _ in pairs for file in pair} | {file for file, _ in singles})
+    if not files:
+        return {}, {}
+    index = {file: i for i, file in enumerate(files)}
+
+    # Абсолютные наблюдения: эпизод и (begin, end)
+    observed_files = np.array([index[file1] for (file1, _), _ in pairs]
+                              + [index[file2] for (_, file2), _ in pairs]
+                              + [index[file] for file, _ in singles], dtype=np.int64)
+    observed = np.array([opening[:2] for _, opening in pairs]
+                        + [opening[2:4] for _, opening in pairs]
+                        + [opening[:2] for _, opening in singles], dtype=np.float64).reshape(-1, 2)
+
+    # Относительные наблюдения: x[file2] - x[file1]
+    first = np.array([index[file1] for (file1, _), _ in pairs], dtype=np.int64)
+    second = np.array([index[file2] for (_, file2), _ in pairs], dtype=np.int64)
+    relative = np.array([(opening[2] - opening[0], opening[3] - opening[1]) for _, opening in pairs],
+                        dtype=np.float64).reshape(-1, 2)
+
+    initial = _group_medians(observed_files, observed, len(files))
+
+    num_observed, num_relative, num_files = len(observed), len(relative), len(files)
+    matrix = np.zeros((num_observed + num_relative + num_files, num_files))
+    matrix[np.arange(num_observed), observed_files] = 1
+    matrix[num_observed + np.arange(num_relative), first] = -1
+    matrix[num_observed + np.arange(num_relative), second] = 1
+    matrix[num_observed + num_relative + np.arange(num_files), np.arange(num_files)] = 1
+    targets = np.concatenate((observed, relative, initial))
+    base_weights = np.concatenate((np.ones(num_observed),
+                                   np.full(num_relative, OFFSET_SOLVER_RELATIVE_WEIGHT),
+                                   np.full(num_files, ANCHOR_WEIGHT)))
+
+    solution = np.empty((num_files, 2))
+    robust_weights = np.empty((len(targets), 2))
+    for column in range(2):
+        solution[:, column], robust_weights[:, column] = \
+            _solve_irls(matrix, targets[:, column], base_weights, initial[:, column], num_observed + num_relative)
+
+    # Доля абсолютных наблюдений эпизода, не отброшенных как выбросы (с учетом весов Тьюки)
+    counts = np.bincount(observed_files, minlength=num_files)
+    inliers = np.stack([np.bincount(observed_files, robust_weights[:num_observed, column], minlength=num_files)
+                        for column in range(2)], axis=-1)
+    confidence = np.min(inliers, axis=1) / np.maximum(counts, 1)
+
+    offsets = {file: (float(solution[i, 0]), float(solution[i, 1])) for file, i in index.items()}
+    return offsets, {file: float(confidence[i]) for file, i in index.items()}
+
+
+def _solve_irls(matrix: np.ndarray,
+                targets: np.ndarray,
+                base_weights: np.ndarray,
+                initial: np.ndarray,
+                num_constraints: int) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Находит наиболее вероятные смещения для каждого файла.
+    :return: (решение, веса Тьюки строк) - веса строк привязки равны 1
     """
-    true_offsets_by_audio: dict[str, tuple[float, float]] = {}
-    for file, offsets in offsets_by_audio.items():
-        start_offsets = [offset[0] for offset in offsets if offset[1] != 0]
-        end_offsets = [offset[1] for offset in offsets if offset[1] != 0]
-
-        start_median = np.median(start_offsets)
-        end_median = np.median(end_offsets)
-
-        true_offsets_by_audio[file] = (start_median, end_median)
-
-    return true_offsets_by_audio
+    solution = initial
+    robust = np.ones(len(targets))
+    for _ in range(OFFSET_SOLVER_ITERATIONS):
+        # Невязки нормированы на точность строк, масштаб - MAD по строкам-ограничениям, еще не признанным выбросами
+        residuals = (matrix @ solution - targets) * np.sqrt(base_weights)
+        constraint_residuals = np.abs(residuals[:num_constraints])
+        active = robust[:num_constraints] > 0
+        scale = 1.4826 * float(np.median(constraint_residuals[active])) if active.any() else 0.0
+        scale = max(scale, OFFSET_SOLVER_MIN_SCALE_SECS)
+
+        u = residuals / (TUKEY_C * scale)
+        robust = np.where(np.abs(u) < 1, (1 - u ** 2) ** 2, 0.0)
+        robust[num_constraints:] = 1
+
+        sqrt_weights = np.sqrt(base_weights * robust)
+        previous = solution
+        solution = np.linalg.lstsq(matrix * sqrt_weights[:, None], targets * sqrt_weights, rcond=None)[0]
+        if np.max(np.abs(solution - previous)) < 1e-6:
+            break
+
+    return solution, robust
+
+
+def _group_medians(groups: np.ndarray, values: np.ndarray, num_groups: int) -> np.ndarray:
+    """
+    Медианы столбцов values по группам одной сортировкой. Группы без значений получают 0.
+    """
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    low = starts + (counts - 1) // 2
+    high = starts + counts // 2
+
+    medians = np.zeros((num_groups, values.shape[1]))
+    has_values = counts > 0
+    for column in range(values.shape[1]):
+        sorted_values = values[np.lexsort((values[:, column], groups)), column]
+        medians[has_values, column] = (sorted_values[low[has_values]] + sorted_values[high[has_values]]) / 2
+    return medians
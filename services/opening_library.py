@@ -0,0 +1,164 @@
+import json
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from config import RATE, MULTIRES_DECIMATION, OPENING_TEMPLATE_SECS, OPENING_LIBRARY_MIN_CORR
+from services.audio_loader import LazyAudio
+from services.backend import xp, asnumpy
+from services.correlator import decimate
+from services.fft_correlator import (compute_blocks_spectra, compute_fragments_spectra, find_correlation_peaks,
+                                     get_fft_size)
+
+INDEX_FILENAME = 'index.json'
+# Окна эпизода тише этой доли самого громкого окна не сравниваются с шаблонами
+SILENCE_RATIO = 1e-4
+
+
+class OpeningLibrary:
+    """
+    Библиотека подтвержденных опенингов. Для каждого опенинга хранится шаблон - первые OPENING_TEMPLATE_SECS секунд
+    аудио опенинга, прореженные в MULTIRES_DECIMATION раз и нормированные (нулевое среднее, единичная норма).
+    Эпизод сравнивается со всеми шаблонами одним батчем FFT; корреляция шаблона с окном эпизода, деленная
+    на норму окна, равна коэффициенту корреляции Пирсона. Максимум ищется по нормированной кривой,
+    иначе громкий участок эпизода перевешивает настоящий опенинг.
+    Каталог библиотеки: index.json со списком шаблонов и {series_id}_{episode}.npy с шаблонами.
+    """
+
+    def __init__(self, path: str, decimation: int = MULTIRES_DECIMATION, template_secs: int = OPENING_TEMPLATE_SECS):
+        self.path = path
+        self.decimation = decimation
+        self.template_length = template_secs * RATE // decimation
+        self.entries: List[dict] = []
+        self._templates: xp.ndarray | None = None
+        self._spectra: xp.ndarray | None = None
+
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_FILENAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index['decimation'] != decimation or index['template_length'] != self.template_length:
+                raise ValueError(f'Opening library {path} was built with other parameters: {index}')
+            self.entries = index['entries']
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, series_id: int, episode: str, audio: np.ndarray, begin_secs: float, end_secs: float) -> bool:
+        """
+        Добавляет опенинг эпизода в библиотеку (заменяя шаблон того же эпизода).
+        :param audio: аудио эпизода с частотой RATE
+        :param begin_secs: начало опенинга в audio
+        :param end_secs: конец опенинга в audio
+        :return: False, если опенинг короче шаблона и не добавлен
+        """
+        begin = int(begin_secs * RATE) // self.decimation
+        coarse = asnumpy(decimate(xp.asarray(audio, dtype=xp.float32), self.decimation))
+        template = coarse[begin:begin + self.template_length].astype(np.float32)
+        if (end_secs - begin_secs) * RATE // self.decimation < self.template_length \
+                or len(template) < self.template_length:
+            return False
+
+        template = template - template.mean()
+        norm = np.linalg.norm(template)
+        if norm == 0:
+            return False
+
+        filename = f'{series_id}_{episode}.npy'
+        np.save(os.path.join(self.path, filename), template / norm)
+        self.entries = [entry for entry in self.entries if entry['filename'] != filename]
+        self.entries.append({'series_id': series_id, 'episode': episode, 'filename': filename,
+                             'length_secs': float(end_secs - begin_secs)})
+        self._templates = None
+        self._spectra = None
+        return True
+
+    def save(self):
+        index = {'decimation': self.decimation, 'template_length': self.template_length, 'entries': self.entries}
+        index_path = os.path.join(self.path, INDEX_FILENAME)
+        with open(f'{index_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(f'{index_path}.tmp', index_path)
+
+    def match(self, audio: xp.ndarray, batch_size: int = 128) -> Tuple[float, float, float, dict] | None:
+        """
+        Ищет в аудио эпизода опенинг из библиотеки.
+        :param audio: аудио эпизода с частотой RATE
+        :param batch_size: количество шаблонов в одном батче FFT, ограничивает потребление памяти
+        :return: (begin_secs, end_secs, corr, entry) для лучшего шаблона или None,
+          если корреляция ниже OPENING_LIBRARY_MIN_CORR
+        """
+        coarse = decimate(audio, self.decimation)
+        if not self.entries or len(coarse) < self.template_length:
+            return None
+
+        templates, spectra = self._get_spectra()
+        nfft = get_fft_size(self.template_length)
+        blocks_spectra = compute_blocks_spectra(coarse, self.template_length, nfft)
+        scale = self._get_inverse_window_norms(coarse)
+
+        offsets = []
+        peaks = []
+        for i in range(0, len(templates), batch_size):
+            batch_offsets, batch_peaks = find_correlation_peaks(
+                spectra[i:i + batch_size], blocks_spectra, self.template_length, len(coarse), nfft, scale)
+            offsets.append(batch_offsets)
+            peaks.append(batch_peaks)
+        offsets = xp.concatenate(offsets)
+        corr = asnumpy(xp.concatenate(peaks))
+
+        best = int(np.argmax(corr))
+        if corr[best] < OPENING_LIBRARY_MIN_CORR:
+            return None
+
+        entry = self.entries[best]
+        begin_secs = int(asnumpy(offsets[best])) * self.decimation / RATE
+        return begin_secs, begin_secs + entry['length_secs'], float(corr[best]), entry
+
+    def _get_inverse_window_norms(self, coarse: xp.ndarray) -> xp.ndarray:
+        """
+        Обратные нормы всех окон эпизода длиной в шаблон за вычетом их среднего. Шаблон имеет нулевое среднее,
+        поэтому среднее окна на скалярное произведение не влияет. Почти тихие окна (норма меньше SILENCE_RATIO
+        от наибольшей) получают 0: их нормы - в основном ошибка округления накопленных сумм.
+        """
+        coarse = coarse.astype(xp.float64)
+        sums = xp.concatenate((xp.zeros(1), xp.cumsum(coarse)))
+        squares = xp.concatenate((xp.zeros(1), xp.cumsum(coarse * coarse)))
+        window_sums = sums[self.template_length:] - sums[:-self.template_length]
+        window_squares = squares[self.template_length:] - squares[:-self.template_length]
+        window_norms = xp.sqrt(xp.maximum(window_squares - window_sums ** 2 / self.template_length, 0))
+        is_audible = window_norms > xp.max(window_norms) * SILENCE_RATIO
+        return xp.where(is_audible, 1 / xp.where(is_audible, window_norms, 1), 0)
+
+    def _get_spectra(self) -> Tuple[xp.ndarray, xp.ndarray]:
+        if self._spectra is None:
+            self._templates = xp.asarray(np.stack([np.load(os.path.join(self.path, entry['filename']))
+                                                   for entry in self.entries]))
+            self._spectra = compute_fragments_spectra(self._templates, get_fft_size(self.template_length))
+        return self._templates, self._spectra
+
+
+def find_offsets_by_library(files: List[LazyAudio], library: OpeningLibrary | None) -> Dict[str, Tuple[float, float]]:
+    """
+    Ищет в эпизодах опенинги из библиотеки одним сравнением эпизода со всеми шаблонами.
+    Эпизоды, в которых опенинг найден, не участвуют в попарном поиске.
+    Аудио загружается по одному эпизоду; нормировать его не нужно - match считает корреляцию Пирсона.
+    :return: filename -> (begin_secs, end_secs)
+    """
+    offsets = {}
+    if library is None or len(library) == 0:
+        return offsets
+
+    for file in files:
+        match = library.match(xp.asarray(file.load(), dtype=xp.float32))
+        if match is None:
+            continue
+
+        start_secs, end_secs, corr, entry = match
+        print(f'{file.filename}: opening of {entry["series_id"]}/{entry["episode"]} found in library '
+              f'({start_secs:.3f}, {end_secs:.3f}, corr {corr:.2f})')
+        offsets[file.filename] = (start_secs, end_secs)
+
+    return offsets
@@ -0,0 +1,113 @@
+import json
+import os
+from typing import Iterable, List, Tuple
+
+from config import (RATE, WINDOW, SERIES_WINDOW, MULTIRES_ENABLED, MULTIRES_DECIMATION, MULTIRES_CANDIDATES,
+                    MULTIRES_REFINE_RADIUS_SECS, PAIR_SCHEDULER_ENABLED, PAIR_SCHEDULER_CONSENSUS,
+                    PAIR_SCHEDULER_TOLERANCE_SECS, PAIR_SCHEDULER_MAX_WINDOW)
+from services.audio_loader import LazyAudio
+
+Pair = Tuple[str, str]
+
+
+def get_ledger_path(ledgers_dir: str, series_id: int) -> str:
+    return os.path.join(ledgers_dir, f'{series_id}.json')
+
+
+def get_window_pairs(files: List[LazyAudio]) -> List[Pair]:
+    """
+    Все пары эпизодов в пределах окна SERIES_WINDOW, в том же порядке, что и generate_pairs.
+    """
+    filenames = [file.filename for file in sorted(files, key=lambda x: int(x.filename.split('.')[0]))]
+    return [(filenames[i], filenames[j])
+            for i in range(len(filenames) - 1)
+            for j in range(i + 1, min(len(filenames), i + SERIES_WINDOW))]
+
+
+def get_config_fingerprint() -> dict:
+    """
+    Параметры, от которых зависит результат корреляции пары. При их изменении все пары считаются заново.
+    """
+    return {'rate': RATE, 'window': WINDOW, 'series_window': SERIES_WINDOW,
+            'multires_enabled': MULTIRES_ENABLED, 'multires_decimation': MULTIRES_DECIMATION,
+            'multires_candidates': MULTIRES_CANDIDATES, 'multires_refine_radius_secs': MULTIRES_REFINE_RADIUS_SECS}
+
+
+def get_scheduler_fingerprint() -> dict:
+    """
+    Параметры выбора пар (services.pair_scheduler). Результаты пар от них не зависят, но от них зависит,
+    какие пары посчитаны, поэтому при их изменении сериал пересчитывается с переиспользованием посчитанных пар.
+    Журналы без этого поля записаны без планировщика.
+    """
+    if not PAIR_SCHEDULER_ENABLED:
+        return {'enabled': False}
+    return {'enabled': True, 'consensus': PAIR_SCHEDULER_CONSENSUS, 'tolerance_secs': PAIR_SCHEDULER_TOLERANCE_SECS,
+            'max_window': PAIR_SCHEDULER_MAX_WINDOW}
+
+
+def get_file_signature(file: LazyAudio) -> List[int]:
+    stat = os.stat(file.path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class PairLedger:
+    """
+    Журнал сериала: какие пары эпизодов уже скоррелированы, с какими параметрами и по каким версиям файлов.
+    Версия файла - размер и время изменения. Пара переиспользуется, если параметры не менялись
+    и оба ее файла остались прежними; остальные пары (с новыми или измененными эпизодами) считаются заново.
+    Для каждой пары можно хранить небольшой результат (например, найденные границы опенинга).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.config = None
+        self.scheduler = None
+        self.episodes: dict[str, List[int]] = {}
+        self.pairs: dict[Pair, object] = {}
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                ledger = json.load(f)
+            self.config = ledger['config']
+            self.scheduler = ledger.get('scheduler', {'enabled': False})
+            self.episodes = ledger['episodes']
+            self.pairs = {(pair['file1'], pair['file2']): pair.get('result') for pair in ledger['pairs']}
+
+    def exists(self) -> bool:
+        return self.config is not None
+
+    def get_unchanged_pairs(self, files: List[LazyAudio]) -> set[Pair]:
+        """
+        Пары журнала, которые можно не пересчитывать для текущего набора файлов.
+        """
+        if self.config != get_config_fingerprint():
+            return set()
+
+        unchanged_files = {file.filename for file in files
+                           if self.episodes.get(file.filename) == get_file_signature(file)}
+        return {pair for pair in self.pairs if pair[0] in unchanged_files and pair[1] in unchanged_files}
+
+    def is_up_to_date(self, files: List[LazyAudio]) -> bool:
+        return (self.config == get_config_fingerprint()
+                and self.scheduler == get_scheduler_fingerprint()
+                and {file.filename: get_file_signature(file) for file in files} == self.episodes)
+
+    def record(self, files: List[LazyAudio], pairs: Iterable[Pair] | dict[Pair, object]):
+        """
+        Запоминает текущие версии файлов и обработанные пары (с результатами, если передан словарь)
+        и атомарно сохраняет журнал.
+        """
+        self.config = get_config_fingerprint()
+        self.scheduler = get_scheduler_fingerprint()
+        self.episodes = {file.filename: get_file_signature(file) for file in files}
+        self.pairs = dict(pairs) if isinstance(pairs, dict) else dict.fromkeys(pairs)
+
+        ledger = {'config': self.config,
+                  'scheduler': self.scheduler,
+                  'episodes': self.episodes,
+                  'pairs': [{'file1': file1, 'file2': file2, 'result': result}
+                            for (file1, file2), result in self.pairs.items()]}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(ledger, f)
+        os.replace(f'{self.path}.tmp', self.path)
@@ -0,0 +1,69 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from config import PAIR_SCHEDULER_CONSENSUS, PAIR_SCHEDULER_TOLERANCE_SECS, PAIR_SCHEDULER_MAX_WINDOW
+
+Pair = Tuple[str, str]
+
+
+class PairScheduler:
+    """
+    Адаптивный порядок сравнения эпизодов сериала.
+    Пары перебираются кругами: сначала соседние эпизоды, затем через один и так далее до window - 1,
+    так как чем ближе эпизоды, тем вероятнее у них общий опенинг.
+    Пара пропускается, если оба ее эпизода уже устоялись: у эпизода не меньше consensus оценок опенинга,
+    у которых начало и конец отличаются от медианных не больше чем на tolerance_secs.
+    Так окно расширяется только для эпизодов, оценки которых расходятся или отсутствуют.
+    Оценки добавляются через add по мере расчета пар, iter_pairs учитывает их сразу.
+    """
+
+    def __init__(self,
+                 filenames: List[str],
+                 consensus: int = PAIR_SCHEDULER_CONSENSUS,
+                 tolerance_secs: float = PAIR_SCHEDULER_TOLERANCE_SECS,
+                 window: int = PAIR_SCHEDULER_MAX_WINDOW):
+        self.filenames = sorted(filenames, key=lambda filename: int(filename.split('.')[0]))
+        self.positions = {filename: i for i, filename in enumerate(self.filenames)}
+        self.consensus = consensus
+        self.tolerance_secs = tolerance_secs
+        self.window = window
+        self.openings: dict[str, List[Tuple[float, float]]] = {filename: [] for filename in self.filenames}
+        self.tried: set[Pair] = set()
+
+    def add(self, pair: Pair, opening: Tuple[float, float, float, float] | None):
+        """
+        Запоминает результат пары: (begin1, end1, begin2, end2) или None, если опенинг не найден.
+        """
+        self.tried.add(pair)
+        if opening is None:
+            return
+
+        file1, file2 = pair
+        begin1, end1, begin2, end2 = opening
+        if file1 in self.openings:
+            self.openings[file1].append((begin1, end1))
+        if file2 in self.openings:
+            self.openings[file2].append((begin2, end2))
+
+    def is_settled(self, filename: str) -> bool:
+        openings = np.array(self.openings[filename], dtype=np.float64).reshape(-1, 2)
+        if len(openings) < self.consensus:
+            return False
+
+        is_consistent = np.all(np.abs(openings - np.median(openings, axis=0)) <= self.tolerance_secs, axis=1)
+        return int(np.count_nonzero(is_consistent)) >= self.consensus
+
+    def is_needed(self, pair: Pair) -> bool:
+        return pair not in self.tried and not (self.is_settled(pair[0]) and self.is_settled(pair[1]))
+
+    def get_round(self, pair: Pair) -> int:
+        # Номер круга - расстояние между эпизодами пары
+        return self.positions[pair[1]] - self.positions[pair[0]]
+
+    def iter_pairs(self) -> Iterator[Pair]:
+        for distance in range(1, self.window):
+            for i in range(len(self.filenames) - distance):
+                pair = (self.filenames[i], self.filenames[i + distance])
+                if self.is_needed(pair):
+                    yield pair
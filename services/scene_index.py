@@ -0,0 +1,186 @@
+import os
+import sqlite3
+from typing import Iterable
+
+import numpy as np
+from numpy import ndarray
+
+from config import SCENE_INDEX_BANDS, SCENE_INDEX_MULTI_PROBE
+
+# Количество единичных битов в каждом байте
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class SceneIndex:
+    """
+    Индекс похожих сцен по хэшам (multi-index hashing в пространстве Хэмминга).
+    Хэш сцены упаковывается в биты и делится на SCENE_INDEX_BANDS полос. Для каждой полосы хранится
+    инвертированный список сцен по ее значению. По принципу Дирихле сцены на расстоянии меньше числа полос
+    совпадают с запросом хотя бы в одной полосе; с multi-probe проверяются и ключи, отличающиеся на один бит,
+    что покрывает расстояния меньше удвоенного числа полос. Кандидаты проверяются точным расстоянием.
+    Хранится в отдельном файле SQLite рядом с базой (см. get_index_path) и фиксируется отдельно от нее,
+    поэтому индекс производный: его всегда можно построить заново по таблице scenes базы
+    (AnilibriaRepository.rebuild_scene_index), например если процесс упал между записью сцен в базу и в индекс.
+    Число полос, с которым построен индекс, хранится в таблице meta. Новый индекс или индекс, у которого оно
+    не совпадает с bands (ключи полос несовместимы), очищается и помечается rebuild_required до перестройки
+    (см. finish_rebuild): индекс не знает, есть ли уже сцены в базе.
+    """
+
+    def __init__(self, path: str, bands: int = SCENE_INDEX_BANDS, multi_probe: bool = SCENE_INDEX_MULTI_PROBE):
+        self.bands = bands
+        self.multi_probe = multi_probe
+        self.database = sqlite3.connect(path)
+        cursor = self.database.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.execute('PRAGMA busy_timeout = 30000')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS indexed_scenes (
+                id INTEGER PRIMARY KEY,
+                series_id INTEGER NOT NULL,
+                episode INTEGER NOT NULL,
+                scene_begin_secs REAL NOT NULL,
+                scene_end_secs REAL NOT NULL,
+                bits BLOB NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bands (
+                band INTEGER NOT NULL,
+                key BLOB NOT NULL,
+                scene_id INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_indexed_scenes_episode ON indexed_scenes (series_id, episode)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bands_key ON bands (band, key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bands_scene ON bands (scene_id)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        ''')
+        meta = dict(cursor.execute('SELECT key, value FROM meta').fetchall())
+        if meta.get('bands') != str(bands):
+            # Новый индекс (в том числе потерянный или для базы, заполненной до его появления), построенный
+            # с другим числом полос или до появления meta: сцены базы индексу неизвестны, нужна перестройка
+            self._clear(cursor)
+        self.database.commit()
+        self.rebuild_required = cursor.execute(
+            "SELECT value FROM meta WHERE key = 'rebuild_required'").fetchone()[0] == '1'
+
+    @staticmethod
+    def get_index_path(database_path: str) -> str:
+        if database_path == ':memory:':
+            return database_path
+        root, _ = os.path.splitext(database_path)
+        return f'{root}.scenes_index.sqlite3'
+
+    def add_episodes(self, episodes: Iterable[tuple[int, int, list[tuple[float, float, ndarray]]]]):
+        """
+        Индексирует сцены эпизодов; ранее проиндексированные сцены этих эпизодов заменяются.
+        """
+        cursor = self.database.cursor()
+        for series_id, episode, scenes in episodes:
+            cursor.execute('DELETE FROM bands WHERE scene_id IN ( '
+                           '    SELECT id FROM indexed_scenes WHERE series_id = ? AND episode = ?)',
+                           (series_id, episode))
+            cursor.execute('DELETE FROM indexed_scenes WHERE series_id = ? AND episode = ?', (series_id, episode))
+            for begin, end, scene_hash in scenes:
+                bits = self.pack_hash(scene_hash)
+                cursor.execute('INSERT INTO indexed_scenes '
+                               '(series_id, episode, scene_begin_secs, scene_end_secs, bits) VALUES (?, ?, ?, ?, ?)',
+                               (series_id, episode, begin, end, bits.tobytes()))
+                scene_id = cursor.lastrowid
+                cursor.executemany('INSERT INTO bands (band, key, scene_id) VALUES (?, ?, ?)',
+                                   ((band, key.tobytes(), scene_id)
+                                    for band, key in enumerate(self._split_to_bands(bits))))
+        self.database.commit()
+
+    def clear(self):
+        """
+        Очищает индекс перед перестройкой. До вызова finish_rebuild индекс помечен rebuild_required,
+        так что прерванная перестройка будет повторена при следующем открытии базы.
+        """
+        self._clear(self.database.cursor())
+        self.database.commit()
+        self.rebuild_required = True
+
+    def finish_rebuild(self):
+        self._set_meta(self.database.cursor(), self.bands, False)
+        self.database.commit()
+        self.rebuild_required = False
+
+    def _clear(self, cursor: sqlite3.Cursor):
+        cursor.execute('DELETE FROM bands')
+        cursor.execute('DELETE FROM indexed_scenes')
+        self._set_meta(cursor, self.bands, True)
+
+    @staticmethod
+    def _set_meta(cursor: sqlite3.Cursor, bands: int, rebuild_required: bool):
+        cursor.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                           (('bands', str(bands)), ('rebuild_required', '1' if rebuild_required else '0')))
+
+    def search(self,
+               scene_hash: ndarray,
+               max_distance: int,
+               series_id: int | None = None,
+               limit: int | None = None) -> list[tuple[int, int, float, float, int]]:
+        """
+        Ищет сцены на расстоянии Хэмминга не больше max_distance от scene_hash.
+        Полнота гарантирована при max_distance < bands (или < 2 * bands с multi_probe), иначе поиск приближенный.
+        :param series_id: искать только в этом сериале; None - во всем каталоге
+        :return: список (series_id, episode, scene_begin_secs, scene_end_secs, distance) по возрастанию расстояния
+        """
+        bits = self.pack_hash(scene_hash)
+        cursor = self.database.cursor()
+
+        candidate_ids = set()
+        for band, key in enumerate(self._split_to_bands(bits)):
+            keys = [key.tobytes()]
+            if self.multi_probe:
+                keys += [SceneIndex._flip_bit(key, bit).tobytes() for bit in range(key.size * 8)]
+            cursor.execute(f'SELECT scene_id FROM bands WHERE band = ? AND key IN ({", ".join("?" * len(keys))})',
+                           (band, *keys))
+            candidate_ids.update(scene_id for scene_id, in cursor.fetchall())
+
+        results = []
+        candidate_ids = list(candidate_ids)
+        # Не больше 999 параметров на запрос для старых сборок SQLite
+        for start in range(0, len(candidate_ids), 900):
+            chunk = candidate_ids[start:start + 900]
+            query = ('SELECT series_id, episode, scene_begin_secs, scene_end_secs, bits '
+                     f'FROM indexed_scenes WHERE id IN ({", ".join("?" * len(chunk))})')
+            if series_id is not None:
+                query += ' AND series_id = ?'
+                chunk = chunk + [series_id]
+            rows = cursor.execute(query, chunk).fetchall()
+            if not rows:
+                continue
+
+            candidates = np.frombuffer(b''.join(row[4] for row in rows), dtype=np.uint8).reshape(len(rows), -1)
+            distances = _POPCOUNT[candidates ^ bits].sum(axis=1, dtype=np.int64)
+            results.extend((*row[:4], int(distance))
+                           for row, distance in zip(rows, distances) if distance <= max_distance)
+
+        results.sort(key=lambda result: (result[4], result[0], result[1], result[2]))
+        return results[:limit] if limit is not None else results
+
+    @staticmethod
+    def pack_hash(scene_hash: ndarray) -> ndarray:
+        """
+        Булевы хэши упаковываются по 8 бит в байт, остальные сравниваются по битам их байтового представления.
+        """
+        scene_hash = np.ascontiguousarray(scene_hash)
+        if scene_hash.dtype == np.bool_:
+            return np.packbits(scene_hash.reshape(-1))
+        return np.frombuffer(scene_hash.tobytes(), dtype=np.uint8)
+
+    def _split_to_bands(self, bits: ndarray) -> list[ndarray]:
+        return [band for band in np.array_split(bits, min(self.bands, bits.size)) if band.size]
+
+    @staticmethod
+    def _flip_bit(key: ndarray, bit: int) -> ndarray:
+        flipped = key.copy()
+        flipped[bit // 8] ^= np.uint8(1 << (bit % 8))
+        return flipped
@@ -0,0 +1,25 @@
+from config import SCREENSHOT_CLUSTER_GAP_SECS
+
+
+def get_screenshot_offsets(op_begin_secs: float, op_end_secs: float) -> list[float]:
+    return [
+        op_begin_secs - 2,
+        op_begin_secs + 2,
+        op_end_secs - 2,
+        op_end_secs + 2,
+    ]
+
+
+def plan_clusters(offsets: list[float], max_gap_secs: float = SCREENSHOT_CLUSTER_GAP_SECS) -> list[list[float]]:
+    """
+    Группирует отсортированные смещения так, чтобы соседние кадры группы отстояли не больше чем на max_gap_secs.
+    На группу приходится одна перемотка: декодировать вперед несколько секунд дешевле, чем снова декодировать
+    от ближайшего ключевого кадра. Смещения до начала видео заменяются нулем.
+    """
+    clusters = []
+    for offset in sorted(max(0.0, offset) for offset in offsets):
+        if clusters and offset - clusters[-1][-1] <= max_gap_secs:
+            clusters[-1].append(offset)
+        else:
+            clusters.append([offset])
+    return clusters
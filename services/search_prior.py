@@ -0,0 +1,157 @@
+import csv
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from config import (RATE, WINDOW, WINDOW_BEAT, SEARCH_PRIOR_MODE, SEARCH_PRIOR_MIN_EPISODES, SEARCH_PRIOR_MARGIN_SECS,
+                    SEARCH_PRIOR_MAX_REGION_SECS, SEARCH_PRIOR_CATALOGUE_QUANTILE, SEARCH_PRIOR_MIN_CORR)
+from services.backend import xp
+from services.correlator import correlation_with_async_moving_window_batch, get_match_corr
+from services.feature_cache import FeatureCache
+
+SEARCH_PRIOR_MODES = ('off', 'series', 'catalogue')
+
+Opening = Tuple[float, float]
+
+
+class SearchPrior:
+    """
+    Область аудио эпизода (в секундах), в которой ожидается опенинг.
+    Аудио всех эпизодов - хвосты одинаковой длины (см. s2_extract_audio.py), поэтому опенинги одного сериала
+    находятся примерно в одном и том же месте аудио.
+    """
+
+    def __init__(self, begin_secs: float, end_secs: float, source: str):
+        self.begin_secs = begin_secs
+        self.end_secs = end_secs
+        self.source = source
+
+    def get_region(self) -> Tuple[int, int]:
+        return int(self.begin_secs * RATE), int(self.end_secs * RATE)
+
+    def __repr__(self):
+        return f'SearchPrior({self.begin_secs:.1f}, {self.end_secs:.1f}, {self.source})'
+
+
+def learn_search_prior(openings: List[Opening], source: str, quantile: float = 0.0) -> SearchPrior | None:
+    """
+    Строит область по найденным опенингам: от quantile-квантиля начал до (1 - quantile)-квантиля концов
+    с запасом SEARCH_PRIOR_MARGIN_SECS. Область не короче двух окон, чтобы в нее поместился целый фрагмент
+    и ему было куда сдвигаться.
+    :return: None, если опенингов меньше SEARCH_PRIOR_MIN_EPISODES или область шире SEARCH_PRIOR_MAX_REGION_SECS -
+      тогда сужение поиска почти ничего не дает
+    """
+    openings = np.array([opening for opening in openings if 0 <= opening[0] < opening[1]],
+                        dtype=np.float64).reshape(-1, 2)
+    if len(openings) < SEARCH_PRIOR_MIN_EPISODES:
+        return None
+
+    begin_secs = max(0.0, float(np.quantile(openings[:, 0], quantile)) - SEARCH_PRIOR_MARGIN_SECS)
+    end_secs = float(np.quantile(openings[:, 1], 1 - quantile)) + SEARCH_PRIOR_MARGIN_SECS
+    if end_secs - begin_secs < 2 * WINDOW:
+        begin_secs = max(0.0, (begin_secs + end_secs) / 2 - WINDOW)
+        end_secs = begin_secs + 2 * WINDOW
+
+    if end_secs - begin_secs > SEARCH_PRIOR_MAX_REGION_SECS:
+        return None
+    return SearchPrior(begin_secs, end_secs, source)
+
+
+class SearchPriors:
+    """
+    Области поиска для сериалов в режиме mode (см. config.SEARCH_PRIOR_MODE),
+    построенные по опенингам, найденным в прошлых запусках.
+    """
+
+    def __init__(self, openings_by_series: Dict[int, List[Opening]], mode: str = SEARCH_PRIOR_MODE):
+        if mode not in SEARCH_PRIOR_MODES:
+            raise ValueError(f'Unknown search prior mode {mode}, expected one of {SEARCH_PRIOR_MODES}')
+
+        self.mode = mode
+        self.openings_by_series = openings_by_series
+        self.catalogue_prior = None
+        if mode == 'catalogue':
+            self.catalogue_prior = learn_search_prior(
+                [opening for openings in openings_by_series.values() for opening in openings],
+                'catalogue', SEARCH_PRIOR_CATALOGUE_QUANTILE)
+
+    def get(self, series_id: int) -> SearchPrior | None:
+        """
+        :return: область сериала, иначе область каталога (в режиме 'catalogue'), иначе None - поиск по всему аудио
+        """
+        if self.mode == 'off':
+            return None
+
+        prior = learn_search_prior(self.openings_by_series.get(series_id, []), f'series {series_id}')
+        return prior if prior is not None else self.catalogue_prior
+
+
+def read_offsets_csv(path: str) -> Dict[int, List[Opening]]:
+    """
+    Читает опенинги из результата s4_offsets_calculator.py (строки series_id,episode,begin,end[,confidence]).
+    """
+    openings_by_series: Dict[int, List[Opening]] = {}
+    if not os.path.exists(path):
+        return openings_by_series
+
+    with open(path, 'r', newline='') as f:
+        for series_id, _, begin, end, *_ in csv.reader(f):
+            openings_by_series.setdefault(int(series_id), []).append((float(begin), float(end)))
+    return openings_by_series
+
+
+def read_offsets_dir(path: str) -> Dict[int, List[Opening]]:
+    """
+    Читает опенинги из результатов main.py ({series_id}.csv со строками File,Start,End,Length).
+    """
+    openings_by_series: Dict[int, List[Opening]] = {}
+    if not os.path.isdir(path):
+        return openings_by_series
+
+    for filename in os.listdir(path):
+        series_id, extension = os.path.splitext(filename)
+        if not series_id.isdigit() or extension != '.csv':
+            continue
+        with open(os.path.join(path, filename), 'r', newline='') as f:
+            openings_by_series[int(series_id)] = [(float(row['Start']), float(row['End']))
+                                                  for row in csv.DictReader(f)]
+    return openings_by_series
+
+
+def correlate_with_prior(audio1: xp.ndarray,
+                         audio2: xp.ndarray,
+                         prior: SearchPrior | None,
+                         cache: FeatureCache | None = None) -> xp.ndarray:
+    return correlate_with_prior_batch([(audio1, audio2)], prior, cache)[0][0]
+
+
+def correlate_with_prior_batch(pairs: List[Tuple[xp.ndarray, xp.ndarray]],
+                               prior: SearchPrior | None,
+                               cache: FeatureCache | None = None) -> Tuple[List[xp.ndarray], int]:
+    """
+    Асинхронное окно (correlation_with_async_moving_window_batch) с поиском только внутри области prior.
+    Пары, для которых область короче окна или найденный в ней фрагмент коррелирует слабее SEARCH_PRIOR_MIN_CORR,
+    коррелируются заново по всему аудио.
+    :return: (результаты в порядке пар, количество пар, скоррелированных по всему аудио)
+    """
+    if prior is None:
+        return correlation_with_async_moving_window_batch(pairs, cache), 0
+
+    begin, end = prior.get_region()
+    results: List[xp.ndarray | None] = [None] * len(pairs)
+    restricted = [i for i, (audio1, audio2) in enumerate(pairs)
+                  if len(audio1[begin:end]) > WINDOW_BEAT and len(audio2[begin:end]) > WINDOW_BEAT]
+    if restricted:
+        batch = correlation_with_async_moving_window_batch([pairs[i] for i in restricted], cache, region=(begin, end))
+        for i, offsets in zip(restricted, batch):
+            if get_match_corr(*pairs[i], offsets) >= SEARCH_PRIOR_MIN_CORR:
+                results[i] = offsets
+
+    full_scan = [i for i, offsets in enumerate(results) if offsets is None]
+    if full_scan:
+        batch = correlation_with_async_moving_window_batch([pairs[i] for i in full_scan], cache)
+        for i, offsets in zip(full_scan, batch):
+            results[i] = offsets
+
+    return results, len(full_scan)
@@ -0,0 +1,112 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from config import RATE
+
+# Сколько значений ниже порога допускается после начала фрагмента, прежде чем он считается законченным
+MAX_BAD_COUNT = 30
+# Начало ближе MIN_BEGIN_IDX к началу кривой приравнивается к нулю
+MIN_BEGIN_IDX = 3
+
+
+def pad_curves(curves: List[np.ndarray]) -> np.ndarray:
+    """
+    Собирает кривые корреляции разной длины в одну матрицу (num_curves, max_length), дополняя их NaN.
+    """
+    max_length = max((len(curve) for curve in curves), default=0)
+    dtype = np.result_type(np.float32, *(curve.dtype for curve in curves))
+    padded = np.full((len(curves), max_length), np.nan, dtype=dtype)
+    for i, curve in enumerate(curves):
+        padded[i, :len(curve)] = curve
+
+    return padded
+
+
+def find_segments(corr_values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Находит самый длинный похожий фрагмент сразу для батча кривых корреляции.
+    Для каждой кривой отбрасываются выбросы выше mean + 3 * std, порог равен половине максимума оставшихся значений.
+    Начало - первое значение выше порога, конец - последнее значение выше порога до того,
+    как после начала наберется больше MAX_BAD_COUNT значений ниже порога.
+    :param corr_values: ndarray (num_curves, max_length), дополненный NaN (см. pad_curves)
+    :return: (begin_idx, end_idx, is_found, is_empty),
+      где is_found - найден ли фрагмент,
+          is_empty - не осталось значений после отбрасывания выбросов
+    """
+    num_curves, length = corr_values.shape
+    is_valid = ~np.isnan(corr_values)
+    lengths = np.count_nonzero(is_valid, axis=1)
+
+    # Статистики считаются по группам кривых одной длины без дополнения, чтобы порядок суммирования,
+    # а значит и результат, совпадали с np.mean/np.std по отдельной кривой
+    max_limit = np.full((num_curves, 1), np.nan)
+    for curve_length in np.unique(lengths[lengths > 0]):
+        rows = lengths == curve_length
+        block = corr_values[rows, :curve_length]
+        max_limit[rows, 0] = np.mean(block, axis=1) + 3 * np.std(block, axis=1)
+
+    with np.errstate(invalid='ignore'):
+        filtered = np.where(is_valid & (corr_values < max_limit), corr_values, np.nan)
+
+    filtered_count = np.count_nonzero(~np.isnan(filtered), axis=1)
+    is_empty = filtered_count == 0
+
+    begin_idx = np.zeros(num_curves, dtype=np.int64)
+    end_idx = np.zeros(num_curves, dtype=np.int64)
+    is_found = np.zeros(num_curves, dtype=bool)
+    if length == 0 or is_empty.all():
+        return begin_idx, end_idx, is_found, is_empty
+
+    rows = ~is_empty
+    filtered = filtered[rows]
+    values = corr_values[rows]
+
+    filtered_mean = np.nanmean(filtered, axis=1)
+    filtered_median = np.nanmedian(filtered, axis=1)
+    threshold = np.nanmax(filtered, axis=1, keepdims=True) / 2
+
+    with np.errstate(invalid='ignore'):
+        above = values > threshold
+
+    begin = np.argmax(above, axis=1)
+    begin = np.where(begin > MIN_BEGIN_IDX, begin, 0)
+
+    # Значения ниже порога копятся с начала фрагмента; на (MAX_BAD_COUNT + 1)-м поиск конца останавливается
+    indices = np.arange(length)
+    after_begin = indices >= begin[:, None]
+    bad_count = np.cumsum(~above & after_begin, axis=1)
+    is_before_stop = bad_count <= MAX_BAD_COUNT
+    last_above = np.max(np.where(above & after_begin & is_before_stop, indices, -1), axis=1)
+    end = np.maximum(begin, last_above)
+
+    begin_idx[rows] = begin
+    end_idx[rows] = end
+    is_found[rows] = ~(filtered_mean < filtered_median * 2)
+
+    return begin_idx, end_idx, is_found, is_empty
+
+
+def find_pair_openings(data: List[Tuple[str, str, float, float, np.ndarray]]
+                       ) -> List[Tuple[float, float, float, float] | None]:
+    """
+    Границы опенинга в обоих эпизодах каждой пары по ее кривой корреляции (как в s4_offsets_calculator.py).
+    :param data: список (file1, file2, offset1_secs, offset2_secs, corr), corr - ndarray (num_seconds, 2)
+    :return: для каждой пары (begin1, end1, begin2, end2) в секундах или None, если опенинг не найден
+    """
+    if not data:
+        return []
+
+    begin_indices, end_indices, is_found, is_empty = find_segments(pad_curves([corr[:, 1] for *_, corr in data]))
+
+    openings = []
+    for (_, _, offset1, offset2, corr), begin_idx, end_idx, found, empty \
+            in zip(data, begin_indices, end_indices, is_found, is_empty):
+        if empty or not found:
+            openings.append(None)
+            continue
+
+        begin = corr[begin_idx, 0] / RATE
+        end = corr[end_idx, 0] / RATE
+        openings.append((offset1 + begin, offset1 + end, offset2 + begin, offset2 + end))
+    return openings
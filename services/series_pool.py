@@ -0,0 +1,270 @@
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+from typing import Callable, Iterable
+
+from config import POOL_WORKERS, THREADS_PER_WORKER, CLAIM_TIMEOUT_SECS
+
+_THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'AOR_FFT_WORKERS')
+
+# WinAPI: права на запрос состояния процесса, код отказа в доступе и код возврата еще работающего процесса
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+ERROR_ACCESS_DENIED = 5
+STILL_ACTIVE = 259
+
+
+def run_series_pool(series_ids: Iterable[int],
+                    analyze: Callable[[int], None],
+                    claims_dir: str,
+                    workers: int = POOL_WORKERS,
+                    threads_per_worker: int = THREADS_PER_WORKER):
+    """
+    Обрабатывает сериалы в workers процессах, которые берут id из общей очереди.
+    Перед обработкой сериал захватывается файлом {series_id}.claim в claims_dir, поэтому два процесса
+    (в том числе на разных машинах с общим хранилищем) не возьмут один сериал.
+    Захват продлевается, пока сериал обрабатывается; брошенный после падения захват истекает через
+    CLAIM_TIMEOUT_SECS (захват умершего процесса этой же машины - сразу), и сериал снова становится доступен.
+    Успешно обработанные отмечаются файлом {series_id}.done, завершившиеся ошибкой - {series_id}.failed.
+    :param series_ids: id сериалов для обработки
+    :param analyze: функция обработки одного сериала, должна импортироваться по имени (для spawn)
+    :param claims_dir: каталог файлов захвата
+    :param workers: количество процессов
+    :param threads_per_worker: количество потоков BLAS/FFT в каждом процессе
+    """
+    os.makedirs(claims_dir, exist_ok=True)
+
+    # Переменные окружения наследуются дочерними процессами и читаются при импорте numpy/scipy
+    for name in _THREAD_ENV_VARS:
+        os.environ[name] = str(threads_per_worker)
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    for series_id in series_ids:
+        queue.put(series_id)
+    for _ in range(workers):
+        queue.put(None)
+
+    processes = [context.Process(target=_worker, args=(queue, analyze, claims_dir), daemon=False)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def get_interrupted_series(claims_dir: str) -> list[int]:
+    """
+    Возвращает id сериалов, захваченных, но так и не завершенных, например из-за падения процесса,
+    и сериалов, обработка которых завершилась ошибкой ({series_id}.failed).
+    Их результаты могут быть неполными, поэтому при перезапуске их нужно обработать заново.
+    """
+    if not os.path.isdir(claims_dir):
+        return []
+
+    files = os.listdir(claims_dir)
+    return sorted({int(file.split('.')[0])
+                   for file in files
+                   if (file.endswith('.claim') or file.endswith('.failed'))
+                   and f'{file.split(".")[0]}.done' not in files})
+
+
+def is_series_done(claims_dir: str, series_id: int) -> bool:
+    return os.path.exists(os.path.join(claims_dir, f'{series_id}.done'))
+
+
+def reset_done_series(claims_dir: str, series_ids: Iterable[int]):
+    """
+    Удаляет отметки {series_id}.done сериалов, которые нужно обработать заново (например, у них изменились эпизоды).
+    Иначе процессы пула пропустят их как уже обработанные. Вызывается перед run_series_pool.
+    """
+    if not os.path.isdir(claims_dir):
+        return
+
+    for series_id in series_ids:
+        _remove_if_exists(os.path.join(claims_dir, f'{series_id}.done'))
+
+
+def _worker(queue, analyze: Callable[[int], None], claims_dir: str):
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    while True:
+        series_id = queue.get()
+        if series_id is None:
+            return
+
+        if is_series_done(claims_dir, series_id) or not _try_claim(claims_dir, series_id, worker_id):
+            continue
+
+        print(f'[{worker_id}] Processing series {series_id}')
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=_renew_claim, args=(claims_dir, series_id, worker_id, stop_heartbeat),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            analyze(series_id)
+        except Exception:
+            print(f'[{worker_id}] Error while processing series {series_id}')
+            traceback.print_exc()
+            stop_heartbeat.set()
+            heartbeat.join()
+            # Отметка ошибки возвращает сериал в очередь при следующем запуске (см. get_interrupted_series)
+            _write_marker(claims_dir, series_id, 'failed', worker_id)
+            _release_claim(claims_dir, series_id, worker_id)
+            continue
+
+        stop_heartbeat.set()
+        heartbeat.join()
+        _write_marker(claims_dir, series_id, 'done', worker_id)
+        _remove_if_exists(os.path.join(claims_dir, f'{series_id}.failed'))
+        _release_claim(claims_dir, series_id, worker_id)
+
+
+def _try_claim(claims_dir: str, series_id: int, worker_id: str) -> bool:
+    claim_path = _get_claim_path(claims_dir, series_id)
+    try:
+        fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return _try_take_over(claim_path, worker_id)
+
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker_id': worker_id, 'claimed_at': time.time()}, f)
+    return True
+
+
+def _try_take_over(claim_path: str, worker_id: str) -> bool:
+    """
+    Перехватывает брошенный захват (см. _is_claim_stale).
+    Перехваты одного сериала идут под блокировкой - каталогом {claim}.lock (os.mkdir атомарен),
+    поэтому между повторной проверкой и заменой захват не перехватит другой процесс.
+    Захват заменяется атомарно через os.replace заранее записанного файла: файл захвата не пропадает ни на миг,
+    и создать его заново через O_EXCL никто не может.
+    """
+    if not _is_claim_stale(claim_path):
+        return False
+
+    lock_path = f'{claim_path}.lock'
+    try:
+        os.mkdir(lock_path)
+    except FileExistsError:
+        # Блокировку держат миллисекунды; оставшаяся после падения снимается по таймауту
+        try:
+            if time.time() - os.path.getmtime(lock_path) > CLAIM_TIMEOUT_SECS:
+                os.rmdir(lock_path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    try:
+        if not _is_claim_stale(claim_path):
+            return False
+
+        new_claim_path = f'{claim_path}.{worker_id.replace(":", "_")}.new'
+        with open(new_claim_path, 'w') as f:
+            json.dump({'worker_id': worker_id, 'claimed_at': time.time()}, f)
+        os.replace(new_claim_path, claim_path)
+        return True
+    finally:
+        os.rmdir(lock_path)
+
+
+def _is_claim_stale(claim_path: str) -> bool:
+    """
+    Захват брошен, если он не продлевался дольше CLAIM_TIMEOUT_SECS
+    или принадлежит уже завершившемуся процессу на этой же машине (перезапуск после падения).
+    """
+    try:
+        modified_at = os.path.getmtime(claim_path)
+        claim = _read_claim(claim_path)
+    except FileNotFoundError:
+        return False
+
+    if time.time() - modified_at > CLAIM_TIMEOUT_SECS:
+        return True
+
+    host, _, pid = (claim.get('worker_id') or '').rpartition(':')
+    return host == socket.gethostname() and pid.isdigit() and not _is_process_alive(int(pid))
+
+
+def _renew_claim(claims_dir: str, series_id: int, worker_id: str, stop: threading.Event):
+    claim_path = _get_claim_path(claims_dir, series_id)
+    while not stop.wait(CLAIM_TIMEOUT_SECS / 4):
+        try:
+            claim = _read_claim(claim_path)
+        except FileNotFoundError:
+            # Захват пропал (например, удален вручную) - создаем его заново, если сериал никто не успел захватить
+            if not _try_claim(claims_dir, series_id, worker_id):
+                print(f'[{worker_id}] Lost the claim of series {series_id}')
+                return
+            continue
+
+        if claim.get('worker_id') != worker_id:
+            print(f'[{worker_id}] Claim of series {series_id} was taken over by {claim.get("worker_id")}')
+            return
+        os.utime(claim_path)
+
+
+def _release_claim(claims_dir: str, series_id: int, worker_id: str):
+    # Перехваченный другим процессом захват не трогаем
+    claim_path = _get_claim_path(claims_dir, series_id)
+    try:
+        if _read_claim(claim_path).get('worker_id') == worker_id:
+            os.remove(claim_path)
+    except FileNotFoundError:
+        pass
+
+
+def _read_claim(claim_path: str) -> dict:
+    """
+    :return: содержимое захвата; пустой словарь, если файл только что создан и еще не записан
+    :raise FileNotFoundError: захвата нет
+    """
+    with open(claim_path, 'r') as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+
+def _write_marker(claims_dir: str, series_id: int, kind: str, worker_id: str):
+    with open(os.path.join(claims_dir, f'{series_id}.{kind}'), 'w') as f:
+        json.dump({'worker_id': worker_id, 'finished_at': time.time()}, f)
+
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _is_process_alive(pid: int) -> bool:
+    if os.name == 'nt':
+        # os.kill(pid, 0) на Windows завершает процесс, поэтому состояние запрашивается через WinAPI
+        import ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _get_claim_path(claims_dir: str, series_id: int) -> str:
+    return os.path.join(claims_dir, f'{series_id}.claim')
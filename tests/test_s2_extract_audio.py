@@ -0,0 +1,76 @@
+# Извлечение аудио на коротких роликах, сгенерированных ffmpeg. Без ffmpeg тесты пропускаются.
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import s2_extract_audio
+from services.audio_loader import NPY_META_EXTENSION, read_npy_rate
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+
+RATE = 8000
+
+
+def make_video(path: str, duration_secs: float):
+    # Синус 440 Гц в AAC с кадрами тестовой таблицы - как у настоящих эпизодов, mp4 с видео и звуком
+    subprocess.run(['ffmpeg', '-v', 'error', '-nostdin', '-y',
+                    '-f', 'lavfi', '-i', f'testsrc=duration={duration_secs}:size=64x64:rate=10',
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:duration={duration_secs}',
+                    '-c:v', 'mpeg4', '-c:a', 'aac', '-shortest', path],
+                   check=True)
+
+
+@pytest.fixture
+def extraction(tmp_path, monkeypatch):
+    monkeypatch.setattr(s2_extract_audio, 'TRUNCATE_SECS', 3)
+    monkeypatch.setattr(s2_extract_audio, 'EXTRACT_RATE', RATE)
+    monkeypatch.setattr(s2_extract_audio, 'MIN_DURATION_TOLERANCE_SECS', 1)
+    return tmp_path
+
+
+def test_decode_tail_returns_last_seconds(tmp_path):
+    video = str(tmp_path / '1.mp4')
+    make_video(video, 5)
+
+    audio, _ = s2_extract_audio.decode_tail(video, truncate_secs=3, rate=RATE)
+
+    assert audio.dtype == np.float32
+    # Граница AAC-кадра дает расхождение в несколько миллисекунд
+    assert abs(len(audio) - 3 * RATE) <= 0.05 * RATE
+    assert np.max(np.abs(audio)) > 0.1
+
+
+def test_decode_tail_fails_on_missing_file(tmp_path):
+    audio, stderr = s2_extract_audio.decode_tail(str(tmp_path / 'missing.mp4'), truncate_secs=3, rate=RATE)
+
+    assert len(audio) == 0
+    assert stderr
+
+
+def test_extract_episode_saves_array_and_rate(extraction):
+    video = str(extraction / '7.mp4')
+    make_video(video, 5)
+
+    record = s2_extract_audio.extract_episode(1, video, str(extraction))
+
+    path = str(extraction / '7.npy')
+    assert record['status'] == 'ok'
+    assert record['episode'] == '7'
+    assert record['rate'] == RATE
+    assert len(np.load(path)) == record['samples']
+    assert abs(record['samples'] - 3 * RATE) <= 0.05 * RATE
+    assert os.path.exists(f'{path}{NPY_META_EXTENSION}')
+    assert read_npy_rate(path) == RATE
+
+
+def test_extract_episode_rejects_short_video(extraction):
+    video = str(extraction / '2.mp4')
+    make_video(video, 1)
+
+    record = s2_extract_audio.extract_episode(1, video, str(extraction))
+
+    assert record['status'] == 'too_short'
+    assert not os.path.exists(extraction / '2.npy')
@@ -0,0 +1,50 @@
+# Планирование перемоток - без зависимостей; чтение кадров - на ролике, сгенерированном ffmpeg, при наличии cv2
+import shutil
+import subprocess
+
+import pytest
+
+from services.screenshots import get_screenshot_offsets, plan_clusters
+
+FPS = 25
+
+
+def test_plan_clusters_clamps_negative_offsets_to_zero():
+    assert plan_clusters([-2.0, 2.0], max_gap_secs=10) == [[0.0, 2.0]]
+
+
+def test_plan_clusters_merges_close_and_splits_distant_offsets():
+    offsets = get_screenshot_offsets(100, 190)
+
+    assert plan_clusters(offsets, max_gap_secs=10) == [[98, 102], [188, 192]]
+    assert plan_clusters(offsets, max_gap_secs=100) == [[98, 102, 188, 192]]
+    assert plan_clusters(offsets, max_gap_secs=1) == [[98], [102], [188], [192]]
+
+
+def test_plan_clusters_sorts_offsets():
+    assert plan_clusters([30.0, 5.0, 1.0], max_gap_secs=10) == [[1.0, 5.0], [30.0]]
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+def test_read_frames_returns_frames_at_offsets(tmp_path):
+    cv2 = pytest.importorskip('cv2')
+    from s6_screenshoter import read_frames
+
+    video = str(tmp_path / '1.mp4')
+    # Ключевой кадр раз в 2 секунды: перемотка внутри группы требует декодирования от ключевого кадра
+    subprocess.run(['ffmpeg', '-v', 'error', '-nostdin', '-y',
+                    '-f', 'lavfi', '-i', f'testsrc=duration=10:size=64x64:rate={FPS}',
+                    '-c:v', 'mpeg4', '-g', str(2 * FPS), video],
+                   check=True)
+    offsets = [-1.0, 3.0, 3.5, 8.3]
+
+    cap = cv2.VideoCapture(video)
+    try:
+        frames = read_frames(cap, offsets)
+    finally:
+        cap.release()
+
+    assert len(frames) == len(offsets)
+    for (timecode_ms, frame), offset in zip(frames, sorted(max(0.0, offset) for offset in offsets)):
+        assert abs(timecode_ms - offset * 1000) <= 100
+        assert frame.shape == (64, 64, 3)